@@ -0,0 +1,270 @@
+"""Circulation statistics computed on an in-memory columnar snapshot.
+
+Loans (live and archived), books and categories are loaded once into NumPy
+column arrays and every report is a vectorized group-by over them, so the
+statistics pages never run row-by-row SQL against the production tables.
+
+The snapshot refreshes incrementally after REFRESH_SECONDS: only loans with a
+higher id, loans still open or returned since the last refresh, and newly
+archived loans are read back. Deleted loans and edits to long-finished loans
+are picked up by the full reload every FULL_REFRESH_SECONDS.
+
+One snapshot holds every branch; reports mask it down to the branch of the
+request.
+"""
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import or_
+from models import db, Loan, LoanArchive, Book, Category, Reader
+import branches
+
+try:
+    import numpy as np
+except ImportError:  # the /api/stats endpoints answer 503 without it
+    np = None
+
+REFRESH_SECONDS = 60
+FULL_REFRESH_SECONDS = 3600
+
+_lock = threading.Lock()
+_snapshot = {}
+
+
+def available():
+    return np is not None
+
+
+def _dates(values):
+    return np.array([v.date() if hasattr(v, 'date') else v for v in values], dtype='datetime64[D]')
+
+
+def _loan_columns(rows):
+    # rows: (loan_id, book_id, reader_id, loan_date, due_date, returned_at, branch_id)
+    rows = list(rows)
+    return {
+        'loan_id': np.array([r[0] for r in rows], dtype=np.int64),
+        'branch_id': np.array([r[6] for r in rows], dtype=np.int64),
+        'book_id': np.array([r[1] for r in rows], dtype=np.int64),
+        'reader_id': np.array([r[2] for r in rows], dtype=np.int64),
+        'loan_date': _dates(r[3] for r in rows),
+        'due_date': _dates(r[4] for r in rows),
+        'returned': _dates(r[5] for r in rows),
+    }
+
+
+def _live_query():
+    return db.session.query(Loan.id, Loan.book_id, Loan.reader_id, Loan.loan_date, Loan.due_date,
+                            Loan.returned_at, Loan.branch_id).execution_options(all_branches=True)
+
+
+def _archive_query():
+    return db.session.query(LoanArchive.loan_id, LoanArchive.book_id, LoanArchive.reader_id,
+                            LoanArchive.loan_date, LoanArchive.due_date, LoanArchive.returned_at,
+                            LoanArchive.branch_id).execution_options(all_branches=True)
+
+
+def _replace(loans, columns):
+    # Drop the rows being re-read, then append their current version
+    keep = ~np.isin(loans['loan_id'], columns['loan_id'])
+    return {key: np.concatenate([loans[key][keep], columns[key]]) for key in loans}
+
+
+def _load_books():
+    rows = (db.session.query(Book.id, Book.category_id, Book.title, Book.branch_id)
+            .order_by(Book.id).execution_options(all_branches=True).all())
+    return {
+        'id': np.array([r[0] for r in rows], dtype=np.int64),
+        'branch_id': np.array([r[3] for r in rows], dtype=np.int64),
+        'category_id': np.array([r[1] or 0 for r in rows], dtype=np.int64),
+        'title': np.array([r[2] for r in rows], dtype=object),
+    }
+
+
+def refresh(full=False):
+    """Bring the snapshot up to date. Returns it."""
+    now = time.monotonic()
+    snap = _snapshot
+    if full or not snap or now - snap['loaded_at'] > FULL_REFRESH_SECONDS:
+        loans = _replace(_loan_columns(_archive_query()), _loan_columns(_live_query()))
+        snap = {'loaded_at': now}
+    else:
+        loans = snap['loans']
+        since = snap['refreshed_on'] - timedelta(minutes=1)
+        archived = _loan_columns(_archive_query().filter(LoanArchive.id > snap['max_archive_id']))
+        changed = _loan_columns(_live_query().filter(or_(
+            Loan.id > snap['max_live_id'],
+            Loan.returned_at == None,
+            Loan.returned_at >= since
+        )))
+        loans = _replace(_replace(loans, archived), changed)
+        snap = dict(snap)
+
+    snap['max_live_id'] = db.session.query(db.func.max(Loan.id)).execution_options(all_branches=True).scalar() or 0
+    snap['max_archive_id'] = db.session.query(db.func.max(LoanArchive.id)).execution_options(all_branches=True).scalar() or 0
+    snap['refreshed_on'] = datetime.utcnow()
+    snap['refreshed_at'] = now
+    snap['loans'] = loans
+    snap['books'] = _load_books()
+    snap['categories'] = dict(db.session.query(Category.id, Category.name).all())
+    _snapshot.clear()
+    _snapshot.update(snap)
+    return _snapshot
+
+
+def _current():
+    """The snapshot, restricted to the current branch if one is set."""
+    with _lock:
+        if not _snapshot or time.monotonic() - _snapshot['refreshed_at'] > REFRESH_SECONDS:
+            refresh()
+        snap = dict(_snapshot)
+    branch_id = branches.current_id()
+    if branch_id is not None:
+        for name in ('loans', 'books'):
+            keep = snap[name]['branch_id'] == branch_id
+            snap[name] = {key: column[keep] for key, column in snap[name].items()}
+    return snap
+
+
+def _categories_of(snap, book_ids):
+    # Category id per loan through the sorted book id column; 0 = unknown
+    books = snap['books']
+    if not len(books['id']):
+        return np.zeros(len(book_ids), dtype=np.int64)
+    pos = np.clip(np.searchsorted(books['id'], book_ids), 0, len(books['id']) - 1)
+    found = books['id'][pos] == book_ids
+    return np.where(found, books['category_id'][pos], 0)
+
+
+def _category_name(snap, category_id):
+    return snap['categories'].get(int(category_id), 'Sans catégorie')
+
+
+def _today():
+    return np.datetime64(date.today(), 'D')
+
+
+def loans_per_category(args):
+    """Loans started per month and category over the last `months` months."""
+    snap = _current()
+    loans = snap['loans']
+    months = min(60, max(1, args.get('months', 12, type=int)))
+    last = _today().astype('datetime64[M]')
+    first = last - (months - 1)
+    month = loans['loan_date'].astype('datetime64[M]')
+    mask = (month >= first) & (month <= last)
+    month_idx = (month[mask] - first).astype(np.int64)
+    cats = _categories_of(snap, loans['book_id'][mask])
+    cat_ids, cat_idx = np.unique(cats, return_inverse=True)
+    counts = np.zeros((len(cat_ids), months), dtype=np.int64)
+    np.add.at(counts, (cat_idx, month_idx), 1)
+    labels = [str(first + i) for i in range(months)]
+    series = sorted(
+        ({'category': _category_name(snap, c), 'counts': counts[i].tolist(), 'total': int(counts[i].sum())}
+         for i, c in enumerate(cat_ids)),
+        key=lambda s: -s['total']
+    )
+    return {'months': labels, 'series': series}
+
+
+def loan_duration(args):
+    """Average and median days between loan and return, overall and per category."""
+    snap = _current()
+    loans = snap['loans']
+    done = ~np.isnat(loans['returned'])
+    days = (loans['returned'][done] - loans['loan_date'][done]).astype(np.int64)
+    cats = _categories_of(snap, loans['book_id'][done])
+    by_category = []
+    if len(days):
+        cat_ids, cat_idx = np.unique(cats, return_inverse=True)
+        sums = np.bincount(cat_idx, weights=days)
+        counts = np.bincount(cat_idx)
+        for i, c in enumerate(cat_ids):
+            by_category.append({
+                'category': _category_name(snap, c),
+                'average_days': round(float(sums[i] / counts[i]), 1),
+                'returns': int(counts[i])
+            })
+        by_category.sort(key=lambda row: -row['returns'])
+    return {
+        'returns': int(len(days)),
+        'average_days': round(float(days.mean()), 1) if len(days) else None,
+        'median_days': float(np.median(days)) if len(days) else None,
+        'by_category': by_category
+    }
+
+
+def on_time_rate(args):
+    """Share of returns made on or before the due date, overall and per month."""
+    snap = _current()
+    loans = snap['loans']
+    done = ~np.isnat(loans['returned'])
+    returned = loans['returned'][done]
+    on_time = returned <= loans['due_date'][done]
+    months, month_idx = np.unique(returned.astype('datetime64[M]'), return_inverse=True)
+    totals = np.bincount(month_idx, minlength=len(months))
+    good = np.bincount(month_idx, weights=on_time, minlength=len(months))
+    limit = min(60, max(1, args.get('months', 12, type=int)))
+    by_month = [
+        {'month': str(m), 'returns': int(totals[i]), 'rate': round(float(good[i] / totals[i]), 3)}
+        for i, m in enumerate(months)
+    ][-limit:]
+    return {
+        'returns': int(len(returned)),
+        'rate': round(float(on_time.mean()), 3) if len(returned) else None,
+        'by_month': by_month
+    }
+
+
+def top_readers(args):
+    """Readers with the most loans over the last `days` days."""
+    snap = _current()
+    loans = snap['loans']
+    days = max(1, args.get('days', 365, type=int))
+    limit = min(100, max(1, args.get('limit', 10, type=int)))
+    recent = loans['reader_id'][loans['loan_date'] >= _today() - days]
+    if not len(recent):
+        return {'days': days, 'readers': []}
+    reader_ids, counts = np.unique(recent, return_counts=True)
+    order = np.argsort(-counts, kind='stable')[:limit]
+    top = [(int(reader_ids[i]), int(counts[i])) for i in order]
+    names = {r.id: f"{r.first_name} {r.last_name}"
+             for r in Reader.query.filter(Reader.id.in_([rid for rid, _ in top])).all()}
+    return {'days': days, 'readers': [
+        {'reader_id': rid, 'reader_name': names.get(rid, 'N/A'), 'loans': n} for rid, n in top
+    ]}
+
+
+def dormant_titles(args):
+    """Books not borrowed for `days` days (or never), longest-idle first."""
+    snap = _current()
+    loans, books = snap['loans'], snap['books']
+    days = max(1, args.get('days', 180, type=int))
+    limit = min(500, max(1, args.get('limit', 50, type=int)))
+    n = len(books['id'])
+    if not n:
+        return {'days': days, 'books': []}
+    # Last loan per book as a day number; -1 = never borrowed
+    last = np.full(n, -1, dtype=np.int64)
+    pos = np.clip(np.searchsorted(books['id'], loans['book_id']), 0, n - 1)
+    known = books['id'][pos] == loans['book_id']
+    np.maximum.at(last, pos[known], loans['loan_date'][known].astype(np.int64))
+    cutoff = (_today() - days).astype(np.int64)
+    idle = np.nonzero(last < cutoff)[0]
+    idle = idle[np.argsort(last[idle], kind='stable')][:limit]
+    return {'days': days, 'books': [{
+        'book_id': int(books['id'][i]),
+        'title': books['title'][i],
+        'category': _category_name(snap, books['category_id'][i]),
+        'last_loan': str(np.datetime64(int(last[i]), 'D')) if last[i] >= 0 else None
+    } for i in idle]}
+
+
+REPORTS = {
+    'loans-per-category': loans_per_category,
+    'loan-duration': loan_duration,
+    'on-time-rate': on_time_rate,
+    'top-readers': top_readers,
+    'dormant-titles': dormant_titles,
+}
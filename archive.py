@@ -0,0 +1,141 @@
+"""Archival of finished loans and the combined returns history.
+
+Loans returned before the configured horizon are moved to LoansArchive in
+bounded batches, so the hot Loans table only holds recent and open loans.
+Penalties keep pointing at the archived copy through archived_loan_id.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, literal, and_, or_
+from models import db, Loan, LoanArchive, Book, Reader, Penalty
+
+
+def archive_finished_loans(older_than_days, batch_size=500, max_batches=None, reader_id=None, book_id=None):
+    """Move finished loans returned more than older_than_days ago (any age if
+    None), optionally only one reader's or book's. Returns the count."""
+    filters = [Loan.status == 'Terminé']
+    if older_than_days is not None:
+        filters.append(Loan.returned_at < datetime.utcnow() - timedelta(days=older_than_days))
+    if reader_id is not None:
+        filters.append(Loan.reader_id == reader_id)
+    if book_id is not None:
+        filters.append(Loan.book_id == book_id)
+    moved = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        loans = (
+            Loan.query.filter(*filters)
+            # Soft-deleted books and readers still lend their names to the archive
+            .execution_options(include_deleted=True)
+            .options(db.joinedload(Loan.book), db.joinedload(Loan.reader))
+            .order_by(Loan.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not loans:
+            break
+        try:
+            archived = {}
+            for loan in loans:
+                row = LoanArchive(
+                    loan_id=loan.id,
+                    branch_id=loan.branch_id,
+                    book_id=loan.book_id,
+                    reader_id=loan.reader_id,
+                    copy_id=loan.copy_id,
+                    book_title=loan.book.title if loan.book else None,
+                    reader_name=f"{loan.reader.first_name} {loan.reader.last_name}" if loan.reader else None,
+                    loan_date=loan.loan_date,
+                    due_date=loan.due_date,
+                    returned_at=loan.returned_at,
+                    created_at=loan.created_at
+                )
+                db.session.add(row)
+                archived[loan.id] = row
+            db.session.flush()
+
+            ids = list(archived)
+            for penalty in Penalty.query.filter(Penalty.loan_id.in_(ids)).all():
+                penalty.archived_loan_id = archived[penalty.loan_id].id
+                penalty.loan_id = None
+            db.session.flush()
+            # Set-based delete: the penalties were detached above
+            Loan.query.filter(Loan.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        db.session.expunge_all()
+        moved += len(loans)
+        batches += 1
+    return moved
+
+
+def _cursor(row):
+    """Opaque position of a row in the history: returned_at~id."""
+    return f"{row.returned_at.isoformat() if row.returned_at else ''}~{row.id}"
+
+
+def _parse_cursor(cursor):
+    returned_at, _, row_id = cursor.partition('~')
+    return (datetime.fromisoformat(returned_at) if returned_at else None), int(row_id)
+
+
+def _older(query, returned_at, row_id, position, limit):
+    """Up to `limit` rows of one source after `position`, newest first. Dated
+    rows come first, walking the returned_at index; the undated ones of old
+    databases follow, by id."""
+    rows = []
+    undated_from = None
+    if position is None or position[0] is not None:
+        dated = query.where(returned_at != None)
+        if position is not None:
+            dated = dated.where(or_(returned_at < position[0],
+                                    and_(returned_at == position[0], row_id < position[1])))
+        rows = db.session.execute(dated.order_by(returned_at.desc(), row_id.desc()).limit(limit)).all()
+    else:
+        undated_from = position[1]
+    if len(rows) < limit:
+        undated = query.where(returned_at == None)
+        if undated_from is not None:
+            undated = undated.where(row_id < undated_from)
+        rows += db.session.execute(undated.order_by(row_id.desc()).limit(limit - len(rows))).all()
+    return rows
+
+
+def returns_history(before=None, per_page=50):
+    """One page of returned loans, live and archived, newest first, starting
+    after the `before` cursor. Returns (rows, cursor of the next page or None).
+
+    Keyset pagination: each source reads at most per_page + 1 rows from its
+    returned_at index, and the two short lists are merged here, so no request
+    sorts or counts the whole history.
+    """
+    position = _parse_cursor(before) if before else None
+    live = (
+        select(
+            Loan.id.label('id'),
+            Book.title.label('book_title'),
+            (Reader.first_name + ' ' + Reader.last_name).label('reader_name'),
+            Loan.due_date.label('due_date'),
+            Loan.returned_at.label('returned_at'),
+            literal(False).label('archived')
+        )
+        .outerjoin(Book, Book.id == Loan.book_id)
+        .outerjoin(Reader, Reader.id == Loan.reader_id)
+        .where(Loan.status == 'Terminé')
+    )
+    archived = select(
+        LoanArchive.loan_id.label('id'),
+        LoanArchive.book_title.label('book_title'),
+        LoanArchive.reader_name.label('reader_name'),
+        LoanArchive.due_date.label('due_date'),
+        LoanArchive.returned_at.label('returned_at'),
+        literal(True).label('archived')
+    )
+    rows = (_older(live, Loan.returned_at, Loan.id, position, per_page + 1)
+            + _older(archived, LoanArchive.returned_at, LoanArchive.loan_id, position, per_page + 1))
+    # Archived loans keep their live id, so (returned_at, id) orders both
+    rows.sort(key=lambda r: (r.returned_at is not None, r.returned_at or datetime.min, r.id), reverse=True)
+    page = rows[:per_page]
+    return page, (_cursor(page[-1]) if len(rows) > per_page else None)
@@ -0,0 +1,164 @@
+"""Fingerprinted static assets.
+
+`flask build-assets` minifies the files under static/css and static/js,
+writes them to static/dist with a content hash in the name plus .gz/.br
+siblings, and records the mapping in static/dist/manifest.json. Templates
+call asset_url() / asset_urls(), which fall back to the plain static files
+when no build exists, so development needs no build step.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+
+from flask import url_for, send_from_directory, request, abort
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # optional, only .gz variants are written without it
+    brotli = None
+
+# Files concatenated into one asset, loaded on every page by base.html
+BUNDLES = {
+    'css/base.bundle.css': ['css/style.css', 'css/dashboard.css'],
+}
+SOURCE_DIRS = ('css', 'js')
+ONE_YEAR = 31536000
+
+_manifest = {}
+
+
+def _dist_dir(app):
+    return os.path.join(app.static_folder, 'dist')
+
+
+def minify_css(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    return text.replace(';}', '}').strip()
+
+
+def minify_js(text):
+    # Conservative: drop indentation, blank lines and whole-line // comments.
+    # Nothing inside a line is touched, so strings and regexes stay intact.
+    lines = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith('//'):
+            continue
+        lines.append(stripped)
+    return '\n'.join(lines) + '\n'
+
+
+def _absolute_css_urls(text, source):
+    # Relative url(...) must keep pointing into static/ once served from /assets/
+    base = os.path.dirname(source)
+
+    def fix(match):
+        target = match.group(2)
+        if re.match(r'^(data:|https?:|/|#)', target):
+            return match.group(0)
+        return f"url({match.group(1)}/static/{base}/{target}{match.group(1)})"
+    return re.sub(r'''url\((['"]?)([^'")]+)\1\)''', fix, text)
+
+
+def _read(app, path):
+    with open(os.path.join(app.static_folder, path), encoding='utf-8') as f:
+        text = f.read()
+    if path.endswith('.css'):
+        return minify_css(_absolute_css_urls(text, path))
+    return minify_js(text)
+
+
+def _write(app, logical, content):
+    data = content.encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    root, ext = os.path.splitext(logical)
+    hashed = f"{root}.{digest}{ext}"
+    target = os.path.join(_dist_dir(app), hashed)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, 'wb') as f:
+        f.write(data)
+    with open(target + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli:
+        with open(target + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+    return hashed
+
+
+def build(app):
+    """Build every asset and the manifest. Returns the manifest."""
+    manifest = {}
+    for folder in SOURCE_DIRS:
+        for name in sorted(os.listdir(os.path.join(app.static_folder, folder))):
+            if name.endswith(('.css', '.js')):
+                logical = f"{folder}/{name}"
+                manifest[logical] = _write(app, logical, _read(app, logical))
+    for logical, sources in BUNDLES.items():
+        manifest[logical] = _write(app, logical, '\n'.join(_read(app, s) for s in sources))
+
+    # Remove builds from previous runs
+    keep = set(manifest.values())
+    for dirpath, _, filenames in os.walk(_dist_dir(app)):
+        for name in filenames:
+            rel = os.path.relpath(os.path.join(dirpath, name), _dist_dir(app)).replace(os.sep, '/')
+            base = re.sub(r'\.(gz|br)$', '', rel)
+            if base not in keep and rel != 'manifest.json':
+                os.remove(os.path.join(dirpath, name))
+
+    with open(os.path.join(_dist_dir(app), 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    _manifest.clear()
+    _manifest.update(manifest)
+    return manifest
+
+
+def load_manifest(app):
+    _manifest.clear()
+    path = os.path.join(_dist_dir(app), 'manifest.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            _manifest.update(json.load(f))
+
+
+def asset_url(path):
+    """URL of the fingerprinted build of `path`, or the plain static file."""
+    if path in _manifest:
+        return url_for('serve_asset', filename=_manifest[path])
+    return url_for('static', filename=path)
+
+
+def asset_urls(path):
+    """Like asset_url, but expands a bundle into its sources when not built."""
+    if path in _manifest or path not in BUNDLES:
+        return [asset_url(path)]
+    return [url_for('static', filename=s) for s in BUNDLES[path]]
+
+
+def serve(app, filename):
+    """Send a built asset, preferring a pre-compressed variant."""
+    directory = _dist_dir(app)
+    if safe_join(directory, filename) is None:
+        abort(404)
+    accepted = request.headers.get('Accept-Encoding', '')
+    response = None
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in accepted and os.path.exists(os.path.join(directory, filename + suffix)):
+            response = send_from_directory(directory, filename + suffix, max_age=ONE_YEAR)
+            response.headers['Content-Encoding'] = encoding
+            response.mimetype = 'text/css' if filename.endswith('.css') else 'application/javascript'
+            break
+    if response is None:
+        response = send_from_directory(directory, filename, max_age=ONE_YEAR)
+    response.headers['Cache-Control'] = f'public, max-age={ONE_YEAR}, immutable'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def init_app(app):
+    load_manifest(app)
+    app.jinja_env.globals.update(asset_url=asset_url, asset_urls=asset_urls)
@@ -0,0 +1,327 @@
+"""Write-behind audit journal of every mutation made through the ORM.
+
+A session listener turns each flushed insert/update/delete into a compact
+event (actor, entity, id, action, field diff). Events wait in session.info
+until the transaction commits, then go to an in-process buffer; a flusher
+thread writes the buffer to AuditLog in one multi-row INSERT every
+AUDIT_BATCH_SIZE events or AUDIT_FLUSH_MS milliseconds, whichever comes
+first, so request handlers never wait on the journal.
+
+If a batch cannot be written it is appended (fsynced) to a spill file of
+the process, instance/audit_spill.<pid>.jsonl, and replayed by its next
+successful flush. Each process only writes and replays its own file, so
+gunicorn workers never replay the same rows; the file of a process that
+stopped (untouched for AUDIT_SPILL_ORPHAN_SECONDS) is adopted by the next
+flush of another one, which claims it with an atomic rename. Bulk
+query.update() / query.delete() calls bypass the ORM unit of work; callers
+that matter note them with record().
+"""
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, date
+from decimal import Decimal
+
+from flask import has_request_context, session as flask_session
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from models import db, AuditEvent, Job, LoanArchive, BookNeighbour
+
+# Internal bookkeeping tables, not user-facing data
+SKIP_MODELS = (AuditEvent, Job, LoanArchive, BookNeighbour)
+# Derived search keys follow their source column and add only noise
+SKIP_COLUMNS = {'name_key', 'surname_key', 'title_key', 'isbn13'}
+SECRET_COLUMNS = {'password_hash'}
+
+SPILL_PREFIX = 'audit_spill'
+
+_buffer = deque()
+_lock = threading.Lock()
+# Serialises this process's writes to and replays of its spill file
+_spill_lock = threading.Lock()
+_wakeup = threading.Event()
+_flusher = []
+_config = {}
+
+
+def _value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def _diff(obj, action):
+    # Read loaded values only: touching an expired attribute of a deleted
+    # row would emit a SELECT from inside the flush
+    state = inspect(obj)
+    changes = {}
+    for attr in state.mapper.column_attrs:
+        key = attr.key
+        if key in SKIP_COLUMNS:
+            continue
+        if action == 'update':
+            history = state.attrs[key].history
+            if not history.has_changes():
+                continue
+            old = history.deleted[0] if history.deleted else None
+            new = history.added[0] if history.added else None
+            if old == new:
+                continue
+        elif action == 'create':
+            old, new = None, state.dict.get(key)
+        else:
+            old, new = state.dict.get(key), None
+        if key in SECRET_COLUMNS:
+            old, new = old and '***', new and '***'
+        changes[key] = [_value(old), _value(new)]
+    return changes
+
+
+def _actor():
+    if has_request_context():
+        return flask_session.get('user_id')
+    return None
+
+
+@event.listens_for(Session, 'after_flush')
+def _capture(session, flush_context):
+    # History and the new/dirty/deleted sets still describe this flush here
+    now = datetime.utcnow()
+    actor = _actor()
+    pending = session.info.setdefault('audit_pending', [])
+    for action, objects in (('create', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for obj in objects:
+            if isinstance(obj, SKIP_MODELS):
+                continue
+            changes = _diff(obj, action)
+            if action == 'update' and not changes:
+                continue
+            pending.append({
+                'at': now,
+                'actor_id': actor,
+                'entity': obj.__table__.name,
+                'entity_id': inspect(obj).dict.get('id'),
+                'action': action,
+                'changes': json.dumps(changes, ensure_ascii=False)
+            })
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish(session):
+    if session.in_nested_transaction():
+        return
+    events = session.info.pop('audit_pending', None)
+    if events:
+        record_many(events)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard(session):
+    session.info.pop('audit_pending', None)
+
+
+def record(entity, entity_id, action, changes=None):
+    """Journal a change the session listener cannot see (bulk statements).
+    Published with the current transaction."""
+    db.session.info.setdefault('audit_pending', []).append({
+        'at': datetime.utcnow(),
+        'actor_id': _actor(),
+        'entity': entity,
+        'entity_id': entity_id,
+        'action': action,
+        'changes': json.dumps(changes or {}, ensure_ascii=False)
+    })
+
+
+def record_many(events):
+    with _lock:
+        _buffer.extend(events)
+        full = len(_buffer) >= _config.get('batch_size', 100)
+    if full:
+        _wakeup.set()
+    if not _flusher and 'engine' in _config:
+        # No background thread (CLI, scripts): write through
+        flush()
+
+
+def _spill_path(pid=None):
+    directory = _config.get('spill_dir')
+    if not directory:
+        return None
+    return os.path.join(directory, f"{SPILL_PREFIX}.{pid or os.getpid()}.jsonl")
+
+
+def _append(path, rows):
+    with open(path, 'a', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps(dict(row, at=row['at'].isoformat()), ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_spill(path):
+    rows = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                # Torn last line after a crash mid-write
+                continue
+            row['at'] = datetime.fromisoformat(row['at'])
+            rows.append(row)
+    return rows
+
+
+def _claim(path, suffix):
+    """Rename a spill file to a name private to this process. Only one
+    process can win the rename. Returns the new path, or None."""
+    claimed = f"{path}.{os.getpid()}.{suffix}"
+    try:
+        os.rename(path, claimed)
+    except FileNotFoundError:
+        return None
+    return claimed
+
+
+def _adopt_orphans():
+    """Move the rows of spill files left by stopped processes into ours.
+    Runs under _spill_lock."""
+    now = time.time()
+    if now - _config.get('adopted_at', 0) < 60:
+        return
+    _config['adopted_at'] = now
+    own = _spill_path()
+    # Also claimed files of processes that died mid-flush, and the
+    # unnumbered shared file of earlier versions
+    paths = [path for pattern in ('*.jsonl', '*.replay', '*.adopted')
+             for path in glob.glob(os.path.join(_config['spill_dir'], SPILL_PREFIX + pattern))]
+    for path in paths:
+        if path == own:
+            continue
+        try:
+            if now - os.path.getmtime(path) < _config['orphan_seconds']:
+                continue
+        except OSError:
+            continue
+        claimed = _claim(path, 'adopted')
+        if claimed:
+            _append(own, _read_spill(claimed))
+            os.remove(claimed)
+
+
+def flush():
+    """Write buffered events, and any spilled ones, to AuditLog. Returns the
+    number of rows written."""
+    engine = _config.get('engine')
+    if engine is None:
+        # Not initialised yet; events stay buffered
+        return 0
+    with _lock:
+        batch = list(_buffer)
+        _buffer.clear()
+    with _spill_lock:
+        _adopt_orphans()
+        path = _spill_path()
+        claimed = _claim(path, 'replay')
+        spilled = _read_spill(claimed) if claimed else []
+        rows = spilled + batch
+        if not rows:
+            return 0
+        try:
+            with engine.begin() as conn:
+                conn.execute(AuditEvent.__table__.insert(), rows)
+        except Exception:
+            # Spilled rows are already on disk; only the new batch is added
+            # before the file goes back under its name
+            if batch:
+                _append(claimed or path, batch)
+            if claimed:
+                os.replace(claimed, path)
+            raise
+        if claimed:
+            os.remove(claimed)
+    return len(rows)
+
+
+def _flusher_loop(app):
+    interval = app.config['AUDIT_FLUSH_MS'] / 1000.0
+    while True:
+        _wakeup.wait(interval)
+        _wakeup.clear()
+        try:
+            flush()
+        except Exception as e:
+            app.logger.error(f"Audit flush failed, batch spilled to disk: {e}")
+
+
+def start_flusher(app):
+    """Start the flusher thread once per process."""
+    if _flusher:
+        return
+    t = threading.Thread(target=_flusher_loop, args=(app,), name='audit-flusher', daemon=True)
+    t.start()
+    _flusher.append(t)
+
+
+def _flush_quietly():
+    try:
+        flush()
+    except Exception:
+        pass
+
+
+def init_app(app):
+    app.config.setdefault('AUDIT_BATCH_SIZE', 100)
+    app.config.setdefault('AUDIT_FLUSH_MS', 500)
+    app.config.setdefault('AUDIT_SPILL_ORPHAN_SECONDS', 300)
+    _config['batch_size'] = app.config['AUDIT_BATCH_SIZE']
+    _config['spill_dir'] = app.instance_path
+    _config['orphan_seconds'] = app.config['AUDIT_SPILL_ORPHAN_SECONDS']
+    with app.app_context():
+        _config['engine'] = db.engine
+    # The startup commits (seeding) were buffered before the engine was
+    # known. Write them here: a preloading gunicorn master would otherwise
+    # hand the buffer to every worker it forks, and each would write a copy
+    _flush_quietly()
+    atexit.register(_flush_quietly)
+    if app.config['JOBS_AUTOSTART']:
+        start_flusher(app)
+
+
+def serialize(event):
+    return {
+        'id': event.id,
+        'at': event.at.strftime('%Y-%m-%d %H:%M:%S'),
+        'actor_id': event.actor_id,
+        'entity': event.entity,
+        'entity_id': event.entity_id,
+        'action': event.action,
+        'changes': json.loads(event.changes) if event.changes else {}
+    }
+
+
+def query_events(entity=None, entity_id=None, since=None, until=None, page=1, per_page=50):
+    """One page of events, newest first, filtered on the indexed columns."""
+    query = AuditEvent.query
+    if entity:
+        query = query.filter(AuditEvent.entity == entity)
+        if entity_id is not None:
+            query = query.filter(AuditEvent.entity_id == entity_id)
+    if since:
+        query = query.filter(AuditEvent.at >= since)
+    if until:
+        query = query.filter(AuditEvent.at < until)
+    total = query.count()
+    rows = (query.order_by(AuditEvent.at.desc(), AuditEvent.id.desc())
+            .offset((page - 1) * per_page).limit(per_page).all())
+    return rows, total
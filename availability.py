@@ -0,0 +1,137 @@
+"""Predicted next-free dates for books with no copy on the shelf.
+
+Keeps, per book, a min-heap of the due dates of its open loans. The loan
+handlers update it as loans are added, returned, edited or deleted; stale
+heap entries are dropped lazily when read. Each process holds its own copy,
+built with a single query at first use and rebuilt in a background thread
+once it is REFRESH_SECONDS old, so changes made by other workers show up
+within that delay. Only one rebuild runs at a time, and changes made while
+it reads are replayed onto its result before the swap.
+"""
+import heapq
+import threading
+import time
+from datetime import date
+
+from flask import current_app
+from models import db, Loan
+
+REFRESH_SECONDS = 60
+
+_lock = threading.Lock()
+_build_lock = threading.Lock()   # single rebuild at a time
+_heaps = {}      # book_id -> [(due_date, loan_id), ...]
+_open = {}       # loan_id -> (book_id, due_date), the live entries
+_journal = None  # changes made during a rebuild, replayed before its swap
+_built_at = None
+
+
+def _apply(heaps, live, loan_id, book_id=None, due_date=None):
+    if book_id is None:
+        live.pop(loan_id, None)
+    else:
+        live[loan_id] = (book_id, due_date)
+        heapq.heappush(heaps.setdefault(book_id, []), (due_date, loan_id))
+
+
+def _rebuild():
+    global _journal, _built_at
+    with _lock:
+        _journal = []
+    try:
+        # Shared by every branch served by this process
+        rows = (db.session.query(Loan.id, Loan.book_id, Loan.due_date)
+                .filter(Loan.status != 'Terminé')
+                .execution_options(all_branches=True)
+                .all())
+    except Exception:
+        with _lock:
+            _journal = None
+        raise
+    heaps, live = {}, {}
+    for loan_id, book_id, due_date in rows:
+        heaps.setdefault(book_id, []).append((due_date, loan_id))
+        live[loan_id] = (book_id, due_date)
+    for heap in heaps.values():
+        heapq.heapify(heap)
+    with _lock:
+        for change in _journal:
+            _apply(heaps, live, *change)
+        _journal = None
+        _heaps.clear()
+        _heaps.update(heaps)
+        _open.clear()
+        _open.update(live)
+        _built_at = time.monotonic()
+    return len(rows)
+
+
+def rebuild():
+    """Reload every open loan. Returns the number of loans indexed."""
+    with _build_lock:
+        return _rebuild()
+
+
+def _refresh(app):
+    try:
+        with app.app_context():
+            _rebuild()
+    except Exception as e:
+        app.logger.warning(f"Availability refresh failed: {e}")
+    finally:
+        _build_lock.release()
+
+
+def _ensure_fresh():
+    if _built_at is None:
+        # Nothing to answer with yet: the first build is synchronous
+        with _build_lock:
+            if _built_at is None:
+                _rebuild()
+    elif time.monotonic() - _built_at > REFRESH_SECONDS and _build_lock.acquire(blocking=False):
+        # Released by the thread; requests keep reading the current index
+        threading.Thread(target=_refresh, args=(current_app._get_current_object(),),
+                         name='availability-refresh', daemon=True).start()
+
+
+def _change(loan_id, book_id=None, due_date=None):
+    with _lock:
+        _apply(_heaps, _open, loan_id, book_id, due_date)
+        if _journal is not None:
+            _journal.append((loan_id, book_id, due_date))
+
+
+def add(loan_id, book_id, due_date):
+    _change(loan_id, book_id, due_date)
+
+
+def remove(loan_id):
+    _change(loan_id)
+
+
+def update(loan_id, book_id, due_date):
+    # The old heap entry no longer matches _open and is skipped on read
+    add(loan_id, book_id, due_date)
+
+
+def next_free(book_id, position=1):
+    """Date the position-th copy of the book is due back, or None if fewer
+    copies are out. Overdue copies count as due today."""
+    _ensure_fresh()
+    with _lock:
+        heap = _heaps.get(book_id)
+        if not heap:
+            return None
+        # Drop stale entries sitting at the top
+        while heap and _open.get(heap[0][1]) != (book_id, heap[0][0]):
+            heapq.heappop(heap)
+        if position == 1:
+            due = heap[0][0] if heap else None
+        else:
+            # A loan re-added with the same date has two identical entries
+            live = sorted({entry for entry in heap
+                           if _open.get(entry[1]) == (book_id, entry[0])})
+            due = live[position - 1][0] if len(live) >= position else None
+    if due is None:
+        return None
+    return max(due, date.today())
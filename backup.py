@@ -0,0 +1,285 @@
+"""Online backups of the library database and restore from them.
+
+`flask backup` writes a gzip-compressed copy of the database to BACKUP_DIR
+(instance/backups by default) with a sha256sum-style checksum file beside
+it, then deletes all but the newest BACKUP_KEEP backups.
+
+SQLite   the copy goes through SQLite's online backup API in steps of
+         BACKUP_PAGES_PER_STEP pages, pausing BACKUP_STEP_SLEEP seconds in
+         between, so writers only wait for the step in progress. A write
+         from another connection restarts the copy at the next step; after
+         BACKUP_MAX_RESTARTS restarts the copy is taken instead with
+         VACUUM INTO, in one read transaction that writers do not disturb.
+         The copy is checked with PRAGMA quick_check before it is kept.
+MySQL    mysqldump --single-transaction reads one consistent snapshot
+         without locking the InnoDB tables.
+
+`flask restore` puts a backup back: the one given, or the newest taken at
+or before --at, labelled ones (the 'avant-restauration' safety copies)
+excepted. The checksum is verified first and the current database
+is backed up ('avant-restauration') before it is overwritten. On SQLite
+the pages are copied into the live file through the same backup API, so
+the server may keep running, but restart it afterwards: its in-memory
+caches still hold the old data.
+
+With BACKUP_INTERVAL_HOURS set, a 'backup' job runs in the job workers
+and queues the next one as it starts.
+"""
+import glob
+import gzip
+import hashlib
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+from datetime import datetime
+
+from flask import current_app
+from models import db, Job
+import jobs
+
+PREFIX = 'biblionest-'
+STAMP = '%Y%m%d-%H%M%S'
+
+
+class TooManyRestarts(Exception):
+    pass
+
+
+def backup_dir(app=None):
+    app = app or current_app
+    path = app.config['BACKUP_DIR'] or os.path.join(app.instance_path, 'backups')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_checksum(path):
+    with open(path + '.sha256', 'w', encoding='ascii') as f:
+        f.write(f"{_checksum(path)}  {os.path.basename(path)}\n")
+
+
+def verify(path):
+    """Raise ValueError unless the backup matches its checksum file."""
+    try:
+        with open(path + '.sha256', encoding='ascii') as f:
+            expected = f.read().split()[0]
+    except (OSError, IndexError):
+        raise ValueError(f"Somme de contrôle absente pour {os.path.basename(path)}")
+    if _checksum(path) != expected:
+        raise ValueError(f"{os.path.basename(path)} est corrompu (somme de contrôle différente)")
+
+
+def _sqlite_path():
+    return db.engine.url.database
+
+
+def _copy_pages(source, target, config, max_restarts=None):
+    """Online copy in steps. Raises TooManyRestarts once writes to the
+    source restarted it more than max_restarts times."""
+    state = {'remaining': None, 'total': None, 'restarts': 0}
+
+    def progress(status, remaining, total):
+        # The remaining count goes back up when a write restarts the copy
+        if state['remaining'] is not None and remaining > state['remaining']:
+            state['restarts'] += 1
+            if max_restarts is not None and state['restarts'] > max_restarts:
+                raise TooManyRestarts(
+                    f"{state['restarts']} redémarrages, {state['total'] - state['remaining']}"
+                    f"/{state['total']} pages copiées")
+        state['remaining'], state['total'] = remaining, total
+
+    source.backup(target, pages=config['BACKUP_PAGES_PER_STEP'], progress=progress,
+                  sleep=config['BACKUP_STEP_SLEEP'])
+
+
+def _backup_sqlite(stem, config):
+    path = stem + '.db.gz'
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(stem)) as tmp:
+        copy_path = os.path.join(tmp, 'copy.db')
+        source = sqlite3.connect(_sqlite_path(), timeout=30)
+        target = sqlite3.connect(copy_path)
+        try:
+            try:
+                _copy_pages(source, target, config, config['BACKUP_MAX_RESTARTS'])
+            except TooManyRestarts as e:
+                current_app.logger.warning("Copie par étapes abandonnée (%s), passage à VACUUM INTO", e)
+                target.close()
+                os.remove(copy_path)
+                source.execute('VACUUM INTO ?', (copy_path,))
+                target = sqlite3.connect(copy_path)
+            result = target.execute('PRAGMA quick_check').fetchone()[0]
+        finally:
+            target.close()
+            source.close()
+        if result != 'ok':
+            raise RuntimeError(f"Copie incohérente : {result}")
+        with open(copy_path, 'rb') as src, gzip.open(path + '.tmp', 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def _mysql_args(url):
+    args = ['--host', url.host or 'localhost', '--user', url.username or '']
+    if url.port:
+        args += ['--port', str(url.port)]
+    # The password goes through the environment, not the process list
+    env = dict(os.environ, MYSQL_PWD=url.password or '')
+    return args, env
+
+
+def _backup_mysql(stem):
+    path = stem + '.sql.gz'
+    url = db.engine.url
+    args, env = _mysql_args(url)
+    dump = subprocess.Popen(
+        ['mysqldump', '--single-transaction', '--quick', '--routines', '--triggers', '--no-tablespaces',
+         *args, url.database],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    with gzip.open(path + '.tmp', 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(dump.stdout, dst, 1024 * 1024)
+    if dump.wait() != 0:
+        os.remove(path + '.tmp')
+        raise RuntimeError(f"mysqldump a échoué : {dump.stderr.read().decode(errors='replace').strip()}")
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def _dialect():
+    return db.engine.dialect.name
+
+
+def create(label=None, rotate_old=True):
+    """Write a backup, rotate old ones. Returns its path."""
+    config = current_app.config
+    name = PREFIX + datetime.now().strftime(STAMP) + (f'-{label}' if label else '')
+    stem = os.path.join(backup_dir(), name)
+    if _dialect() == 'sqlite':
+        path = _backup_sqlite(stem, config)
+    elif _dialect() == 'mysql':
+        path = _backup_mysql(stem)
+    else:
+        raise RuntimeError(f"Sauvegarde non prise en charge pour {_dialect()}")
+    _write_checksum(path)
+    if rotate_old:
+        rotate(config['BACKUP_KEEP'])
+    return path
+
+
+def list_backups(labelled=True):
+    """(taken_at, path) of the backups in BACKUP_DIR, oldest first; without
+    the labelled ones (biblionest-<stamp>-<label>) if labelled=False."""
+    result = []
+    for path in glob.glob(os.path.join(backup_dir(), PREFIX + '*.gz')):
+        name = os.path.basename(path)
+        stamp = name[len(PREFIX):len(PREFIX) + 15]
+        if not labelled and name[len(PREFIX) + 15:].startswith('-'):
+            continue
+        try:
+            result.append((datetime.strptime(stamp, STAMP), path))
+        except ValueError:
+            continue
+    return sorted(result)
+
+
+def rotate(keep):
+    """Delete all but the newest `keep` backups. Returns how many went."""
+    old = list_backups()[:-keep] if keep else []
+    for _, path in old:
+        for victim in (path, path + '.sha256'):
+            try:
+                os.remove(victim)
+            except FileNotFoundError:
+                pass
+    return len(old)
+
+
+def pick(at=None):
+    """The newest backup taken at or before `at` (default: the newest). The
+    safety copies of earlier restores are skipped: picking one would undo
+    that restore. They can still be given by path."""
+    candidates = [path for taken_at, path in list_backups(labelled=False) if at is None or taken_at <= at]
+    if not candidates:
+        raise ValueError("Aucune sauvegarde ne correspond")
+    return candidates[-1]
+
+
+def _restore_sqlite(path, config):
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(_sqlite_path())) as tmp:
+        copy_path = os.path.join(tmp, 'restore.db')
+        with gzip.open(path, 'rb') as src, open(copy_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        source = sqlite3.connect(copy_path)
+        try:
+            result = source.execute('PRAGMA quick_check').fetchone()[0]
+            if result != 'ok':
+                raise ValueError(f"Sauvegarde incohérente : {result}")
+            target = sqlite3.connect(_sqlite_path(), timeout=30)
+            try:
+                _copy_pages(source, target, config)
+            finally:
+                target.close()
+        finally:
+            source.close()
+
+
+def _restore_mysql(path):
+    url = db.engine.url
+    args, env = _mysql_args(url)
+    load = subprocess.Popen(['mysql', *args, url.database], stdin=subprocess.PIPE,
+                            stderr=subprocess.PIPE, env=env)
+    with gzip.open(path, 'rb') as src:
+        shutil.copyfileobj(src, load.stdin, 1024 * 1024)
+    load.stdin.close()
+    if load.wait() != 0:
+        raise RuntimeError(f"mysql a échoué : {load.stderr.read().decode(errors='replace').strip()}")
+
+
+def restore(path):
+    """Replace the database with a backup. Returns the path of the safety
+    backup taken first."""
+    verify(path)
+    if not path.endswith('.db.gz' if _dialect() == 'sqlite' else '.sql.gz'):
+        raise ValueError(f"{os.path.basename(path)} n'est pas une sauvegarde {_dialect()}")
+    # Nothing of this process may hold the database while it is replaced
+    db.session.remove()
+    # Not rotated here: that could delete the backup being restored
+    safety = create('avant-restauration', rotate_old=False)
+    db.engine.dispose()
+    if _dialect() == 'sqlite':
+        _restore_sqlite(path, current_app.config)
+    else:
+        _restore_mysql(path)
+    db.engine.dispose()
+    return safety
+
+
+def schedule(delay=0, running_id=None):
+    """Queue the next scheduled backup unless one is already waiting."""
+    pending = Job.query.filter(Job.kind == 'backup', Job.status.in_(('En attente', 'En cours')))
+    if running_id:
+        pending = pending.filter(Job.id != running_id)
+    if pending.first():
+        return None
+    return jobs.enqueue('backup', {'scheduled': True}, delay=delay)
+
+
+def init_app(app):
+    app.config.setdefault('BACKUP_DIR', None)
+    app.config.setdefault('BACKUP_KEEP', 14)
+    app.config.setdefault('BACKUP_PAGES_PER_STEP', 256)
+    app.config.setdefault('BACKUP_STEP_SLEEP', 0.05)
+    app.config.setdefault('BACKUP_MAX_RESTARTS', 5)
+    app.config.setdefault('BACKUP_INTERVAL_HOURS', 0)
+    if app.config['BACKUP_INTERVAL_HOURS']:
+        with app.app_context():
+            schedule()
@@ -0,0 +1,155 @@
+"""Library branches sharing one deployment.
+
+Books, copies, readers, loans, reservations, penalties and archived loans
+carry a branch_id. The branch being worked on lives in flask.g: set per request from
+the admin's session, or with use() in jobs. A session listener adds
+`branch_id = <current>` to every ORM SELECT touching those tables and new
+rows are stamped with it, so handlers query as if there were one library and
+each query is served by the branch-led composite indexes. Queries that must
+see every branch (in-process caches, transfers) run with
+execution_options(all_branches=True); with no branch set (startup, CLI,
+global jobs) nothing is filtered.
+"""
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session, with_loader_criteria
+from models import db, Branch, Setting, Book, Copy, Reader, Loan, Reservation, Penalty, LoanArchive
+import audit
+import copies
+
+MAIN_BRANCH_ID = 1
+SCOPED_MODELS = (Book, Copy, Reader, Loan, Reservation, Penalty, LoanArchive)
+
+
+def current_id():
+    """The branch queries are scoped to, or None."""
+    if has_app_context():
+        return g.get('branch_id')
+    return None
+
+
+@contextmanager
+def use(branch_id):
+    """Scope the queries of a job or command to one branch."""
+    previous = g.get('branch_id')
+    g.branch_id = branch_id
+    try:
+        yield
+    finally:
+        g.branch_id = previous
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _scope_to_branch(state):
+    branch_id = current_id()
+    if (branch_id is None or not state.is_select or state.is_relationship_load
+            or state.is_column_load or state.execution_options.get('all_branches', False)):
+        return
+    # Relationship and refresh loads are left alone: a loan's book or a row
+    # just moved to another branch must still load
+    state.statement = state.statement.options(*(
+        with_loader_criteria(model, lambda cls: cls.branch_id == branch_id,
+                             include_aliases=True, propagate_to_loaders=False)
+        for model in SCOPED_MODELS
+    ))
+
+
+@event.listens_for(Session, 'before_flush')
+def _stamp_branch(session, flush_context, instances):
+    for obj in session.new:
+        if isinstance(obj, SCOPED_MODELS) and obj.branch_id is None:
+            obj.branch_id = current_id() or MAIN_BRANCH_ID
+
+
+def settings(branch_id=None):
+    """Settings of the given (default: current) branch, falling back to the
+    main branch's row."""
+    branch_id = branch_id or current_id() or MAIN_BRANCH_ID
+    return Setting.query.filter_by(branch_id=branch_id).first() or db.session.get(Setting, 1)
+
+
+def backfill():
+    """Create the main branch that existing rows default to, and attach the
+    original settings row to it."""
+    if not db.session.get(Branch, MAIN_BRANCH_ID):
+        db.session.add(Branch(id=MAIN_BRANCH_ID, name='Principale', code='MAIN'))
+        db.session.flush()
+    Setting.query.filter(Setting.id == 1, Setting.branch_id == None).update(
+        {Setting.branch_id: MAIN_BRANCH_ID}, synchronize_session=False)
+    db.session.commit()
+
+
+def create_branch(name, code, address=None):
+    """Add a branch whose settings start as a copy of the main branch's.
+    The caller commits."""
+    branch = Branch(name=name, code=code, address=address)
+    db.session.add(branch)
+    db.session.flush()
+    main = settings(MAIN_BRANCH_ID)
+    copied = {c.key: getattr(main, c.key) for c in Setting.__table__.columns
+              if c.key not in ('id', 'branch_id')} if main else {}
+    # Settings ids are assigned by hand (no AUTO_INCREMENT in database.sql)
+    next_id = (db.session.query(func.max(Setting.id)).scalar() or 0) + 1
+    db.session.add(Setting(id=next_id, branch_id=branch.id, **copied))
+    return branch
+
+
+def _move(book_id, count, condition=None):
+    query = Book.query.filter(Book.id == book_id)
+    if condition is not None:
+        query = query.filter(condition)
+    return query.update({
+        Book.total_copies: Book.total_copies + count,
+        Book.available_copies: Book.available_copies + count,
+        Book.version: Book.version + 1
+    }, synchronize_session=False)
+
+
+def transfer_copies(book, target_branch_id, count):
+    """Move `count` shelf copies of a book to another branch, adding the title
+    there (matched by ISBN, else by title and author) if it has no record of
+    it yet. Returns the target book. The caller commits."""
+    # Conditional decrement: copies on loan cannot leave
+    if _move(book.id, -count, Book.available_copies >= count) != 1:
+        raise ValueError("Pas assez d'exemplaires disponibles pour ce transfert")
+    # A soft-deleted record there still holds the ISBN: it comes back
+    candidates = Book.query.execution_options(all_branches=True, include_deleted=True) \
+        .filter(Book.branch_id == target_branch_id)
+    if book.isbn13:
+        target = candidates.filter(Book.isbn13 == book.isbn13).first()
+    else:
+        target = candidates.filter(Book.title_key == book.title_key, Book.author_id == book.author_id) \
+            .order_by(Book.deleted_at.isnot(None)).first()
+    if target:
+        if target.deleted_at:
+            # Flushed before _move bumps the version behind the ORM's back
+            target.deleted_at = None
+            db.session.flush()
+        _move(target.id, count)
+    else:
+        target = Book(
+            branch_id=target_branch_id,
+            title=book.title,
+            title_key=book.title_key,
+            author_id=book.author_id,
+            category_id=book.category_id,
+            isbn=book.isbn,
+            isbn13=book.isbn13,
+            publication_year=book.publication_year,
+            price=book.price,
+            total_copies=count,
+            available_copies=count,
+            image_path=book.image_path
+        )
+        db.session.add(target)
+        db.session.flush()
+    # The physical items follow, barcodes unchanged
+    copies.move(book, target, count)
+    audit.record('Books', book.id, 'transfer', {
+        'branch_id': [book.branch_id, target_branch_id],
+        'copies': count,
+        'target_id': target.id
+    })
+    return target
@@ -0,0 +1,303 @@
+"""Read-through cache for rarely changing query results and JSON views.
+
+@cached(...) wraps a function returning JSON-serializable data, and
+@cached_view(...) a Flask view (only 200 responses are kept). Both list the
+tables the result is read from. Entries live in a bounded LRU with a TTL and
+are keyed per branch. When a transaction commits, the tables it wrote
+(flushed objects and ORM bulk statements) are collected by session
+listeners and every entry tagged with one of them is evicted.
+
+Raw SQL writes are not seen; call invalidate() after them. Each process
+keeps its own LRU, so a commit in one gunicorn worker only evicts there:
+the other workers catch up within the TTL (CACHE_DEFAULT_TTL). With
+BIBLIONEST_CACHE_REDIS_URL set and the redis package installed, entries
+and tags live in Redis instead and evictions reach every worker at once.
+"""
+import functools
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request, Response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+import branches
+
+try:
+    import redis
+except ImportError:  # the shared backend is optional
+    redis = None
+
+_MISSING = object()
+_config = {}
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+class LocalStore:
+    """Thread-safe LRU of (expires_at, value, tags), with a tag index."""
+
+    name = 'local'
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._tags = {}
+        # Bumped on every eviction of a tag; a value computed while its tag
+        # was evicted is not stored
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _drop(self, key):
+        _, _, tags = self._data.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys:
+                keys.discard(key)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return _MISSING
+            if entry[0] is not None and entry[0] < time.monotonic():
+                self._drop(key)
+                return _MISSING
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def _generations_of(self, tags):
+        return tuple(self._generations.get(tag, 0) for tag in tags)
+
+    def generations(self, tags):
+        with self._lock:
+            return self._generations_of(tags)
+
+    def set(self, key, value, tags, ttl, generations):
+        with self._lock:
+            if self._generations_of(tags) != generations:
+                return False
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (time.monotonic() + ttl if ttl else None, value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._drop(next(iter(self._data)))
+            return True
+
+    def invalidate(self, tags):
+        with self._lock:
+            evicted = 0
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+                for key in list(self._tags.pop(tag, ())):
+                    if key in self._data:
+                        self._drop(key)
+                        evicted += 1
+            return evicted
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+
+
+class RedisStore:
+    """Entries as JSON strings with a Redis expiry, one set of keys per tag.
+    Size is bounded by the server's maxmemory policy."""
+
+    name = 'redis'
+    prefix = 'biblionest:cache:'
+
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url)
+
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(self.prefix + 'entry:*'))
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + 'entry:' + key)
+        return _MISSING if raw is None else json.loads(raw)
+
+    def generations(self, tags):
+        if not tags:
+            return ()
+        return tuple(int(g or 0) for g in self.client.mget([self.prefix + 'gen:' + t for t in tags]))
+
+    def set(self, key, value, tags, ttl, generations):
+        if self.generations(tags) != generations:
+            return False
+        pipe = self.client.pipeline()
+        pipe.set(self.prefix + 'entry:' + key, json.dumps(value), ex=ttl or None)
+        for tag in tags:
+            pipe.sadd(self.prefix + 'tag:' + tag, key)
+        pipe.execute()
+        return True
+
+    def invalidate(self, tags):
+        evicted = 0
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            keys = [self.prefix + 'entry:' + k.decode() for k in self.client.smembers(tag_key)]
+            pipe = self.client.pipeline()
+            pipe.incr(self.prefix + 'gen:' + tag)
+            if keys:
+                pipe.delete(*keys)
+            pipe.delete(tag_key)
+            evicted += pipe.execute()[1] if keys else 0
+        return evicted
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+def _store():
+    store = _config.get('store')
+    if store is None:
+        # Not initialised (scripts importing app pieces): a small local LRU
+        store = _config['store'] = LocalStore(256)
+    return store
+
+
+def _count(name, outcome):
+    with _stats_lock:
+        counters = _stats.setdefault(name, {'hits': 0, 'misses': 0})
+        counters[outcome] += 1
+
+
+def _read_through(name, key, tags, ttl, compute):
+    store = _store()
+    value = store.get(key)
+    if value is not _MISSING:
+        _count(name, 'hits')
+        return value
+    _count(name, 'misses')
+    generations = store.generations(tags)
+    value = compute()
+    if value is not _MISSING:
+        store.set(key, value, tags, _config.get('default_ttl', 30) if ttl is None else ttl, generations)
+    return value
+
+
+def cached(*tables, ttl=None):
+    """Cache a function's JSON-serializable result per arguments and branch,
+    until one of `tables` is written or `ttl` seconds pass (None: the
+    default TTL, 0: no expiry)."""
+    tags = tuple(tables)
+
+    def decorator(func):
+        name = func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = json.dumps([name, branches.current_id(), args, sorted(kwargs.items())], default=str)
+            return _read_through(name, key, tags, ttl, lambda: func(*args, **kwargs))
+        wrapper.uncached = func
+        return wrapper
+    return decorator
+
+
+def cached_view(*tables, ttl=None):
+    """Like cached(), for a Flask view: keyed on the path and query string,
+    only successful responses are kept."""
+    tags = tuple(tables)
+
+    def decorator(view):
+        name = view.__name__
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            def compute():
+                response = view(*args, **kwargs)
+                if not isinstance(response, Response) or response.status_code != 200:
+                    compute.passthrough = response
+                    return _MISSING
+                return {'body': response.get_data(as_text=True), 'mimetype': response.mimetype}
+            compute.passthrough = None
+            key = json.dumps([name, branches.current_id(), request.full_path])
+            entry = _read_through(name, key, tags, ttl, compute)
+            if entry is _MISSING:
+                return compute.passthrough
+            return Response(entry['body'], mimetype=entry['mimetype'])
+        return wrapper
+    return decorator
+
+
+def invalidate(*tables):
+    """Evict every entry read from the given tables. Returns the count."""
+    evicted = _store().invalidate(tables)
+    with _stats_lock:
+        _config['evicted'] = _config.get('evicted', 0) + evicted
+    return evicted
+
+
+@event.listens_for(Session, 'after_flush')
+def _note_flush(session, flush_context):
+    tables = session.info.setdefault('cache_tables', set())
+    for objects in (session.new, session.dirty, session.deleted):
+        for obj in objects:
+            tables.add(obj.__table__.name)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _note_bulk(state):
+    # query.update(), query.delete() and Core inserts never reach the flush
+    if state.is_update or state.is_delete or state.is_insert:
+        table = getattr(state.statement, 'table', None)
+        if table is not None:
+            state.session.info.setdefault('cache_tables', set()).add(table.name)
+
+
+@event.listens_for(Session, 'after_commit')
+def _evict(session):
+    if session.in_nested_transaction():
+        return
+    tables = session.info.pop('cache_tables', None)
+    if tables:
+        invalidate(*tables)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget(session):
+    session.info.pop('cache_tables', None)
+
+
+def stats():
+    """Hit/miss counters per cached function since the process started."""
+    with _stats_lock:
+        functions = {name: dict(c, hit_rate=round(c['hits'] / (c['hits'] + c['misses']), 3))
+                     for name, c in _stats.items()}
+        evicted = _config.get('evicted', 0)
+    hits = sum(c['hits'] for c in functions.values())
+    misses = sum(c['misses'] for c in functions.values())
+    store = _store()
+    return {
+        'backend': store.name,
+        'entries': len(store),
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+        'evicted': evicted,
+        'functions': functions
+    }
+
+
+def init_app(app):
+    app.config.setdefault('CACHE_MAX_ENTRIES', 1024)
+    app.config.setdefault('CACHE_DEFAULT_TTL', 30)
+    app.config.setdefault('CACHE_REDIS_URL', None)
+    _config['default_ttl'] = app.config['CACHE_DEFAULT_TTL']
+    url = app.config['CACHE_REDIS_URL']
+    if url and redis is None:
+        app.logger.warning("CACHE_REDIS_URL is set but the redis package is missing; using the local cache")
+    if url and redis is not None:
+        _config['store'] = RedisStore(url)
+    else:
+        _config['store'] = LocalStore(app.config['CACHE_MAX_ENTRIES'])
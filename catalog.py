@@ -0,0 +1,120 @@
+"""Faceted browsing of the catalog: category, author, decade, availability.
+
+browse() returns one page of the matching books and, for every facet, the
+number of books per value under the current filter. Counts are disjunctive:
+a facet's own selection is left out of its counts, so the other values
+show what picking them would add. All of them come from a single UNION ALL
+statement with one GROUP BY branch per facet, a scan of the covering index
+idx_books_branch_facets, instead of a COUNT per value. The total number of
+matches is read back from the availability counts. Counts are cached
+(cache.py) until the next write to Books, Authors or Categories.
+"""
+from sqlalchemy import select, union_all, literal, func, case, or_
+from models import db, Book, Author, Category
+from names import normalize
+import branches
+import cache
+
+FACETS = ('category', 'author', 'decade', 'available')
+# Authors listed in the facet, by number of books (the selected ones always are)
+AUTHOR_LIMIT = 30
+
+_DECADE = (Book.publication_year // 10) * 10
+_AVAILABLE = case((Book.available_copies > 0, 1), else_=0)
+_COLUMNS = {
+    'category': Book.category_id,
+    'author': Book.author_id,
+    'decade': _DECADE,
+    'available': _AVAILABLE,
+}
+
+
+def _search(q):
+    """Substring match on the title, the author or the ISBN, as the list
+    filter of the books page did."""
+    key = normalize(q)
+    if not key:
+        return []
+    authors = select(Author.id).where(Author.name_key.contains(key, autoescape=True))
+    return [or_(Book.title_key.contains(key, autoescape=True),
+                Book.isbn.contains(q.strip(), autoescape=True),
+                Book.author_id.in_(authors))]
+
+
+def _selections(filters):
+    """{facet: condition} for the facets with selected values."""
+    conditions = {}
+    if filters.get('category'):
+        conditions['category'] = Book.category_id.in_(filters['category'])
+    if filters.get('author'):
+        conditions['author'] = Book.author_id.in_(filters['author'])
+    if filters.get('decade'):
+        # Year ranges rather than the decade expression, so the index applies
+        conditions['decade'] = or_(*(Book.publication_year.between(d, d + 9) for d in filters['decade']))
+    if filters.get('available') is not None:
+        conditions['available'] = Book.available_copies > 0 if filters['available'] else Book.available_copies == 0
+    return conditions
+
+
+def _base(q):
+    # The session listeners would scope every SELECT of the UNION too;
+    # facet_counts() skips them and spells the branch and soft-delete
+    # filters out instead, so each SELECT reads as a plain prefix of
+    # idx_books_branch_facets
+    return [Book.branch_id == (branches.current_id() or branches.MAIN_BRANCH_ID),
+            Book.deleted_at == None, *_search(q)]
+
+
+@cache.cached('Books', 'Authors', 'Categories')
+def facet_counts(q, filters):
+    """{facet: [{'value', 'label', 'count', 'selected'}]} under the filter."""
+    base = _base(q)
+    selections = _selections(filters)
+    statement = union_all(*(
+        select(literal(facet).label('facet'), column.label('value'), func.count().label('n'))
+        .where(*base, *(c for f, c in selections.items() if f != facet))
+        .group_by(column)
+        for facet, column in _COLUMNS.items()
+    ))
+    counts = {facet: {} for facet in FACETS}
+    for facet, value, n in db.session.execute(statement.execution_options(all_branches=True, include_deleted=True)):
+        counts[facet][value] = n
+
+    categories = dict(db.session.query(Category.id, Category.name)
+                      .filter(Category.id.in_([v for v in counts['category'] if v is not None])))
+    selected_authors = set(filters.get('author') or [])
+    author_ids = sorted(counts['author'], key=lambda v: (-counts['author'][v], v))
+    author_ids = [v for i, v in enumerate(author_ids) if i < AUTHOR_LIMIT or v in selected_authors]
+    authors = dict(db.session.query(Author.id, Author.full_name).filter(Author.id.in_(author_ids)))
+
+    def entries(facet, values, label):
+        chosen = filters.get(facet)
+        chosen = set(chosen) if isinstance(chosen, list) else set() if chosen is None else {chosen}
+        return [{'value': v, 'label': label(v), 'count': counts[facet][v], 'selected': v in chosen} for v in values]
+
+    return {
+        'category': sorted(entries('category', counts['category'], lambda v: categories.get(v, 'Sans catégorie')),
+                           key=lambda e: (-e['count'], e['label'])),
+        'author': entries('author', author_ids, lambda v: authors.get(v, 'N/A')),
+        'decade': entries('decade', sorted(counts['decade'], key=lambda v: (v is None, v)),
+                          lambda v: f"{v}s" if v is not None else 'Inconnue'),
+        'available': entries('available', sorted(counts['available'], reverse=True),
+                             lambda v: 'Disponible' if v else 'Emprunté'),
+    }
+
+
+def browse(q='', filters=None, page=1, per_page=50):
+    """(books of the page, total matches, facet counts)."""
+    filters = filters or {}
+    facets = facet_counts(q, filters)
+    # The availability branch counts every match, split by its own filter
+    wanted = filters.get('available')
+    total = sum(e['count'] for e in facets['available'] if wanted is None or e['value'] == int(wanted))
+    books = (Book.query
+             .options(db.joinedload(Book.author), db.joinedload(Book.category))
+             .filter(*_search(q), *_selections(filters).values())
+             .order_by(Book.title_key, Book.id)
+             .offset((page - 1) * per_page)
+             .limit(per_page)
+             .all())
+    return books, total, facets
@@ -2,6 +2,18 @@
 CREATE DATABASE IF NOT EXISTS BiblioNest CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
 USE BiblioNest;
 
+-- Table: Branches (agences)
+CREATE TABLE IF NOT EXISTS Branches (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    code VARCHAR(20) NOT NULL UNIQUE,
+    address VARCHAR(255),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO Branches (id, name, code) VALUES (1, 'Principale', 'MAIN')
+ON DUPLICATE KEY UPDATE id=id;
+
 -- Table: Admins
 CREATE TABLE IF NOT EXISTS Admins (
     id INT AUTO_INCREMENT PRIMARY KEY,
@@ -9,7 +21,9 @@ CREATE TABLE IF NOT EXISTS Admins (
     username VARCHAR(50) UNIQUE NOT NULL,
     password_hash VARCHAR(255) NOT NULL,
     role VARCHAR(50) NOT NULL DEFAULT 'Admin',
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    branch_id INT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (branch_id) REFERENCES Branches(id)
 );
 
 -- Table: Authors
@@ -17,70 +31,140 @@ CREATE TABLE IF NOT EXISTS Authors (
     id INT AUTO_INCREMENT PRIMARY KEY,
     full_name VARCHAR(150) NOT NULL,
     birth_year INT,
-    nationality VARCHAR(100)
+    nationality VARCHAR(100),
+    name_key VARCHAR(150) NULL,
+    UNIQUE INDEX idx_authors_name_key (name_key)
 );
 
 -- Table: Categories
 CREATE TABLE IF NOT EXISTS Categories (
     id INT AUTO_INCREMENT PRIMARY KEY,
-    name VARCHAR(100) NOT NULL UNIQUE
+    name VARCHAR(100) NOT NULL UNIQUE,
+    name_key VARCHAR(100) NULL,
+    UNIQUE INDEX idx_categories_name_key (name_key)
 );
 
 -- Table: Books
 CREATE TABLE IF NOT EXISTS Books (
     id INT AUTO_INCREMENT PRIMARY KEY,
+    branch_id INT NOT NULL DEFAULT 1,
     title VARCHAR(255) NOT NULL,
+    title_key VARCHAR(255) NULL,
     author_id INT NOT NULL,
     category_id INT,
-    isbn VARCHAR(20) UNIQUE,
+    isbn VARCHAR(20),
+    isbn13 CHAR(13) NULL,
     publication_year INT,
     price DECIMAL(8,2) DEFAULT 0.00,
     total_copies INT NOT NULL DEFAULT 1,
     available_copies INT NOT NULL DEFAULT 1,
     image_path VARCHAR(255),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    deleted_at DATETIME NULL,
+    version INT NOT NULL DEFAULT 1,
+    FOREIGN KEY (branch_id) REFERENCES Branches(id),
     FOREIGN KEY (author_id) REFERENCES Authors(id) ON DELETE RESTRICT,
     FOREIGN KEY (category_id) REFERENCES Categories(id) ON DELETE SET NULL,
     CHECK (available_copies <= total_copies),
-    CHECK (available_copies >= 0)
+    CHECK (available_copies >= 0),
+    UNIQUE INDEX idx_books_branch_isbn13 (branch_id, isbn13),
+    UNIQUE INDEX idx_books_branch_isbn (branch_id, isbn),
+    INDEX idx_books_branch_title_key (branch_id, title_key),
+    INDEX idx_books_branch_facets (branch_id, category_id, author_id, publication_year, available_copies, deleted_at)
+);
+
+-- Table: Copies (exemplaires physiques, un code-barres par exemplaire)
+CREATE TABLE IF NOT EXISTS Copies (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    branch_id INT NOT NULL DEFAULT 1,
+    book_id INT NOT NULL,
+    barcode VARCHAR(32) NULL,
+    `condition` ENUM('Neuf', 'Bon', 'Usé', 'Abîmé') NOT NULL DEFAULT 'Bon',
+    status ENUM('Disponible', 'Prêté', 'Retiré') NOT NULL DEFAULT 'Disponible',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (branch_id) REFERENCES Branches(id),
+    FOREIGN KEY (book_id) REFERENCES Books(id) ON DELETE CASCADE,
+    UNIQUE INDEX idx_copies_barcode (barcode),
+    INDEX idx_copies_book_status (book_id, status)
 );
 
 -- Table: Readers
 CREATE TABLE IF NOT EXISTS Readers (
     id INT AUTO_INCREMENT PRIMARY KEY,
+    branch_id INT NOT NULL DEFAULT 1,
     first_name VARCHAR(100) NOT NULL,
     last_name VARCHAR(100) NOT NULL,
     email VARCHAR(150) UNIQUE NOT NULL,
     phone VARCHAR(20),
     registration_date DATE NOT NULL DEFAULT (CURRENT_DATE),
-    status ENUM('Actif', 'Suspendu') NOT NULL DEFAULT 'Actif'
+    status ENUM('Actif', 'Suspendu') NOT NULL DEFAULT 'Actif',
+    name_key VARCHAR(201) NULL,
+    surname_key VARCHAR(201) NULL,
+    deleted_at DATETIME NULL,
+    version INT NOT NULL DEFAULT 1,
+    FOREIGN KEY (branch_id) REFERENCES Branches(id),
+    INDEX idx_readers_branch_name_key (branch_id, name_key),
+    INDEX idx_readers_branch_surname_key (branch_id, surname_key)
 );
 
 -- Table: Loans
 CREATE TABLE IF NOT EXISTS Loans (
     id INT AUTO_INCREMENT PRIMARY KEY,
+    branch_id INT NOT NULL DEFAULT 1,
     book_id INT NOT NULL,
     reader_id INT NOT NULL,
+    copy_id INT NULL,
     loan_date DATE NOT NULL DEFAULT (CURRENT_DATE),
     due_date DATE NOT NULL,
     returned_at DATE NULL,
     status ENUM('En cours', 'Retard', 'Terminé') DEFAULT 'En cours',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    version INT NOT NULL DEFAULT 1,
+    FOREIGN KEY (branch_id) REFERENCES Branches(id),
     FOREIGN KEY (book_id) REFERENCES Books(id) ON DELETE RESTRICT,
-    FOREIGN KEY (reader_id) REFERENCES Readers(id) ON DELETE RESTRICT
+    FOREIGN KEY (reader_id) REFERENCES Readers(id) ON DELETE RESTRICT,
+    FOREIGN KEY (copy_id) REFERENCES Copies(id) ON DELETE SET NULL,
+    INDEX idx_loans_branch_status_returned (branch_id, status, returned_at),
+    INDEX idx_loans_reader_book (reader_id, book_id),
+    INDEX idx_loans_returned_due (returned_at, due_date),
+    INDEX idx_loans_copy (copy_id)
+);
+
+-- Table: LoansArchive (prêts terminés archivés)
+CREATE TABLE IF NOT EXISTS LoansArchive (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    loan_id INT NOT NULL,
+    branch_id INT NOT NULL DEFAULT 1,
+    book_id INT NOT NULL,
+    reader_id INT NOT NULL,
+    copy_id INT NULL,
+    book_title VARCHAR(255),
+    reader_name VARCHAR(201),
+    loan_date DATE NOT NULL,
+    due_date DATE NOT NULL,
+    returned_at DATETIME NULL,
+    created_at TIMESTAMP NULL,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_archive_loan (loan_id),
+    INDEX idx_archive_reader (reader_id),
+    INDEX idx_archive_returned (returned_at),
+    INDEX idx_archive_branch_returned (branch_id, returned_at)
 );
 
 -- Table: Reservations
 CREATE TABLE IF NOT EXISTS Reservations (
     id INT AUTO_INCREMENT PRIMARY KEY,
+    branch_id INT NOT NULL DEFAULT 1,
     book_id INT NOT NULL,
     reader_id INT NOT NULL,
     reservation_date DATE NOT NULL DEFAULT (CURRENT_DATE),
     expiry_date DATE NOT NULL,
     status ENUM('En attente', 'Terminée', 'Annulée') NOT NULL DEFAULT 'En attente',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (branch_id) REFERENCES Branches(id),
     FOREIGN KEY (book_id) REFERENCES Books(id) ON DELETE CASCADE,
-    FOREIGN KEY (reader_id) REFERENCES Readers(id) ON DELETE CASCADE
+    FOREIGN KEY (reader_id) REFERENCES Readers(id) ON DELETE CASCADE,
+    INDEX idx_reservations_branch_status (branch_id, status)
 );
 
 -- Table: PenaltyTypes
@@ -95,8 +179,10 @@ CREATE TABLE IF NOT EXISTS PenaltyTypes (
 -- Table: Penalties
 CREATE TABLE IF NOT EXISTS Penalties (
     id INT AUTO_INCREMENT PRIMARY KEY,
+    branch_id INT NOT NULL DEFAULT 1,
     reader_id INT NOT NULL,
     loan_id INT NULL,
+    archived_loan_id INT NULL,
     penalty_type_id INT NOT NULL,
     reason TEXT NOT NULL,
     amount DECIMAL(10, 2) NOT NULL,
@@ -106,18 +192,25 @@ CREATE TABLE IF NOT EXISTS Penalties (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (reader_id) REFERENCES Readers(id) ON DELETE CASCADE,
     FOREIGN KEY (loan_id) REFERENCES Loans(id) ON DELETE SET NULL,
-    FOREIGN KEY (penalty_type_id) REFERENCES PenaltyTypes(id) ON DELETE RESTRICT
+    FOREIGN KEY (archived_loan_id) REFERENCES LoansArchive(id) ON DELETE SET NULL,
+    FOREIGN KEY (penalty_type_id) REFERENCES PenaltyTypes(id) ON DELETE RESTRICT,
+    FOREIGN KEY (branch_id) REFERENCES Branches(id),
+    INDEX idx_penalties_branch_status (branch_id, status)
 );
 
 -- Table: Settings
 CREATE TABLE IF NOT EXISTS Settings (
     id INT PRIMARY KEY,
+    branch_id INT NULL,
     library_name VARCHAR(255) NOT NULL DEFAULT 'BiblioNest',
     contact_email VARCHAR(255) NOT NULL DEFAULT 'contact@biblionest.com',
     default_loan_duration INT NOT NULL DEFAULT 15,
     daily_penalty_amount DECIMAL(10,2) NOT NULL DEFAULT 5.00,
     deterioration_penalty_amount DECIMAL(10,2) NOT NULL DEFAULT 5.00,
-    lost_book_penalty_amount DECIMAL(10,2) NOT NULL DEFAULT 20.00
+    lost_book_penalty_amount DECIMAL(10,2) NOT NULL DEFAULT 20.00,
+    reminder_days INT NOT NULL DEFAULT 2,
+    FOREIGN KEY (branch_id) REFERENCES Branches(id),
+    UNIQUE INDEX idx_settings_branch (branch_id)
 );
 
 -- Données initiales : Types de pénalités
@@ -128,6 +221,88 @@ INSERT INTO PenaltyTypes (id, label, description, fixed_amount, daily_rate) VALU
 ON DUPLICATE KEY UPDATE label=label;
 
 -- Données initiales : Paramètres
-INSERT INTO Settings (id, library_name, contact_email, default_loan_duration, daily_penalty_amount, deterioration_penalty_amount, lost_book_penalty_amount)
-VALUES (1, 'BiblioNest', 'contact@biblionest.com', 15, 5.00, 5.00, 20.00)
+INSERT INTO Settings (id, branch_id, library_name, contact_email, default_loan_duration, daily_penalty_amount, deterioration_penalty_amount, lost_book_penalty_amount)
+VALUES (1, 1, 'BiblioNest', 'contact@biblionest.com', 15, 5.00, 5.00, 20.00)
 ON DUPLICATE KEY UPDATE id=id;
+
+-- Table: Notices (rappels et avis de retard envoyés aux lecteurs)
+CREATE TABLE IF NOT EXISTS Notices (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    branch_id INT NOT NULL DEFAULT 1,
+    loan_id INT NOT NULL,
+    reader_id INT NOT NULL,
+    kind ENUM('Rappel', 'Retard') NOT NULL,
+    due_date DATE NOT NULL,
+    email VARCHAR(255) NULL,
+    status ENUM('En attente', 'Envoi', 'Envoyé', 'Échec') NOT NULL DEFAULT 'En attente',
+    claim VARCHAR(32) NULL,
+    claimed_at DATETIME NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    error TEXT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sent_at DATETIME NULL,
+    UNIQUE INDEX idx_notices_loan_kind_due (loan_id, kind, due_date),
+    INDEX idx_notices_status (status)
+);
+
+-- Table: Jobs (file de tâches en arrière-plan)
+CREATE TABLE IF NOT EXISTS Jobs (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    kind VARCHAR(50) NOT NULL,
+    payload TEXT,
+    status ENUM('En attente', 'En cours', 'Terminé', 'Échec') NOT NULL DEFAULT 'En attente',
+    attempts INT NOT NULL DEFAULT 0,
+    max_attempts INT NOT NULL DEFAULT 3,
+    run_after DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    result TEXT,
+    artifact VARCHAR(255),
+    error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at DATETIME NULL,
+    finished_at DATETIME NULL,
+    INDEX idx_jobs_status_run_after (status, run_after),
+    INDEX idx_jobs_status_finished_at (status, finished_at)
+);
+
+-- Table: BookNeighbours (recommandations "les lecteurs ont aussi emprunté")
+CREATE TABLE IF NOT EXISTS BookNeighbours (
+    book_id INT NOT NULL,
+    neighbour_id INT NOT NULL,
+    score INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (book_id, neighbour_id),
+    INDEX idx_neighbours_book_score (book_id, score)
+);
+
+-- Table: Popularity (compteurs d'emprunts par mois, année et au total)
+CREATE TABLE IF NOT EXISTS Popularity (
+    branch_id INT NOT NULL,
+    entity VARCHAR(10) NOT NULL,
+    bucket VARCHAR(7) NOT NULL,
+    entity_id INT NOT NULL,
+    loans INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (branch_id, entity, bucket, entity_id),
+    INDEX idx_popularity_top (branch_id, entity, bucket, loans, entity_id)
+);
+
+-- Table: AuditLog (journal des modifications, écrit par lots)
+CREATE TABLE IF NOT EXISTS AuditLog (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    at DATETIME NOT NULL,
+    actor_id INT NULL,
+    entity VARCHAR(50) NOT NULL,
+    entity_id INT NULL,
+    action VARCHAR(20) NOT NULL,
+    changes TEXT,
+    INDEX idx_audit_entity_time (entity, entity_id, at),
+    INDEX idx_audit_time (at)
+);
+
+-- Table: ChangeEvents (relais des mises à jour en direct entre processus)
+CREATE TABLE IF NOT EXISTS ChangeEvents (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    at DATETIME NOT NULL,
+    branch_id INT NULL,
+    kind VARCHAR(20) NOT NULL,
+    payload TEXT NOT NULL,
+    INDEX idx_change_events_at (at)
+);
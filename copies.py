@@ -0,0 +1,219 @@
+"""Physical copies of books and the stock counters derived from them.
+
+Every item is a Copy row with a unique barcode, so scanning a label is a
+single index lookup and a loan records which item went out. The Books row
+keeps total_copies (copies not withdrawn) and available_copies (copies on
+the shelf) as aggregates so the lists still read one row per title: every
+status change below moves them in the same transaction with a conditional
+UPDATE. Book.version is only bumped when total_copies moves: the edit form
+sends the total back, while available_copies is never taken from a form and
+the guards of the UPDATE already keep it consistent, so a loan or a return
+does not invalidate a book form left open. Callers commit.
+"""
+from sqlalchemy import bindparam, func, case
+from models import db, Book, Copy, Loan
+
+BARCODE_PREFIX = 'BN'
+CONDITIONS = ('Neuf', 'Bon', 'Usé', 'Abîmé')
+# Withdrawn first when a title loses copies
+CONDITION_ORDER = case({c: -i for i, c in enumerate(CONDITIONS)}, value=Copy.condition)
+
+
+def barcode_for(copy_id):
+    return f"{BARCODE_PREFIX}{copy_id:08d}"
+
+
+def normalize(barcode):
+    return (barcode or '').strip().upper() or None
+
+
+def find(barcode):
+    """The copy carrying this barcode in the current branch, or None."""
+    code = normalize(barcode)
+    if not code:
+        return None
+    return Copy.query.filter(Copy.barcode == code).first()
+
+
+def _counters(book_id, total=0, available=0):
+    """Move a book's aggregates. Decrements only apply while enough copies
+    are counted; returns False when they were not."""
+    query = Book.query.filter(Book.id == book_id).execution_options(include_deleted=True)
+    if available < 0:
+        query = query.filter(Book.available_copies >= -available)
+    if total < 0:
+        query = query.filter(Book.total_copies >= -total)
+    values = {
+        Book.total_copies: Book.total_copies + total,
+        Book.available_copies: Book.available_copies + available
+    }
+    if total:
+        values[Book.version] = Book.version + 1
+    return query.update(values, synchronize_session=False) == 1
+
+
+def create(book, count, barcodes=None, condition='Bon'):
+    """Put `count` new copies of a flushed book on the shelf, labelled with
+    the given barcodes or generated ones. The counters are left to the
+    caller (add() moves them)."""
+    barcodes = [normalize(b) for b in (barcodes or [])]
+    rows = [Copy(book_id=book.id, branch_id=book.branch_id, condition=condition,
+                 barcode=barcodes[i] if i < len(barcodes) else None)
+            for i in range(count)]
+    db.session.add_all(rows)
+    db.session.flush()
+    for row in rows:
+        if not row.barcode:
+            row.barcode = barcode_for(row.id)
+    db.session.flush()
+    return rows
+
+
+def add(book, count, barcodes=None, condition='Bon'):
+    """Add copies to a title and count them."""
+    rows = create(book, count, barcodes, condition)
+    _counters(book.id, count, count)
+    return rows
+
+
+def withdraw(book, count):
+    """Retire `count` shelf copies, worst condition first. Copies on loan
+    cannot be withdrawn."""
+    ids = [i for (i,) in db.session.query(Copy.id)
+           .filter(Copy.book_id == book.id, Copy.status == 'Disponible')
+           .order_by(CONDITION_ORDER, Copy.id.desc()).limit(count)]
+    retired = Copy.query.filter(Copy.id.in_(ids), Copy.status == 'Disponible') \
+        .update({Copy.status: 'Retiré'}, synchronize_session=False) if ids else 0
+    if retired != count or not _counters(book.id, -count, -count):
+        raise ValueError(f"Seulement {len(ids)} exemplaire(s) en rayon, les autres sont en prêt")
+
+
+def set_status(copy, status):
+    """Withdraw a shelf copy or put a withdrawn one back."""
+    moves = {('Disponible', 'Retiré'): -1, ('Retiré', 'Disponible'): 1}
+    delta = moves.get((copy.status, status))
+    if delta is None:
+        if copy.status == status:
+            return
+        raise ValueError("Un exemplaire prêté change de statut au retour du prêt")
+    changed = Copy.query.filter(Copy.id == copy.id, Copy.status == copy.status) \
+        .update({Copy.status: status}, synchronize_session=False)
+    if not changed or not _counters(copy.book_id, delta, delta):
+        raise ValueError("L'exemplaire a changé entre-temps, rechargez la page")
+    db.session.expire(copy, ['status'])
+
+
+def lend(book_id, barcode=None):
+    """Take a copy off the shelf for a loan: the scanned one, or any copy of
+    the book on the shelf. Returns it, or None when there is none."""
+    for _ in range(3):
+        if barcode:
+            copy = find(barcode)
+            if not copy or copy.book_id != book_id or copy.status != 'Disponible':
+                return None
+        else:
+            copy = Copy.query.filter(Copy.book_id == book_id, Copy.status == 'Disponible') \
+                .order_by(Copy.id).first()
+            if not copy:
+                return None
+        # Conditional UPDATE: another desk may have taken the same copy
+        if Copy.query.filter(Copy.id == copy.id, Copy.status == 'Disponible') \
+                .update({Copy.status: 'Prêté'}, synchronize_session=False):
+            db.session.expire(copy, ['status'])
+            return copy if _counters(book_id, available=-1) else None
+    return None
+
+
+def give_back(loan):
+    """Put the copy of a loan that ends (return or delete) back on the shelf."""
+    if loan.copy_id:
+        Copy.query.filter(Copy.id == loan.copy_id, Copy.status == 'Prêté') \
+            .update({Copy.status: 'Disponible'}, synchronize_session=False)
+    _counters(loan.book_id, available=1)
+
+
+def move(book, target, count):
+    """Hand `count` shelf copies of a book over to another book record (a
+    transfer between branches). The counters are moved by the caller."""
+    ids = [i for (i,) in db.session.query(Copy.id)
+           .filter(Copy.book_id == book.id, Copy.status == 'Disponible')
+           .order_by(Copy.id).limit(count)]
+    moved = Copy.query.filter(Copy.id.in_(ids), Copy.status == 'Disponible').update(
+        {Copy.book_id: target.id, Copy.branch_id: target.branch_id},
+        synchronize_session=False) if ids else 0
+    if moved != count:
+        raise ValueError("Pas assez d'exemplaires disponibles pour ce transfert")
+
+
+def serialize(copy, loan=None):
+    return {
+        'id': copy.id,
+        'book_id': copy.book_id,
+        'barcode': copy.barcode,
+        'condition': copy.condition,
+        'status': copy.status,
+        'loan_id': loan.id if loan else None,
+        'reader_name': f"{loan.reader.first_name} {loan.reader.last_name}" if loan and loan.reader else None,
+        'due_date': loan.due_date.strftime('%Y-%m-%d') if loan else None
+    }
+
+
+def resync():
+    """Rebuild copy statuses from the open loans and the counters from the
+    copies. Returns the number of books whose counters changed."""
+    loaned = db.session.query(Loan.copy_id).filter(Loan.status != 'Terminé', Loan.copy_id != None)
+    Copy.query.filter(Copy.status == 'Prêté', ~Copy.id.in_(loaned)) \
+        .update({Copy.status: 'Disponible'}, synchronize_session=False)
+    Copy.query.filter(Copy.status != 'Prêté', Copy.id.in_(loaned)) \
+        .update({Copy.status: 'Prêté'}, synchronize_session=False)
+    counts = {book_id: (total or 0, available or 0) for book_id, total, available in
+              db.session.query(Copy.book_id,
+                               func.sum(case((Copy.status != 'Retiré', 1), else_=0)),
+                               func.sum(case((Copy.status == 'Disponible', 1), else_=0)))
+              .execution_options(all_branches=True)
+              .group_by(Copy.book_id)}
+    updated = 0
+    for book in Book.query.execution_options(all_branches=True, include_deleted=True).all():
+        total, available = counts.get(book.id, (0, 0))
+        if (book.total_copies, book.available_copies) != (total, available):
+            book.total_copies = total
+            book.available_copies = available
+            updated += 1
+    db.session.commit()
+    return updated
+
+
+def backfill():
+    """Create the copies of books that predate copy tracking: total_copies
+    items, one of them lent to each open loan. Returns the copies created."""
+    books = Book.query.execution_options(include_deleted=True).filter(~Book.copies.any()).all()
+    if not books:
+        return 0
+    open_loans = {}
+    for loan_id, book_id in db.session.query(Loan.id, Loan.book_id) \
+            .filter(Loan.status != 'Terminé', Loan.copy_id == None).order_by(Loan.id):
+        open_loans.setdefault(book_id, []).append(loan_id)
+    created = []
+    assignments = []
+    for book in books:
+        loans = open_loans.get(book.id, [])
+        rows = [Copy(book_id=book.id, branch_id=book.branch_id,
+                     status='Prêté' if i < len(loans) else 'Disponible')
+                for i in range(max(book.total_copies, len(loans)))]
+        created.extend(rows)
+        assignments.append((loans, rows))
+        # Counters follow the copies, fixing any drift
+        book.total_copies = len(rows)
+        book.available_copies = len(rows) - len(loans)
+    db.session.add_all(created)
+    db.session.flush()
+    for row in created:
+        row.barcode = barcode_for(row.id)
+    links = [{'loan_id': loan_id, 'copy': row.id}
+             for loans, rows in assignments for loan_id, row in zip(loans, rows)]
+    if links:
+        table = Loan.__table__
+        db.session.execute(table.update().where(table.c.id == bindparam('loan_id'))
+                           .values(copy_id=bindparam('copy')), links)
+    db.session.commit()
+    return len(created)
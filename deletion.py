@@ -0,0 +1,142 @@
+"""Deleting readers and books.
+
+Hard deletes remove the dependent penalties, reservations and loans with a
+few set-based DELETE statements, then the row itself; the relationships are
+declared passive_deletes so the ORM never loads the history into the
+session first. Copies still out on an open loan of a deleted reader go back
+on the shelf, as in delete_loan.
+
+With SOFT_DELETE enabled, a delete only stamps deleted_at and queues a job
+that archives the finished loans and drops pending reservations. Soft-deleted
+rows are hidden from every ORM query (but not from relationship loads, so an
+open loan still shows its reader) unless the query runs with
+execution_options(include_deleted=True). `flask purge-deleted` hard-deletes
+them once they have no open loan left.
+
+A hidden row keeps its unique email or ISBN, so the duplicate checks look at
+soft-deleted rows too and answer with duplicate_error(), which points at the
+row to restore() instead of creating a second one.
+"""
+from datetime import datetime
+
+from sqlalchemy import event, select, func, or_
+from sqlalchemy.orm import Session, with_loader_criteria
+from models import db, Book, Copy, Reader, Loan, Reservation, Penalty
+import archive
+import audit
+import jobs
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _hide_deleted(state):
+    if (state.is_select and not state.is_relationship_load
+            and not state.execution_options.get('include_deleted', False)):
+        # propagate_to_loaders=False: lazy loads from the rows returned here
+        # (loan.reader, ...) must still find a soft-deleted parent
+        state.statement = state.statement.options(
+            with_loader_criteria(Reader, Reader.deleted_at == None, include_aliases=True, propagate_to_loaders=False),
+            with_loader_criteria(Book, Book.deleted_at == None, include_aliases=True, propagate_to_loaders=False)
+        )
+
+
+def _restore_copies(loan_filter):
+    # The items go back on the shelf, then one UPDATE per book that had
+    # copies out on the loans being removed
+    Copy.query.filter(Copy.id.in_(
+        select(Loan.copy_id).where(loan_filter, Loan.status != 'Terminé', Loan.copy_id != None)
+    )).update({Copy.status: 'Disponible'}, synchronize_session=False)
+    open_counts = (
+        db.session.query(Loan.book_id, func.count(Loan.id))
+        .filter(loan_filter, Loan.status != 'Terminé')
+        .group_by(Loan.book_id)
+        .all()
+    )
+    for book_id, count in open_counts:
+        Book.query.filter(Book.id == book_id).execution_options(include_deleted=True).update(
+            {Book.available_copies: Book.available_copies + count},
+            synchronize_session=False)
+
+
+def _delete_children(loan_filter, reservation_filter, penalty_filter):
+    """Set-based delete of loans and what hangs off them. Returns the
+    removed loan ids and the row counts per table."""
+    loan_ids = [i for (i,) in db.session.execute(select(Loan.id).where(loan_filter))]
+    loans = select(Loan.id).where(loan_filter).scalar_subquery()
+    counts = {
+        'Penalties': Penalty.query.filter(or_(penalty_filter, Penalty.loan_id.in_(loans)))
+        .delete(synchronize_session=False),
+        'Reservations': Reservation.query.filter(reservation_filter).delete(synchronize_session=False),
+    }
+    counts['Loans'] = Loan.query.filter(loan_filter).delete(synchronize_session=False)
+    return loan_ids, counts
+
+
+def hard_delete_reader(reader):
+    """Delete a reader and their whole history. Returns the removed loan ids.
+    The caller commits."""
+    _restore_copies(Loan.reader_id == reader.id)
+    loan_ids, counts = _delete_children(
+        Loan.reader_id == reader.id, Reservation.reader_id == reader.id, Penalty.reader_id == reader.id)
+    # Children are gone; with passive_deletes the ORM leaves the collections alone
+    db.session.delete(reader)
+    audit.record('Readers', reader.id, 'cascade', counts)
+    return loan_ids
+
+
+def hard_delete_book(book):
+    """Delete a book, its copies, loans and reservations, and the penalties on
+    those loans. Returns the removed loan ids. The caller commits."""
+    loan_ids, counts = _delete_children(
+        Loan.book_id == book.id, Reservation.book_id == book.id, db.false())
+    counts['Copies'] = Copy.query.filter(Copy.book_id == book.id).delete(synchronize_session=False)
+    db.session.delete(book)
+    audit.record('Books', book.id, 'cascade', counts)
+    return loan_ids
+
+
+def soft_delete(row):
+    """Hide a reader or book; the history is archived by a job. Commits."""
+    row.deleted_at = datetime.utcnow()
+    entity = 'reader' if isinstance(row, Reader) else 'book'
+    return jobs.enqueue('archive_deleted', {'entity': entity, 'id': row.id})
+
+
+def restore(row):
+    """Bring back a soft-deleted reader or book. Loans archived meanwhile
+    stay in the archive. The caller commits."""
+    row.deleted_at = None
+
+
+def duplicate_error(row, message):
+    """JSON body for a unique key already held by `row`. A soft-deleted
+    holder is named so the page can offer to restore it."""
+    if row.deleted_at is None:
+        return {'success': False, 'error': message}
+    return {'success': False, 'error': f"{message} (supprimé, à restaurer)", 'deleted_id': row.id}
+
+
+def archive_deleted(entity, row_id, batch_size=500):
+    """Archive the finished loans of a soft-deleted reader or book and drop
+    its pending reservations. Returns the number of loans archived."""
+    column = 'reader_id' if entity == 'reader' else 'book_id'
+    Reservation.query.filter(getattr(Reservation, column) == row_id,
+                             Reservation.status.in_(['En attente', 'Active'])).delete(synchronize_session=False)
+    db.session.commit()
+    return archive.archive_finished_loans(None, batch_size, **{column: row_id})
+
+
+def purge_deleted():
+    """Hard-delete soft-deleted readers and books with no open loan.
+    Returns (readers, books) purged."""
+    open_loans = Loan.query.filter(Loan.status != 'Terminé')
+    purged = []
+    for model, column, delete in ((Reader, Loan.reader_id, hard_delete_reader),
+                                  (Book, Loan.book_id, hard_delete_book)):
+        busy = open_loans.with_entities(column)
+        rows = (model.query.execution_options(include_deleted=True)
+                .filter(model.deleted_at != None, ~model.id.in_(busy)).all())
+        for row in rows:
+            delete(row)
+            db.session.commit()
+        purged.append(len(rows))
+    return tuple(purged)
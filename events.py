@@ -0,0 +1,262 @@
+"""Live change notifications pushed to open pages over Server-Sent Events.
+
+Mutating handlers call publish() after their commit with a compact event
+(kind, action, serialized row). A backend carries events between processes;
+each process fans them out to its local /api/events streams, filtered on the
+subscriber's branch.
+
+Backends (EVENTS_BACKEND):
+  'table'   events go through the ChangeEvents table, which each process
+            polls by primary key every EVENTS_POLL_MS while it has open
+            streams. Works across gunicorn workers on SQLite and MySQL.
+            MySQL hands out auto-increment ids at INSERT, so they can
+            commit out of order: the poller re-reads past missing ids for
+            up to EVENTS_GAP_SECONDS before giving up on them.
+  'memory'  in-process only, for a single-process server.
+
+Event ids are sent as SSE ids, so a reconnecting EventSource replays what it
+missed from Last-Event-ID (kept EVENTS_RETENTION_SECONDS in the table, the
+last REPLAY_SIZE events in memory).
+"""
+import itertools
+import json
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from models import db, ChangeEvent
+import branches
+
+REPLAY_SIZE = 500
+QUEUE_SIZE = 1000
+HEARTBEAT_SECONDS = 15
+
+_lock = threading.Lock()
+_subscribers = set()
+_config = {}
+
+
+class Subscription:
+    """One open stream: a bounded queue of events for one branch."""
+
+    def __init__(self, branch_id):
+        self.branch_id = branch_id
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.backlog = []
+        # Set when the queue overflowed: the stream ends and the client
+        # reconnects, replaying from its last id
+        self.dropped = False
+
+    def offer(self, event):
+        if event['branch_id'] not in (None, self.branch_id):
+            return
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped = True
+
+
+def _dispatch(events):
+    with _lock:
+        subscribers = list(_subscribers)
+    for event in events:
+        for subscription in subscribers:
+            subscription.offer(event)
+
+
+class MemoryBackend:
+    def __init__(self, app):
+        self._ids = itertools.count(1)
+        self._recent = deque(maxlen=REPLAY_SIZE)
+
+    def publish(self, events):
+        for event in events:
+            event['id'] = next(self._ids)
+            self._recent.append(event)
+        _dispatch(events)
+
+    def since(self, last_id):
+        return [e for e in list(self._recent) if e['id'] > last_id]
+
+    def start(self):
+        pass
+
+
+class TableBackend:
+    def __init__(self, app):
+        self.engine = _config['engine']
+        self.interval = app.config['EVENTS_POLL_MS'] / 1000.0
+        self.retention = app.config['EVENTS_RETENTION_SECONDS']
+        self.gap_timeout = app.config['EVENTS_GAP_SECONDS']
+        self._thread = None
+        self._start_lock = threading.Lock()
+        # Every id up to _floor is dispatched or given up; above it, _seen
+        # holds the ids dispatched and _gaps the missing ones (id -> since)
+        self._floor = None
+        self._seen = set()
+        self._gaps = {}
+
+    def publish(self, events):
+        rows = [{
+            'at': datetime.utcnow(),
+            'branch_id': e['branch_id'],
+            'kind': e['type'],
+            'payload': json.dumps(e, ensure_ascii=False)
+        } for e in events]
+        with self.engine.begin() as conn:
+            conn.execute(ChangeEvent.__table__.insert(), rows)
+
+    def _read(self, conn, last_id, limit=None):
+        table = ChangeEvent.__table__
+        query = db.select(table.c.id, table.c.payload).where(table.c.id > last_id).order_by(table.c.id)
+        if limit:
+            query = query.limit(limit)
+        events = []
+        for row_id, payload in conn.execute(query):
+            event = json.loads(payload)
+            event['id'] = row_id
+            events.append(event)
+        return events
+
+    def since(self, last_id):
+        with self.engine.connect() as conn:
+            return self._read(conn, last_id, REPLAY_SIZE)
+
+    def _poll(self):
+        table = ChangeEvent.__table__
+        pruned_at = 0
+        while True:
+            time.sleep(self.interval)
+            with _lock:
+                idle = not _subscribers
+            if idle:
+                continue
+            try:
+                with self.engine.connect() as conn:
+                    events = self._read(conn, self._floor)
+                self._advance(events)
+                if time.monotonic() - pruned_at > 60:
+                    with self.engine.begin() as conn:
+                        conn.execute(table.delete().where(
+                            table.c.at < datetime.utcnow() - timedelta(seconds=self.retention)))
+                    pruned_at = time.monotonic()
+            except Exception:
+                # Transient database error: retry on the next tick
+                continue
+
+    def _advance(self, events):
+        """Dispatch the events not seen yet and move the floor past the
+        ids that are settled."""
+        fresh = [e for e in events if e['id'] > self._floor and e['id'] not in self._seen]
+        if fresh:
+            self._seen.update(e['id'] for e in fresh)
+            _dispatch(fresh)
+        now = time.monotonic()
+        previous = self._floor
+        for row_id in sorted(self._seen):
+            # Ids skipped between two seen ones may still be committing
+            for missing in range(previous + 1, row_id):
+                self._gaps.setdefault(missing, now)
+            previous = row_id
+        while True:
+            following = self._floor + 1
+            if following in self._seen:
+                self._seen.discard(following)
+            elif following in self._gaps and now - self._gaps[following] > self.gap_timeout:
+                # Rolled back, or too late to matter
+                del self._gaps[following]
+            else:
+                break
+            self._floor = following
+        self._gaps = {i: since for i, since in self._gaps.items() if i > self._floor}
+
+    def start(self):
+        # Started by the first stream of the process
+        with self._start_lock:
+            if self._thread:
+                return
+            table = ChangeEvent.__table__
+            with self.engine.connect() as conn:
+                self._floor = conn.execute(db.select(db.func.max(table.c.id))).scalar() or 0
+            self._thread = threading.Thread(target=self._poll, name='events-poller', daemon=True)
+            self._thread.start()
+
+
+BACKENDS = {'memory': MemoryBackend, 'table': TableBackend}
+
+
+def publish(kind, action, data, branch_id=None):
+    """Send a change event to every open stream of the branch."""
+    backend = _config.get('backend')
+    if backend is None:
+        return
+    event = {
+        'type': kind,
+        'action': action,
+        'branch_id': branch_id or branches.current_id(),
+        'data': data
+    }
+    try:
+        backend.publish([event])
+    except Exception:
+        # Live updates are best-effort; the pages still reload on demand
+        pass
+
+
+def subscribe(branch_id, last_event_id=None):
+    """Open a stream for a branch, or None when this process already serves
+    EVENTS_MAX_STREAMS of them (each holds a server thread)."""
+    backend = _config['backend']
+    with _lock:
+        if len(_subscribers) >= _config['max_streams']:
+            return None
+    backend.start()
+    subscription = Subscription(branch_id)
+    with _lock:
+        _subscribers.add(subscription)
+    if last_event_id and str(last_event_id).isdigit():
+        subscription.backlog = [e for e in backend.since(int(last_event_id))
+                                if e['branch_id'] in (None, branch_id)]
+    return subscription
+
+
+def _format(event):
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+def stream(subscription, lifetime=None):
+    """SSE body for a subscription. Ends after `lifetime` seconds so threads
+    are recycled; EventSource reconnects on its own."""
+    lifetime = lifetime or _config['stream_seconds']
+    try:
+        yield 'retry: 3000\n\n'
+        for event in subscription.backlog:
+            yield _format(event)
+        deadline = time.monotonic() + lifetime
+        while not subscription.dropped and time.monotonic() < deadline:
+            try:
+                event = subscription.queue.get(timeout=HEARTBEAT_SECONDS)
+            except queue.Empty:
+                # Comment line: keeps proxies from closing an idle stream
+                yield ': ping\n\n'
+                continue
+            yield _format(event)
+    finally:
+        with _lock:
+            _subscribers.discard(subscription)
+
+
+def init_app(app):
+    app.config.setdefault('EVENTS_BACKEND', 'table')
+    app.config.setdefault('EVENTS_POLL_MS', 500)
+    app.config.setdefault('EVENTS_RETENTION_SECONDS', 300)
+    app.config.setdefault('EVENTS_GAP_SECONDS', 10)
+    app.config.setdefault('EVENTS_MAX_STREAMS', 16)
+    app.config.setdefault('EVENTS_STREAM_SECONDS', 300)
+    _config['max_streams'] = app.config['EVENTS_MAX_STREAMS']
+    _config['stream_seconds'] = app.config['EVENTS_STREAM_SECONDS']
+    with app.app_context():
+        _config['engine'] = db.engine
+    _config['backend'] = BACKENDS[app.config['EVENTS_BACKEND']](app)
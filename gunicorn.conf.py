@@ -0,0 +1,36 @@
+"""Gunicorn settings for BiblioNest: gunicorn -c gunicorn.conf.py
+
+Every value can be overridden through BIBLIONEST_* environment variables.
+`kill -HUP <master pid>` starts fresh workers and retires the old ones
+gracefully. With preload_app the code itself is only reloaded on a full
+restart.
+"""
+import multiprocessing
+import os
+
+# Job and audit threads are started per worker in post_worker_init, not in the master
+os.environ.setdefault('BIBLIONEST_JOBS_AUTOSTART', '0')
+
+wsgi_app = 'wsgi:app'
+bind = os.environ.get('BIBLIONEST_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('BIBLIONEST_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('BIBLIONEST_THREADS', 4))
+# Live update streams (/api/events) may take at most half of a worker's threads
+os.environ.setdefault('BIBLIONEST_EVENT_STREAMS', str(max(1, threads // 2)))
+preload_app = True
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+accesslog = os.environ.get('BIBLIONEST_ACCESS_LOG', '-')
+
+
+def post_worker_init(worker):
+    # Runs in each worker before it accepts connections
+    import audit
+    import jobs
+    from wsgi import app, warm_up
+    warm_up(app)
+    jobs.start_workers(app)
+    audit.start_flusher(app)
+    worker.log.info("Worker %s warmed up", worker.pid)
@@ -0,0 +1,116 @@
+"""ISBN normalization and the scan-lookup cache.
+
+Books keep the ISBN as typed in Book.isbn; Book.isbn13 holds the canonical
+ISBN-13 (digits only) used for lookups, so hyphens and ISBN-10 codes match.
+"""
+import re
+import threading
+from collections import OrderedDict
+
+from models import db, Book
+import branches
+
+
+def to_isbn13(raw):
+    """Return the canonical ISBN-13 for an ISBN-10/13 string, or None if invalid."""
+    if not raw:
+        return None
+    code = re.sub(r'[^0-9Xx]', '', str(raw)).upper()
+    if len(code) == 10 and code[:9].isdigit() and (code[9].isdigit() or code[9] == 'X'):
+        check = sum((10 - i) * (10 if c == 'X' else int(c)) for i, c in enumerate(code)) % 11
+        if check != 0:
+            return None
+        code = '978' + code[:9]
+        return code + str((10 - sum((3 if i % 2 else 1) * int(c) for i, c in enumerate(code)) % 10) % 10)
+    if len(code) == 13 and code.isdigit():
+        if sum((3 if i % 2 else 1) * int(c) for i, c in enumerate(code)) % 10 != 0:
+            return None
+        return code
+    return None
+
+
+class LRUCache:
+    """Small thread-safe LRU mapping."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def discard_where(self, predicate):
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# (branch id, isbn13) -> book id. Only the mapping is cached: stock is always
+# read fresh through the primary key.
+_book_ids = LRUCache(4096)
+
+
+def find_book(code):
+    """Look up a book by any ISBN form. Returns (isbn13, book or None)."""
+    isbn13 = to_isbn13(code)
+    if not isbn13:
+        return None, None
+    key = (branches.current_id(), isbn13)
+    book_id = _book_ids.get(key)
+    if book_id is not None:
+        book = db.session.get(Book, book_id)
+        if book and book.isbn13 == isbn13:
+            return isbn13, book
+        _book_ids.discard(key)
+    book = Book.query.filter_by(isbn13=isbn13).first()
+    if book:
+        _book_ids.set(key, book.id)
+    return isbn13, book
+
+
+def invalidate(*codes):
+    """Forget cached ids for the given canonical ISBNs, in every branch
+    (None is ignored)."""
+    codes = {code for code in codes if code}
+    if codes:
+        _book_ids.discard_where(lambda key: key[1] in codes)
+
+
+def backfill():
+    """Fill Book.isbn13 for rows missing it. Returns (filled, skipped duplicates)."""
+    # ISBNs are unique per branch
+    taken = {(branch_id, code) for branch_id, code in
+             db.session.query(Book.branch_id, Book.isbn13).filter(Book.isbn13 != None)}
+    filled = skipped = 0
+    for book in Book.query.filter(Book.isbn13 == None, Book.isbn != None).all():
+        code = to_isbn13(book.isbn)
+        if not code:
+            continue
+        if (book.branch_id, code) in taken:
+            skipped += 1
+            continue
+        book.isbn13 = code
+        taken.add((book.branch_id, code))
+        filled += 1
+    db.session.commit()
+    return filled, skipped
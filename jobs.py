@@ -0,0 +1,221 @@
+"""In-process background jobs stored in the Jobs table.
+
+Tasks are registered with the @task decorator and executed by a small pool of
+worker threads, each inside its own application context. Jobs survive restarts
+since they live in the database, so no external broker is needed. Finished and
+failed jobs are deleted, with their artifacts, JOBS_RETENTION_DAYS after they
+end; the workers check every JOBS_PURGE_INTERVAL seconds.
+"""
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+from models import db, Job
+
+_tasks = {}
+_wakeup = threading.Event()
+_workers = []
+_purge_lock = threading.Lock()
+_purged_at = [None]
+
+
+def task(name, max_attempts=3):
+    """Register a function as the handler for jobs of the given kind.
+
+    The handler receives the decoded payload and the Job row, and returns a
+    JSON-serializable dict. A returned 'artifact' key names a file written
+    under artifact_dir() that can be downloaded once the job is done.
+    """
+    def decorator(func):
+        _tasks[name] = (func, max_attempts)
+        return func
+    return decorator
+
+
+def enqueue(name, payload=None, delay=0, commit=True):
+    """Queue a job and wake the workers. Commits the current session.
+
+    With commit=False the job only joins the caller's transaction, so it is
+    queued if and only if that transaction commits; call wake() afterwards.
+    """
+    if name not in _tasks:
+        raise ValueError(f"Unknown job kind: {name}")
+    job = Job(
+        kind=name,
+        payload=json.dumps(payload or {}),
+        max_attempts=_tasks[name][1],
+        run_after=datetime.utcnow() + timedelta(seconds=delay)
+    )
+    db.session.add(job)
+    if commit:
+        db.session.commit()
+        wake()
+    return job
+
+
+def wake():
+    _wakeup.set()
+
+
+def artifact_dir(app=None):
+    from flask import current_app
+    app = app or current_app
+    path = os.path.join(app.instance_path, 'jobs')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def serialize(job):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+        'result': json.loads(job.result) if job.result else None,
+        'error': job.error,
+        'has_artifact': bool(job.artifact),
+        'created_at': job.created_at.strftime('%Y-%m-%d %H:%M:%S') if job.created_at else None,
+        'finished_at': job.finished_at.strftime('%Y-%m-%d %H:%M:%S') if job.finished_at else None
+    }
+
+
+def _claimable(now, lease):
+    # Pending jobs that are due, or running jobs whose worker died mid-flight
+    return or_(
+        and_(Job.status == 'En attente', Job.run_after <= now),
+        and_(Job.status == 'En cours', Job.started_at < now - timedelta(seconds=lease))
+    )
+
+
+def _claim_next(lease):
+    now = datetime.utcnow()
+    candidate = Job.query.filter(_claimable(now, lease)).order_by(Job.run_after, Job.id).first()
+    if not candidate:
+        db.session.rollback()
+        return None
+    # Conditional UPDATE so two workers never run the same job
+    claimed = Job.query.filter(Job.id == candidate.id, _claimable(now, lease)).update({
+        'status': 'En cours',
+        'started_at': now,
+        'attempts': Job.attempts + 1
+    }, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return None
+    return db.session.get(Job, candidate.id, populate_existing=True)
+
+
+def _run(job):
+    func, _ = _tasks.get(job.kind, (None, 0))
+    try:
+        if func is None:
+            raise ValueError(f"Unknown job kind: {job.kind}")
+        result = func(json.loads(job.payload or '{}'), job) or {}
+        job.artifact = result.pop('artifact', None)
+        job.result = json.dumps(result)
+        job.status = 'Terminé'
+        job.error = None
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(Job, job.id)
+        job.error = str(e)
+        if job.attempts < job.max_attempts:
+            # Exponential backoff: 5s, 10s, 20s, ...
+            job.status = 'En attente'
+            job.run_after = datetime.utcnow() + timedelta(seconds=5 * 2 ** (job.attempts - 1))
+        else:
+            job.status = 'Échec'
+            job.finished_at = datetime.utcnow()
+        db.session.commit()
+
+
+def purge_finished(days, batch_size=1000):
+    """Delete jobs finished or failed more than `days` days ago, and their
+    artifacts. Returns the number of jobs deleted."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    done = 0
+    while True:
+        batch = (db.session.query(Job.id, Job.artifact)
+                 .filter(Job.status.in_(('Terminé', 'Échec')), Job.finished_at < cutoff)
+                 .limit(batch_size).all())
+        if not batch:
+            return done
+        Job.query.filter(Job.id.in_([job_id for job_id, _ in batch])).delete(synchronize_session=False)
+        db.session.commit()
+        for _, artifact in batch:
+            if artifact:
+                try:
+                    os.remove(os.path.join(artifact_dir(), artifact))
+                except FileNotFoundError:
+                    pass
+        done += len(batch)
+
+
+def _purge_if_due(app):
+    # One worker of the process purges, once per interval
+    days = app.config['JOBS_RETENTION_DAYS']
+    if not days:
+        return
+    with _purge_lock:
+        now = datetime.utcnow()
+        if _purged_at[0] and now - _purged_at[0] < timedelta(seconds=app.config['JOBS_PURGE_INTERVAL']):
+            return
+        _purged_at[0] = now
+    purge_finished(days)
+
+
+def _worker_loop(app):
+    poll = app.config['JOBS_POLL_INTERVAL']
+    lease = app.config['JOBS_LEASE_SECONDS']
+    while True:
+        try:
+            with app.app_context():
+                _purge_if_due(app)
+                job = _claim_next(lease)
+                if job:
+                    _run(job)
+                    continue
+        except Exception as e:
+            app.logger.error(f"Job worker error: {e}")
+        _wakeup.wait(poll)
+        _wakeup.clear()
+
+
+def start_workers(app):
+    """Start the worker threads once per process."""
+    if _workers:
+        return
+    for i in range(app.config['JOBS_WORKERS']):
+        t = threading.Thread(target=_worker_loop, args=(app,), name=f"job-worker-{i}", daemon=True)
+        t.start()
+        _workers.append(t)
+
+
+def init_app(app):
+    app.config.setdefault('JOBS_WORKERS', min(4, os.cpu_count() or 1))
+    app.config.setdefault('JOBS_POLL_INTERVAL', 2.0)
+    app.config.setdefault('JOBS_LEASE_SECONDS', 900)
+    app.config.setdefault('JOBS_AUTOSTART', True)
+    app.config.setdefault('JOBS_RETENTION_DAYS', 30)
+    app.config.setdefault('JOBS_PURGE_INTERVAL', 3600)
+    artifact_dir(app)
+    if app.config['JOBS_AUTOSTART']:
+        start_workers(app)
+
+
+def run_pending(app, limit=None):
+    """Drain due jobs synchronously in the calling thread (CLI and scripts)."""
+    done = 0
+    with app.app_context():
+        while limit is None or done < limit:
+            job = _claim_next(app.config['JOBS_LEASE_SECONDS'])
+            if not job:
+                break
+            _run(job)
+            done += 1
+    return done
@@ -0,0 +1,88 @@
+"""Lightweight schema upgrades for existing databases.
+
+db.create_all() only creates missing tables. This adds the columns and
+indexes declared in models.py that an older database is still missing, so an
+existing biblionest.db keeps working after an upgrade. Indexes and unique
+constraints replaced by newer ones are listed below and dropped.
+"""
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateTable
+
+# (table, index) pairs superseded by the branch-led composite indexes
+RETIRED_INDEXES = [
+    ('Books', 'idx_books_isbn13'),
+    ('Books', 'ix_Books_title_key'),
+    ('Readers', 'ix_Readers_name_key'),
+    ('Readers', 'ix_Readers_surname_key'),
+    ('Loans', 'idx_loans_status_returned'),
+]
+# (table, columns) of column-level UNIQUE constraints no longer declared
+RETIRED_UNIQUES = [
+    ('Books', ['isbn']),
+]
+
+
+def _column_ddl(column, dialect):
+    ddl = f"{column.name} {column.type.compile(dialect=dialect)}"
+    default = column.server_default
+    if default is not None:
+        ddl += f" DEFAULT {default.arg.text if hasattr(default.arg, 'text') else repr(default.arg)}"
+    elif column.default is not None and column.default.is_scalar:
+        value = column.default.arg
+        ddl += f" DEFAULT {int(value) if isinstance(value, bool) else repr(value)}"
+    return ddl
+
+
+def _rebuild(conn, table, dialect):
+    """SQLite cannot drop a constraint: copy the rows into a table created
+    from the current model, then swap it in. Indexes are recreated after."""
+    preparer = dialect.identifier_preparer
+    old_name = preparer.format_table(table)
+    new_name = preparer.quote(f"{table.name}_new")
+    ddl = str(CreateTable(table).compile(dialect=dialect))
+    conn.execute(text(ddl.replace(f"TABLE {old_name}", f"TABLE {new_name}", 1)))
+    columns = ', '.join(preparer.quote(c.name) for c in table.columns)
+    conn.execute(text(f"INSERT INTO {new_name} ({columns}) SELECT {columns} FROM {old_name}"))
+    conn.execute(text(f"DROP TABLE {old_name}"))
+    conn.execute(text(f"ALTER TABLE {new_name} RENAME TO {old_name}"))
+
+
+def _retire(conn, db, engine):
+    inspector = inspect(conn)
+    existing_tables = set(inspector.get_table_names())
+    sqlite = engine.dialect.name == 'sqlite'
+    for table_name, index_name in RETIRED_INDEXES:
+        if table_name not in existing_tables:
+            continue
+        if index_name in {i['name'] for i in inspector.get_indexes(table_name)}:
+            conn.execute(text(f"DROP INDEX {index_name}" if sqlite else f"DROP INDEX {index_name} ON {table_name}"))
+    for table_name, columns in RETIRED_UNIQUES:
+        if table_name not in existing_tables:
+            continue
+        for constraint in inspector.get_unique_constraints(table_name):
+            if constraint['column_names'] != columns:
+                continue
+            if sqlite:
+                _rebuild(conn, db.metadata.tables[table_name], engine.dialect)
+            else:
+                conn.execute(text(f"ALTER TABLE {table_name} DROP INDEX {constraint['name']}"))
+
+
+def upgrade(db):
+    """Add missing columns and indexes. Safe to run on every start."""
+    engine = db.engine
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            present = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in present:
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {_column_ddl(column, engine.dialect)}"))
+    with engine.begin() as conn:
+        _retire(conn, db, engine)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
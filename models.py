@@ -4,6 +4,16 @@ from sqlalchemy import Enum
 
 db = SQLAlchemy()
 
+class Branch(db.Model):
+    # A library site; catalogue, readers and circulation are partitioned by
+    # branch_id and scoped to the admin's branch by branches.py
+    __tablename__ = 'Branches'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    code = db.Column(db.String(20), nullable=False, unique=True)
+    address = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Admin(db.Model):
     __tablename__ = 'Admins'
     id = db.Column(db.Integer, primary_key=True)
@@ -11,6 +21,8 @@ class Admin(db.Model):
     username = db.Column(db.String(50), unique=True, nullable=False)
     password_hash = db.Column(db.String(255), nullable=False)
     role = db.Column(db.String(50), nullable=False, default='Admin')
+    # Home branch; a Super Admin can switch to any other
+    branch_id = db.Column(db.Integer, db.ForeignKey('Branches.id'))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Author(db.Model):
@@ -19,21 +31,38 @@ class Author(db.Model):
     full_name = db.Column(db.String(150), nullable=False)
     birth_year = db.Column(db.Integer)
     nationality = db.Column(db.String(100))
+    # Normalized full_name (see names.normalize), unique
+    name_key = db.Column(db.String(150))
     books = db.relationship('Book', backref='author', lazy=True, cascade="all, delete-orphan")
 
+    __table_args__ = (
+        db.Index('idx_authors_name_key', 'name_key', unique=True),
+    )
+
 class Category(db.Model):
     __tablename__ = 'Categories'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
+    name_key = db.Column(db.String(100))
     books = db.relationship('Book', backref='category', lazy=True)
 
+    __table_args__ = (
+        db.Index('idx_categories_name_key', 'name_key', unique=True),
+    )
+
 class Book(db.Model):
     __tablename__ = 'Books'
     id = db.Column(db.Integer, primary_key=True)
+    branch_id = db.Column(db.Integer, db.ForeignKey('Branches.id'), nullable=False, server_default='1')
     title = db.Column(db.String(255), nullable=False)
+    # Normalized title for prefix search (typeahead.py)
+    title_key = db.Column(db.String(255))
     author_id = db.Column(db.Integer, db.ForeignKey('Authors.id'), nullable=False)
     category_id = db.Column(db.Integer, db.ForeignKey('Categories.id'))
-    isbn = db.Column(db.String(20), unique=True)
+    # Unique per branch: each branch holds its own record of a title
+    isbn = db.Column(db.String(20))
+    # Canonical ISBN-13 (digits only), maintained by isbn.to_isbn13()
+    isbn13 = db.Column(db.String(13))
     publication_year = db.Column(db.Integer)
     price = db.Column(db.Numeric(8, 2), default=0.00)
     total_copies = db.Column(db.Integer, nullable=False, default=1)
@@ -41,56 +70,141 @@ class Book(db.Model):
     image_path = db.Column(db.String(255))
     # status is a generated column in SQL, we can handle it as a property in Python
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Set when soft-deleted (SOFT_DELETE mode); hidden from queries by deletion.py
+    deleted_at = db.Column(db.DateTime)
+    # Optimistic locking: every UPDATE checks and bumps it
+    version = db.Column(db.Integer, nullable=False, server_default='1')
     
-    # Relationships with cascade delete
-    loans = db.relationship('Loan', backref='book', lazy=True, cascade="all, delete-orphan")
-    reservations = db.relationship('Reservation', backref='book', lazy=True, cascade="all, delete-orphan")
+    # Relationships with cascade delete. passive_deletes: deletion.py removes
+    # the children with set-based DELETEs instead of loading them one by one
+    loans = db.relationship('Loan', backref='book', lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    reservations = db.relationship('Reservation', backref='book', lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    copies = db.relationship('Copy', backref='book', lazy=True, cascade="all, delete-orphan", passive_deletes=True)
     
     __table_args__ = (
         db.CheckConstraint('available_copies <= total_copies', name='check_available_not_exceed_total'),
         db.CheckConstraint('available_copies >= 0', name='check_available_positive'),
+        db.Index('idx_books_branch_isbn13', 'branch_id', 'isbn13', unique=True),
+        db.Index('idx_books_branch_isbn', 'branch_id', 'isbn', unique=True),
+        db.Index('idx_books_branch_title_key', 'branch_id', 'title_key'),
+        # Covering index for the facet counts (catalog.py)
+        db.Index('idx_books_branch_facets', 'branch_id', 'category_id', 'author_id', 'publication_year',
+                 'available_copies', 'deleted_at'),
     )
+    __mapper_args__ = {'version_id_col': version}
 
     @property
     def status(self):
         return 'Disponible' if self.available_copies > 0 else 'Emprunté'
 
+class Copy(db.Model):
+    # One physical item of a book. Book.total_copies and available_copies are
+    # kept as aggregates of these rows by copies.py
+    __tablename__ = 'Copies'
+    id = db.Column(db.Integer, primary_key=True)
+    branch_id = db.Column(db.Integer, db.ForeignKey('Branches.id'), nullable=False, server_default='1')
+    book_id = db.Column(db.Integer, db.ForeignKey('Books.id', ondelete='CASCADE'), nullable=False)
+    # Printed label; generated from the id when not given (see copies.py)
+    barcode = db.Column(db.String(32))
+    condition = db.Column(Enum('Neuf', 'Bon', 'Usé', 'Abîmé'), nullable=False, default='Bon')
+    # Retiré: lost or discarded, no longer counted in total_copies
+    status = db.Column(Enum('Disponible', 'Prêté', 'Retiré'), nullable=False, default='Disponible')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('idx_copies_barcode', 'barcode', unique=True),
+        db.Index('idx_copies_book_status', 'book_id', 'status'),
+    )
+
 class Reader(db.Model):
     __tablename__ = 'Readers'
     id = db.Column(db.Integer, primary_key=True)
+    branch_id = db.Column(db.Integer, db.ForeignKey('Branches.id'), nullable=False, server_default='1')
     first_name = db.Column(db.String(100), nullable=False)
     last_name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(150), unique=True, nullable=False)
     phone = db.Column(db.String(20))
     registration_date = db.Column(db.Date, nullable=False, default=date.today)
     status = db.Column(Enum('Actif', 'Suspendu'), nullable=False, default='Actif')
-    loans = db.relationship('Loan', backref='reader', lazy=True, cascade="all, delete-orphan")
-    reservations = db.relationship('Reservation', backref='reader', lazy=True, cascade="all, delete-orphan")
-    penalties = db.relationship('Penalty', backref='reader', lazy=True, cascade="all, delete-orphan")
+    # Normalized "first last" / "last first" for prefix search (typeahead.py)
+    name_key = db.Column(db.String(201))
+    surname_key = db.Column(db.String(201))
+    deleted_at = db.Column(db.DateTime)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    loans = db.relationship('Loan', backref='reader', lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    reservations = db.relationship('Reservation', backref='reader', lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    penalties = db.relationship('Penalty', backref='reader', lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+
+    __table_args__ = (
+        db.Index('idx_readers_branch_name_key', 'branch_id', 'name_key'),
+        db.Index('idx_readers_branch_surname_key', 'branch_id', 'surname_key'),
+    )
+    __mapper_args__ = {'version_id_col': version}
 
 class Loan(db.Model):
     __tablename__ = 'Loans'
     id = db.Column(db.Integer, primary_key=True)
-    book_id = db.Column(db.Integer, db.ForeignKey('Books.id'), nullable=False)
-    reader_id = db.Column(db.Integer, db.ForeignKey('Readers.id'), nullable=False)
+    branch_id = db.Column(db.Integer, db.ForeignKey('Branches.id'), nullable=False, server_default='1')
+    book_id = db.Column(db.Integer, db.ForeignKey('Books.id', ondelete='RESTRICT'), nullable=False)
+    reader_id = db.Column(db.Integer, db.ForeignKey('Readers.id', ondelete='RESTRICT'), nullable=False)
+    # The item handed out
+    copy_id = db.Column(db.Integer, db.ForeignKey('Copies.id', ondelete='SET NULL'))
     loan_date = db.Column(db.Date, nullable=False, default=date.today)
     due_date = db.Column(db.Date, nullable=False)
     returned_at = db.Column(db.DateTime)
     status = db.Column(Enum('En cours', 'Retard', 'Terminé'), default='En cours')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
     # Relationship with cascade delete for penalties
     penalties = db.relationship('Penalty', backref='loan', lazy=True, cascade="all, delete-orphan")
+    copy = db.relationship('Copy')
+
+    __table_args__ = (
+        db.Index('idx_loans_branch_status_returned', 'branch_id', 'status', 'returned_at'),
+        db.Index('idx_loans_reader_book', 'reader_id', 'book_id'),
+        # Open loans by due date, for the reminder run across branches
+        db.Index('idx_loans_returned_due', 'returned_at', 'due_date'),
+        db.Index('idx_loans_copy', 'copy_id'),
+    )
+    __mapper_args__ = {'version_id_col': version}
+
+class LoanArchive(db.Model):
+    # Finished loans moved out of Loans by archive.py. Titles and names are
+    # copied so the history survives later book or reader deletions.
+    __tablename__ = 'LoansArchive'
+    id = db.Column(db.Integer, primary_key=True)
+    loan_id = db.Column(db.Integer, nullable=False, index=True)
+    branch_id = db.Column(db.Integer, nullable=False, server_default='1')
+    book_id = db.Column(db.Integer, nullable=False)
+    reader_id = db.Column(db.Integer, nullable=False, index=True)
+    copy_id = db.Column(db.Integer)
+    book_title = db.Column(db.String(255))
+    reader_name = db.Column(db.String(201))
+    loan_date = db.Column(db.Date, nullable=False)
+    due_date = db.Column(db.Date, nullable=False)
+    returned_at = db.Column(db.DateTime, index=True)
+    created_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('idx_archive_branch_returned', 'branch_id', 'returned_at'),
+    )
 
 class Reservation(db.Model):
     __tablename__ = 'Reservations'
     id = db.Column(db.Integer, primary_key=True)
-    book_id = db.Column(db.Integer, db.ForeignKey('Books.id'), nullable=False)
-    reader_id = db.Column(db.Integer, db.ForeignKey('Readers.id'), nullable=False)
+    branch_id = db.Column(db.Integer, db.ForeignKey('Branches.id'), nullable=False, server_default='1')
+    book_id = db.Column(db.Integer, db.ForeignKey('Books.id', ondelete='CASCADE'), nullable=False)
+    reader_id = db.Column(db.Integer, db.ForeignKey('Readers.id', ondelete='CASCADE'), nullable=False)
     reservation_date = db.Column(db.Date, nullable=False, default=date.today)
     expiry_date = db.Column(db.Date, nullable=False)
     status = db.Column(Enum('En attente', 'Terminée', 'Annulée', 'Active'), nullable=False, default='En attente')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('idx_reservations_branch_status', 'branch_id', 'status'),
+    )
+
 class PenaltyType(db.Model):
     __tablename__ = 'PenaltyTypes'
     id = db.Column(db.Integer, primary_key=True)
@@ -102,8 +216,10 @@ class PenaltyType(db.Model):
 class Penalty(db.Model):
     __tablename__ = 'Penalties'
     id = db.Column(db.Integer, primary_key=True)
-    reader_id = db.Column(db.Integer, db.ForeignKey('Readers.id'), nullable=False)
-    loan_id = db.Column(db.Integer, db.ForeignKey('Loans.id'))
+    branch_id = db.Column(db.Integer, db.ForeignKey('Branches.id'), nullable=False, server_default='1')
+    reader_id = db.Column(db.Integer, db.ForeignKey('Readers.id', ondelete='CASCADE'), nullable=False)
+    loan_id = db.Column(db.Integer, db.ForeignKey('Loans.id', ondelete='SET NULL'))
+    archived_loan_id = db.Column(db.Integer, db.ForeignKey('LoansArchive.id', ondelete='SET NULL'))
     penalty_type_id = db.Column(db.Integer, db.ForeignKey('PenaltyTypes.id'), nullable=False)
     reason = db.Column(db.Text, nullable=False)
     amount = db.Column(db.Numeric(10, 2), nullable=False)
@@ -112,13 +228,125 @@ class Penalty(db.Model):
     paid_at = db.Column(db.Date)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     penalty_type = db.relationship('PenaltyType', backref='penalties')
+    archived_loan = db.relationship('LoanArchive')
+
+    __table_args__ = (
+        db.Index('idx_penalties_branch_status', 'branch_id', 'status'),
+    )
 
 class Setting(db.Model):
     __tablename__ = 'Settings'
     id = db.Column(db.Integer, primary_key=True)
+    # One row per branch (see branches.settings)
+    branch_id = db.Column(db.Integer, db.ForeignKey('Branches.id'))
     library_name = db.Column(db.String(255), nullable=False, default='BiblioNest')
     contact_email = db.Column(db.String(255), nullable=False, default='contact@biblionest.com')
     default_loan_duration = db.Column(db.Integer, nullable=False, default=15)
     daily_penalty_amount = db.Column(db.Numeric(10, 2), nullable=False, default=5.00)
     deterioration_penalty_amount = db.Column(db.Numeric(10, 2), nullable=False, default=5.00)
     lost_book_penalty_amount = db.Column(db.Numeric(10, 2), nullable=False, default=20.00)
+    # Readers are reminded this many days before a due date (0: no reminder)
+    reminder_days = db.Column(db.Integer, nullable=False, default=2)
+
+    __table_args__ = (
+        db.Index('idx_settings_branch', 'branch_id', unique=True),
+    )
+
+class Notice(db.Model):
+    # One row per loan, notice kind and due date: a reader is never sent the
+    # same notice twice. loan_id has no foreign key so archived loans keep
+    # their history.
+    __tablename__ = 'Notices'
+    id = db.Column(db.Integer, primary_key=True)
+    branch_id = db.Column(db.Integer, nullable=False, server_default='1')
+    loan_id = db.Column(db.Integer, nullable=False)
+    reader_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(Enum('Rappel', 'Retard'), nullable=False)
+    due_date = db.Column(db.Date, nullable=False)
+    email = db.Column(db.String(255))
+    status = db.Column(Enum('En attente', 'Envoi', 'Envoyé', 'Échec'), nullable=False, default='En attente')
+    claim = db.Column(db.String(32))
+    claimed_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('idx_notices_loan_kind_due', 'loan_id', 'kind', 'due_date', unique=True),
+        db.Index('idx_notices_status', 'status'),
+    )
+
+class Job(db.Model):
+    __tablename__ = 'Jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text)
+    status = db.Column(Enum('En attente', 'En cours', 'Terminé', 'Échec'), nullable=False, default='En attente')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    result = db.Column(db.Text)
+    artifact = db.Column(db.String(255))
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('idx_jobs_status_run_after', 'status', 'run_after'),
+        db.Index('idx_jobs_status_finished_at', 'status', 'finished_at'),
+    )
+
+class BookNeighbour(db.Model):
+    # Top-k "readers also borrowed" list per book, see recommendations.py
+    __tablename__ = 'BookNeighbours'
+    book_id = db.Column(db.Integer, primary_key=True)
+    neighbour_id = db.Column(db.Integer, primary_key=True)
+    score = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('idx_neighbours_book_score', 'book_id', 'score'),
+    )
+
+class Popularity(db.Model):
+    # Borrow counters per branch, entity and period bucket, see popularity.py
+    __tablename__ = 'Popularity'
+    branch_id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(10), primary_key=True)
+    bucket = db.Column(db.String(7), primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True)
+    loans = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('idx_popularity_top', 'branch_id', 'entity', 'bucket', 'loans', 'entity_id'),
+    )
+
+class AuditEvent(db.Model):
+    # Append-only journal written in batches by audit.py
+    __tablename__ = 'AuditLog'
+    id = db.Column(db.Integer, primary_key=True)
+    at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    actor_id = db.Column(db.Integer)
+    entity = db.Column(db.String(50), nullable=False)
+    entity_id = db.Column(db.Integer)
+    action = db.Column(db.String(20), nullable=False)
+    changes = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('idx_audit_entity_time', 'entity', 'entity_id', 'at'),
+        db.Index('idx_audit_time', 'at'),
+    )
+
+class ChangeEvent(db.Model):
+    # Short-lived relay of live change events between processes, see events.py
+    __tablename__ = 'ChangeEvents'
+    id = db.Column(db.Integer, primary_key=True)
+    at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    branch_id = db.Column(db.Integer)
+    kind = db.Column(db.String(20), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+
+    __table_args__ = (
+        db.Index('idx_change_events_at', 'at'),
+    )
@@ -0,0 +1,165 @@
+"""Author and category dictionary: normalized keys, interning and autocomplete.
+
+Names are matched on a normalized key (case-folded, whitespace collapsed)
+stored in an indexed name_key column, so "Victor  Hugo" and "victor hugo"
+resolve to the same author. Known keys are interned in memory (checked with
+a primary-key probe on use, as another process may have merged the row), and
+a sorted word-prefix index answers the autocomplete endpoints without
+touching the database.
+"""
+import bisect
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db, Author, Category, Book
+
+# kind -> (model, display column)
+_MODELS = {
+    'author': (Author, 'full_name'),
+    'category': (Category, 'name'),
+}
+_lock = threading.Lock()
+_interned = {kind: {} for kind in _MODELS}
+_prefix = {kind: None for kind in _MODELS}
+_prefix_loaded_at = {kind: 0 for kind in _MODELS}
+
+# Other processes may add names; rebuild the prefix index after this long
+PREFIX_INDEX_TTL = 300
+
+
+def normalize(name):
+    return ' '.join((name or '').split()).casefold()
+
+
+def _entries(key, display, row_id):
+    # One entry per word so "hugo" also finds "Victor Hugo"
+    words = key.split(' ')
+    return [(' '.join(words[i:]), display, row_id) for i in range(len(words))]
+
+
+def _add_to_prefix(kind, key, display, row_id):
+    with _lock:
+        index = _prefix[kind]
+        if index is not None:
+            for entry in _entries(key, display, row_id):
+                bisect.insort(index, entry)
+
+
+def get_or_create(kind, name):
+    """Return the id for the author/category named `name`, creating it if needed."""
+    model, column = _MODELS[kind]
+    display = ' '.join((name or '').split())
+    key = normalize(name)
+    if not key:
+        raise ValueError("Nom vide")
+
+    row_id = _interned[kind].get(key)
+    # A primary-key probe: `flask dedupe-names`, run in another process, may
+    # have merged the row away since it was interned here
+    if row_id is not None and db.session.get(model, row_id) is not None:
+        return row_id
+    _interned[kind].pop(key, None)
+
+    row = model.query.filter_by(name_key=key).first()
+    if not row:
+        # A concurrent insert of the same name fails on the unique index
+        # and rolls back with the caller's transaction
+        row = model(**{column: display, 'name_key': key})
+        db.session.add(row)
+        db.session.flush()
+        # Only published once the surrounding transaction commits
+        db.session.info.setdefault('names_pending', []).append((kind, key, display, row.id))
+        return row.id
+    _interned[kind][key] = row.id
+    return row.id
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_pending(session):
+    if session.in_nested_transaction():
+        return
+    for kind, key, display, row_id in session.info.pop('names_pending', []):
+        _interned[kind][key] = row_id
+        _add_to_prefix(kind, key, display, row_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop('names_pending', None)
+
+
+def autocomplete(kind, prefix, limit=10):
+    """Names whose key, or one of its words, starts with `prefix`."""
+    key = normalize(prefix)
+    if not key:
+        return []
+    with _lock:
+        index = _prefix[kind]
+        if index is None or time.monotonic() - _prefix_loaded_at[kind] > PREFIX_INDEX_TTL:
+            model, column = _MODELS[kind]
+            index = []
+            for row_id, display, row_key in db.session.query(model.id, getattr(model, column), model.name_key):
+                index.extend(_entries(row_key or normalize(display), display, row_id))
+            index.sort()
+            _prefix[kind] = index
+            _prefix_loaded_at[kind] = time.monotonic()
+
+        results = []
+        seen = set()
+        for entry_key, display, row_id in index[bisect.bisect_left(index, (key,)):]:
+            if not entry_key.startswith(key) or len(results) >= limit:
+                break
+            if row_id not in seen:
+                seen.add(row_id)
+                results.append({'id': row_id, 'name': display})
+        return results
+
+
+def _reset(kind):
+    with _lock:
+        _interned[kind].clear()
+        _prefix[kind] = None
+
+
+def backfill():
+    """Fill name_key where missing. Rows whose key is already taken stay NULL
+    until merged by dedupe()."""
+    for kind, (model, column) in _MODELS.items():
+        taken = {k for (k,) in db.session.query(model.name_key).filter(model.name_key != None)}
+        for row in model.query.filter(model.name_key == None).order_by(model.id).all():
+            key = normalize(getattr(row, column))
+            if key and key not in taken:
+                row.name_key = key
+                taken.add(key)
+    db.session.commit()
+
+
+def dedupe():
+    """Merge authors/categories sharing a normalized name into the oldest row.
+    Returns {kind: merged count}."""
+    merged = {}
+    for kind, (model, column) in _MODELS.items():
+        groups = {}
+        for row in model.query.order_by(model.id).all():
+            groups.setdefault(normalize(getattr(row, column)), []).append(row)
+        count = 0
+        for key, rows in groups.items():
+            keeper, duplicates = rows[0], rows[1:]
+            if not duplicates:
+                continue
+            dup_ids = [r.id for r in duplicates]
+            fk = Book.author_id if kind == 'author' else Book.category_id
+            Book.query.filter(fk.in_(dup_ids)).update({fk: keeper.id, Book.version: Book.version + 1},
+                                                      synchronize_session=False)
+            for dup in duplicates:
+                db.session.expire(dup, ['books'])
+                db.session.delete(dup)
+            db.session.flush()
+            keeper.name_key = key
+            count += len(duplicates)
+        db.session.commit()
+        merged[kind] = count
+        _reset(kind)
+    return merged
@@ -0,0 +1,316 @@
+"""Due-date reminders and overdue notices emailed to readers.
+
+A run (`flask send-notices`, or the send_notices job) has two steps:
+
+queue()    one indexed query over open loans of every branch picks those due
+           in Setting.reminder_days days ('Rappel') and those overdue that
+           were never told about this due date ('Retard'), and records a
+           Notice row for each. The unique (loan, kind, due date) index
+           keeps a reader from being queued twice for the same notice.
+deliver()  claims the pending notices with a conditional UPDATE, so two runs
+           never send the same one, renders one message per reader and kind
+           from templates/emails/ and sends them over a single SMTP
+           connection, rate limited, committing the outcome every
+           NOTICES_BATCH_SIZE messages.
+
+A dropped connection or a 4xx answer is retried on a new connection; if the
+server stays unreachable the rest of the run is released for the next one.
+A 5xx answer or a refused address marks the notice 'Échec'. A claim is a
+lease of NOTICES_CLAIM_LEASE seconds, renewed at every batch commit: the
+notices of a run that died mid-send are claimed again by a later run once
+it has expired, and marked 'Échec' if they used up their attempts. A message
+sent just before such a crash can thus go out twice.
+
+To try it locally, start a debugging server that prints what it receives,
+`python -m smtpd -n -c DebuggingServer localhost:1025` (Python 3.11 and
+older) or `python -m aiosmtpd -n -l localhost:1025`, and set
+BIBLIONEST_SMTP_HOST=localhost BIBLIONEST_SMTP_PORT=1025.
+"""
+import smtplib
+import time
+import uuid
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from email.message import EmailMessage
+from email.utils import formataddr
+
+from flask import current_app
+from sqlalchemy import and_, or_, case, exists, insert
+from sqlalchemy.exc import IntegrityError
+from models import db, Branch, Loan, Notice
+import branches
+
+SUBJECTS = {
+    'Rappel': "Rappel : retour prévu le {due_date}",
+    'Retard': "Livre(s) en retard à rendre"
+}
+
+
+class PermanentFailure(Exception):
+    """The server refused the message for good (5xx, unknown address)."""
+
+
+class Mailer:
+    """One SMTP connection reused for the whole run, reopened when the server
+    drops it, sending at most SMTP_RATE messages per second."""
+
+    def __init__(self, config):
+        self.host = config['SMTP_HOST']
+        self.port = config['SMTP_PORT']
+        self.username = config['SMTP_USERNAME']
+        self.password = config['SMTP_PASSWORD']
+        self.starttls = config['SMTP_STARTTLS']
+        self.timeout = config['SMTP_TIMEOUT']
+        self.retries = config['SMTP_RETRIES']
+        self.interval = 1.0 / config['SMTP_RATE'] if config['SMTP_RATE'] else 0
+        self._smtp = None
+        self._last = 0
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            smtp.starttls()
+        if self.username:
+            smtp.login(self.username, self.password)
+        self._smtp = smtp
+
+    def send(self, message):
+        """Send one message. Raises PermanentFailure, or the last transient
+        error once SMTP_RETRIES reconnections failed."""
+        wait = self.interval - (time.monotonic() - self._last)
+        if wait > 0:
+            time.sleep(wait)
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                if self._smtp is None:
+                    self._connect()
+                self._smtp.send_message(message)
+                self._last = time.monotonic()
+                return
+            except smtplib.SMTPRecipientsRefused as e:
+                raise PermanentFailure(str(e))
+            except smtplib.SMTPResponseException as e:
+                if e.smtp_code >= 500:
+                    raise PermanentFailure(f"{e.smtp_code} {e.smtp_error!r}")
+                error = e
+            except (smtplib.SMTPException, OSError) as e:
+                error = e
+            self.close()
+            if attempt < self.retries:
+                time.sleep(min(30, 2 ** attempt))
+        raise error
+
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
+
+
+def _due_loans(today):
+    """(loan, kind) of the open loans owed a notice today, with reader and
+    book, in a single query on idx_loans_returned_due."""
+    reminders = []
+    for (branch_id,) in db.session.query(Branch.id):
+        days = branches.settings(branch_id).reminder_days
+        if days:
+            reminders.append(and_(Loan.branch_id == branch_id, Loan.due_date == today + timedelta(days=days)))
+    kind = case((Loan.due_date < today, 'Retard'), else_='Rappel')
+    already = exists().where(Notice.loan_id == Loan.id, Notice.kind == kind, Notice.due_date == Loan.due_date)
+    return (
+        db.session.query(Loan, kind)
+        .execution_options(all_branches=True)
+        .join(Loan.reader)
+        .join(Loan.book)
+        .options(db.contains_eager(Loan.reader), db.contains_eager(Loan.book))
+        .filter(Loan.returned_at == None, or_(Loan.due_date < today, *reminders), ~already)
+        .all()
+    )
+
+
+def due(today=None):
+    """What queue() would record today, without writing anything.
+    Returns {'Rappel': n, 'Retard': n}."""
+    counts = {'Rappel': 0, 'Retard': 0}
+    for _, kind in _due_loans(today or date.today()):
+        counts[kind] += 1
+    return counts
+
+
+def queue(today=None):
+    """Record the notices owed today. Returns {'Rappel': n, 'Retard': n}."""
+    today = today or date.today()
+    rows = []
+    counts = {'Rappel': 0, 'Retard': 0}
+    for loan, kind in _due_loans(today):
+        email = (loan.reader.email or '').strip()
+        valid = '@' in email
+        rows.append({
+            'branch_id': loan.branch_id,
+            'loan_id': loan.id,
+            'reader_id': loan.reader_id,
+            'kind': kind,
+            'due_date': loan.due_date,
+            'email': email or None,
+            'status': 'En attente' if valid else 'Échec',
+            'error': None if valid else "Pas d'adresse email valide"
+        })
+        counts[kind] += 1
+    if not rows:
+        return counts
+    try:
+        db.session.execute(insert(Notice), rows)
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent run queued the same notices first
+        db.session.rollback()
+        return {'Rappel': 0, 'Retard': 0}
+    return counts
+
+
+def _claim(max_attempts, lease):
+    token = uuid.uuid4().hex
+    now = datetime.utcnow()
+    # Claims from before claimed_at existed have none and count as expired
+    stale = and_(Notice.status == 'Envoi',
+                 or_(Notice.claimed_at == None, Notice.claimed_at < now - timedelta(seconds=lease)))
+    # Left behind by a run that died with nothing left to retry
+    Notice.query.filter(stale, Notice.attempts >= max_attempts).update({
+        Notice.status: 'Échec',
+        Notice.error: "Envoi interrompu"
+    }, synchronize_session=False)
+    Notice.query.filter(or_(Notice.status == 'En attente', stale), Notice.attempts < max_attempts).update({
+        Notice.status: 'Envoi',
+        Notice.claim: token,
+        Notice.claimed_at: now,
+        Notice.attempts: Notice.attempts + 1
+    }, synchronize_session=False)
+    db.session.commit()
+    return token, Notice.query.filter(Notice.claim == token, Notice.status == 'Envoi') \
+        .order_by(Notice.branch_id, Notice.reader_id, Notice.kind, Notice.due_date).all()
+
+
+def _messages(notices):
+    """Group claimed notices into one message per reader and kind. Yields
+    (message or None, notices); None when every loan was returned since."""
+    loans = {loan.id: loan for loan in
+             Loan.query.execution_options(all_branches=True, include_deleted=True)
+             .options(db.joinedload(Loan.book), db.joinedload(Loan.reader))
+             .filter(Loan.id.in_({n.loan_id for n in notices})).all()}
+    templates = {kind: current_app.jinja_env.get_template(f"emails/{kind.lower()}.txt") for kind in SUBJECTS}
+    groups = OrderedDict()
+    for notice in notices:
+        groups.setdefault((notice.branch_id, notice.reader_id, notice.kind, notice.email), []).append(notice)
+    sender = current_app.config['SMTP_SENDER']
+    today = date.today()
+    for (branch_id, _, kind, email), group in groups.items():
+        open_loans = [loans[n.loan_id] for n in group
+                      if n.loan_id in loans and loans[n.loan_id].returned_at is None]
+        if not open_loans:
+            yield None, group
+            continue
+        setting = branches.settings(branch_id)
+        reader = open_loans[0].reader
+        message = EmailMessage()
+        message['From'] = formataddr((setting.library_name, sender or setting.contact_email))
+        message['Reply-To'] = setting.contact_email
+        message['To'] = email
+        message['Subject'] = SUBJECTS[kind].format(due_date=min(l.due_date for l in open_loans).strftime('%d/%m/%Y'))
+        message.set_content(templates[kind].render(
+            reader=reader,
+            library=setting,
+            loans=[{
+                'title': loan.book.title if loan.book else 'N/A',
+                'due_date': loan.due_date.strftime('%d/%m/%Y'),
+                'days_late': max(0, (today - loan.due_date).days)
+            } for loan in open_loans]
+        ))
+        yield message, group
+
+
+def deliver():
+    """Send the pending notices. Returns counts per outcome."""
+    config = current_app.config
+    token, notices = _claim(config['NOTICES_MAX_ATTEMPTS'], config['NOTICES_CLAIM_LEASE'])
+    counts = {'envoyé': 0, 'échec': 0, 'annulé': 0, 'reporté': 0}
+    if not notices:
+        return counts
+    mailer = Mailer(config)
+    sent_in_batch = 0
+    try:
+        for message, group in _messages(notices):
+            if message is None:
+                for notice in group:
+                    notice.status = 'Échec'
+                    notice.error = "Prêt rendu avant l'envoi"
+                counts['annulé'] += len(group)
+                continue
+            try:
+                mailer.send(message)
+            except PermanentFailure as e:
+                for notice in group:
+                    notice.status = 'Échec'
+                    notice.error = str(e)
+                counts['échec'] += len(group)
+            except (smtplib.SMTPException, OSError) as e:
+                # Server unreachable: stop, everything not sent yet waits for the next run
+                for notice in group:
+                    notice.error = str(e)
+                    if notice.attempts < config['NOTICES_MAX_ATTEMPTS']:
+                        notice.status = 'En attente'
+                        counts['reporté'] += 1
+                    else:
+                        notice.status = 'Échec'
+                        counts['échec'] += 1
+                db.session.commit()
+                counts['reporté'] += Notice.query.filter(Notice.claim == token, Notice.status == 'Envoi').update({
+                    Notice.status: 'En attente',
+                    Notice.attempts: Notice.attempts - 1
+                }, synchronize_session=False)
+                break
+            else:
+                now = datetime.utcnow()
+                for notice in group:
+                    notice.status = 'Envoyé'
+                    notice.sent_at = now
+                    notice.error = None
+                counts['envoyé'] += len(group)
+            sent_in_batch += 1
+            if sent_in_batch >= config['NOTICES_BATCH_SIZE']:
+                # Renew the lease on what this run still holds
+                Notice.query.filter(Notice.claim == token, Notice.status == 'Envoi') \
+                    .update({Notice.claimed_at: datetime.utcnow()}, synchronize_session=False)
+                db.session.commit()
+                sent_in_batch = 0
+    finally:
+        db.session.commit()
+        mailer.close()
+    return counts
+
+
+def run(today=None):
+    """Queue today's notices and send everything pending."""
+    if not current_app.config['SMTP_HOST']:
+        raise RuntimeError("Serveur SMTP non configuré (BIBLIONEST_SMTP_HOST)")
+    queued = queue(today)
+    return dict(deliver(), rappels=queued['Rappel'], retards=queued['Retard'])
+
+
+def init_app(app):
+    app.config.setdefault('SMTP_HOST', None)
+    app.config.setdefault('SMTP_PORT', 25)
+    app.config.setdefault('SMTP_USERNAME', None)
+    app.config.setdefault('SMTP_PASSWORD', None)
+    app.config.setdefault('SMTP_STARTTLS', False)
+    app.config.setdefault('SMTP_TIMEOUT', 30)
+    # Sender address; defaults to the branch's contact_email
+    app.config.setdefault('SMTP_SENDER', None)
+    app.config.setdefault('SMTP_RATE', 5)
+    app.config.setdefault('SMTP_RETRIES', 3)
+    app.config.setdefault('NOTICES_BATCH_SIZE', 50)
+    app.config.setdefault('NOTICES_MAX_ATTEMPTS', 3)
+    # Seconds after which the notices of a silent run can be claimed again
+    app.config.setdefault('NOTICES_CLAIM_LEASE', 3600)
@@ -0,0 +1,122 @@
+"""Borrow counters behind the "most borrowed" lists.
+
+Every loan adds one to twelve Popularity rows: its book, the book's author
+and category, and its reader, each in the loan month's bucket ('2026-10'),
+the loan year's ('2026') and the lifetime one ('all'). The increment is a
+single upsert in the transaction that creates the loan, so the counters
+never disagree with the loans that were committed. A top-N list is then one
+backward read of idx_popularity_top (branch, entity, bucket, loans)
+instead of a GROUP BY over the loan history.
+
+Deleting a loan or changing its book, reader or date moves its counts as
+well. Loans removed with a reader or a book (hard delete) keep theirs
+until `flask rebuild-popularity` recomputes everything from the live and
+archived loans.
+"""
+from collections import Counter
+from datetime import date
+
+from sqlalchemy import select, union_all
+from sqlalchemy.dialects import mysql, sqlite
+from models import db, Book, Author, Category, Reader, Loan, LoanArchive, Popularity
+import branches
+
+PERIODS = ('month', 'year', 'all')
+# entity -> (model, label column)
+ENTITIES = {
+    'book': (Book, Book.title),
+    'author': (Author, Author.full_name),
+    'category': (Category, Category.name),
+    'reader': (Reader, Reader.first_name + ' ' + Reader.last_name),
+}
+
+
+def bucket(period, day=None):
+    day = day or date.today()
+    if period == 'month':
+        return day.strftime('%Y-%m')
+    if period == 'year':
+        return day.strftime('%Y')
+    return 'all'
+
+
+def _rows(branch_id, book_id, author_id, category_id, reader_id, loan_date):
+    ids = {'book': book_id, 'author': author_id, 'category': category_id, 'reader': reader_id}
+    return [(branch_id, entity, bucket(period, loan_date), entity_id)
+            for entity, entity_id in ids.items() if entity_id
+            for period in PERIODS]
+
+
+def _upsert(rows):
+    """Add rows of {key columns..., 'loans': n} to the counters."""
+    table = Popularity.__table__
+    if db.session.get_bind().dialect.name == 'mysql':
+        stmt = mysql.insert(table).values(rows)
+        stmt = stmt.on_duplicate_key_update(loans=table.c.loans + stmt.inserted.loans)
+    else:
+        stmt = sqlite.insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[c.name for c in table.primary_key.columns],
+            set_={'loans': table.c.loans + stmt.excluded.loans})
+    db.session.execute(stmt)
+
+
+def count(branch_id, book_id, reader_id, loan_date, delta=1):
+    """Count (or with delta=-1 uncount) one loan. The caller commits."""
+    author_id, category_id = db.session.query(Book.author_id, Book.category_id) \
+        .execution_options(all_branches=True, include_deleted=True) \
+        .filter(Book.id == book_id).one()
+    _upsert([
+        {'branch_id': b, 'entity': entity, 'bucket': key, 'entity_id': entity_id, 'loans': delta}
+        for b, entity, key, entity_id in _rows(branch_id, book_id, author_id, category_id, reader_id, loan_date)
+    ])
+
+
+def record(loan, delta=1):
+    """Count a flushed loan."""
+    count(loan.branch_id, loan.book_id, loan.reader_id, loan.loan_date, delta)
+
+
+def top(entity, period='month', n=20, day=None, branch_id=None):
+    """[(id, label, loans)] of the n most borrowed entities of the period."""
+    model, label = ENTITIES[entity]
+    branch_id = branch_id or branches.current_id() or branches.MAIN_BRANCH_ID
+    return (
+        db.session.query(Popularity.entity_id, label, Popularity.loans)
+        .join(model, model.id == Popularity.entity_id)
+        .filter(Popularity.branch_id == branch_id, Popularity.entity == entity,
+                Popularity.bucket == bucket(period, day), Popularity.loans > 0)
+        .order_by(Popularity.loans.desc(), Popularity.entity_id.desc())
+        .limit(n)
+        .all()
+    )
+
+
+def rebuild():
+    """Recompute every counter from the loan history. Returns the number of
+    counters written."""
+    books = {book_id: (author_id, category_id) for book_id, author_id, category_id in
+             db.session.query(Book.id, Book.author_id, Book.category_id)
+             .execution_options(all_branches=True, include_deleted=True)}
+    history = union_all(
+        select(Loan.branch_id, Loan.book_id, Loan.reader_id, Loan.loan_date),
+        select(LoanArchive.branch_id, LoanArchive.book_id, LoanArchive.reader_id, LoanArchive.loan_date)
+    )
+    counts = Counter()
+    for branch_id, book_id, reader_id, loan_date in db.session.execute(history.execution_options(yield_per=5000)):
+        author_id, category_id = books.get(book_id, (None, None))
+        counts.update(_rows(branch_id, book_id, author_id, category_id, reader_id, loan_date))
+    Popularity.query.delete()
+    rows = [{'branch_id': b, 'entity': entity, 'bucket': key, 'entity_id': entity_id, 'loans': n}
+            for (b, entity, key, entity_id), n in counts.items()]
+    for start in range(0, len(rows), 5000):
+        db.session.execute(Popularity.__table__.insert(), rows[start:start + 5000])
+    db.session.commit()
+    return len(rows)
+
+
+def backfill():
+    """Build the counters once for a database that has loans but none yet."""
+    if db.session.query(Popularity.entity_id).first() or not db.session.query(Loan.id).first():
+        return 0
+    return rebuild()
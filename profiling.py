@@ -0,0 +1,239 @@
+"""On-demand profiling of single requests.
+
+A request is profiled when it carries a signed X-BiblioNest-Profile header
+(`flask profile-token` prints one; valid PROFILE_TOKEN_MAX_AGE seconds), when
+a Super Admin adds ?_profile=1 to a URL, or at random with probability
+PROFILE_SAMPLE_RATE. The view then runs under cProfile and every SQL
+statement is timed through the engine's cursor events.
+
+Each profile is saved under instance/profiles as a JSON summary (hot
+functions, statements grouped by text) next to the raw .prof file for
+snakeviz or pstats. The directory is a ring buffer of the last PROFILE_KEEP
+profiles. Only one request per process is profiled at a time: cProfile
+cannot run two profilers at once, and the others are served as usual.
+"""
+import cProfile
+import json
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from flask import g, request, session, current_app, has_app_context
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from sqlalchemy import event
+from models import db
+
+HEADER = 'X-BiblioNest-Profile'
+PARAM = '_profile'
+# The live event stream never ends, the viewer would only profile itself
+SKIPPED_ENDPOINTS = {'static', 'serve_asset', 'event_stream', 'list_profiles', 'show_profile', 'download_profile'}
+
+_lock = threading.Lock()
+
+
+def _serializer(app):
+    return URLSafeTimedSerializer(app.secret_key, salt='profile')
+
+
+def make_token(app):
+    return _serializer(app).dumps('profile')
+
+
+def _token_valid(token):
+    try:
+        _serializer(current_app).loads(token, max_age=current_app.config['PROFILE_TOKEN_MAX_AGE'])
+        return True
+    except BadSignature:
+        return False
+
+
+def _reason():
+    if request.endpoint in SKIPPED_ENDPOINTS:
+        return None
+    token = request.headers.get(HEADER)
+    if token:
+        return 'en-tête' if _token_valid(token) else None
+    if request.args.get(PARAM) and session.get('user_role') == 'Super Admin':
+        return 'paramètre'
+    rate = current_app.config['PROFILE_SAMPLE_RATE']
+    if rate and random.random() < rate:
+        return 'échantillon'
+    return None
+
+
+def _start():
+    reason = _reason()
+    if not reason or not _lock.acquire(blocking=False):
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler (a debugger, coverage) is active in this process
+        _lock.release()
+        return
+    g._profile = {
+        'id': uuid.uuid4().hex[:12],
+        'reason': reason,
+        'profiler': profiler,
+        'queries': [],
+        'started': time.perf_counter(),
+        'status': None
+    }
+
+
+def _tag_response(response):
+    profile = g.get('_profile')
+    if profile:
+        profile['status'] = response.status_code
+        response.headers['X-BiblioNest-Profile-Id'] = profile['id']
+    return response
+
+
+def _finish(exc):
+    profile = g.pop('_profile', None)
+    if not profile:
+        return
+    profile['profiler'].disable()
+    _lock.release()
+    duration = time.perf_counter() - profile['started']
+    try:
+        _save(profile, duration, exc)
+    except OSError as e:
+        current_app.logger.warning("Profil non enregistré : %s", e)
+
+
+def _before_cursor(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and g.get('_profile'):
+        conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+
+def _after_cursor(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and g.get('_profile') and conn.info.get('profile_started'):
+        elapsed = time.perf_counter() - conn.info['profile_started'].pop()
+        queries = g._profile['queries']
+        if len(queries) < current_app.config['PROFILE_MAX_QUERIES']:
+            queries.append((statement, elapsed))
+
+
+def _function_name(key):
+    filename, line, name = key
+    if filename == '~':
+        return name
+    for marker in ('site-packages' + os.sep, current_app.root_path + os.sep):
+        if marker in filename:
+            filename = filename.split(marker, 1)[1]
+            break
+    return f"{filename}:{line}({name})"
+
+
+def _summary(profile, duration, exc):
+    stats = pstats.Stats(profile['profiler']).stats
+    top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:current_app.config['PROFILE_TOP_FUNCTIONS']]
+    grouped = {}
+    for statement, elapsed in profile['queries']:
+        entry = grouped.setdefault(statement, {'statement': statement, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        entry['count'] += 1
+        entry['total_ms'] += elapsed * 1000
+        entry['max_ms'] = max(entry['max_ms'], elapsed * 1000)
+    queries = sorted(grouped.values(), key=lambda q: q['total_ms'], reverse=True)
+    return {
+        'id': profile['id'],
+        'at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'status': profile['status'] or 500,
+        'error': str(exc) if exc else None,
+        'reason': profile['reason'],
+        'user': session.get('user_name'),
+        'duration_ms': round(duration * 1000, 2),
+        'sql_ms': round(sum(q['total_ms'] for q in queries), 2),
+        'query_count': len(profile['queries']),
+        'functions': [{
+            'function': _function_name(key),
+            'calls': f"{nc}/{cc}" if nc != cc else str(nc),
+            'tottime_ms': round(tt * 1000, 2),
+            'cumtime_ms': round(ct * 1000, 2)
+        } for key, (cc, nc, tt, ct, _) in top],
+        'queries': [dict(q, total_ms=round(q['total_ms'], 2), max_ms=round(q['max_ms'], 2)) for q in queries]
+    }
+
+
+def profile_dir(app=None):
+    app = app or current_app
+    path = os.path.join(app.instance_path, 'profiles')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _save(profile, duration, exc):
+    path = profile_dir()
+    # Names sort by capture time, the oldest go first
+    stem = os.path.join(path, f"{time.time_ns()}-{profile['id']}")
+    profile['profiler'].dump_stats(stem + '.prof')
+    with open(stem + '.json.tmp', 'w', encoding='utf-8') as f:
+        json.dump(_summary(profile, duration, exc), f)
+    os.replace(stem + '.json.tmp', stem + '.json')
+    summaries = sorted(name for name in os.listdir(path) if name.endswith('.json'))
+    for name in summaries[:-current_app.config['PROFILE_KEEP']]:
+        for suffix in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(path, name[:-len('.json')] + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def _find(profile_id):
+    path = profile_dir()
+    for name in os.listdir(path):
+        if name.endswith(f"-{profile_id}.json"):
+            return os.path.join(path, name)
+    return None
+
+
+def list_profiles():
+    """Summaries of the stored profiles, newest first, without details."""
+    path = profile_dir()
+    result = []
+    for name in sorted((n for n in os.listdir(path) if n.endswith('.json')), reverse=True):
+        try:
+            with open(os.path.join(path, name), encoding='utf-8') as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            continue
+        result.append({k: v for k, v in summary.items() if k not in ('functions', 'queries')})
+    return result
+
+
+def load(profile_id):
+    found = _find(profile_id)
+    if not found:
+        return None
+    with open(found, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def raw_path(profile_id):
+    """Path of the .prof file of a profile, or None."""
+    found = _find(profile_id)
+    prof = found[:-len('.json')] + '.prof' if found else None
+    return prof if prof and os.path.exists(prof) else None
+
+
+def init_app(app):
+    app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+    app.config.setdefault('PROFILE_TOKEN_MAX_AGE', 3600)
+    app.config.setdefault('PROFILE_KEEP', 50)
+    app.config.setdefault('PROFILE_TOP_FUNCTIONS', 40)
+    app.config.setdefault('PROFILE_MAX_QUERIES', 1000)
+    app.before_request(_start)
+    app.after_request(_tag_response)
+    app.teardown_request(_finish)
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', _before_cursor)
+        event.listen(db.engine, 'after_cursor_execute', _after_cursor)
@@ -0,0 +1,154 @@
+""""Readers also borrowed" recommendations.
+
+Two books co-occur when the same reader borrowed both; the score of a pair is
+the number of such readers. rebuild() computes the sparse co-occurrence
+counts from the whole loan history (live and archived) in one pass and keeps
+only the top-k neighbours per book in BookNeighbours. record_loan() applies
+a new loan incrementally with one upsert (score = score + 1, so concurrent
+job workers never lose a bump), then trims the lists it pushed past k.
+Pairs that were outside a book's top-k re-enter with the new loan's
+contribution as their score, so lists drift from the exact top-k until the
+next rebuild.
+"""
+from collections import defaultdict, Counter
+from heapq import nlargest
+
+from sqlalchemy import select, union_all, func
+from sqlalchemy.dialects import mysql, sqlite
+from models import db, Loan, LoanArchive, Book, Author, BookNeighbour
+
+# Neighbours kept per book
+TOP_K = 10
+# Most recent distinct books per reader taken into account; bounds the
+# quadratic pair count for very heavy readers
+MAX_HISTORY = 200
+
+
+def _history_query():
+    # Distinct books per reader, least recently borrowed first. Archived
+    # loans keep the id of the live loan, so ids order both tables
+    live = select(Loan.reader_id, Loan.book_id, Loan.id.label('loan_id'))
+    archived = select(LoanArchive.reader_id, LoanArchive.book_id, LoanArchive.loan_id)
+    history = union_all(live, archived).subquery()
+    last = func.max(history.c.loan_id)
+    return (select(history.c.reader_id, history.c.book_id)
+            .group_by(history.c.reader_id, history.c.book_id)
+            .order_by(history.c.reader_id, last))
+
+
+def rebuild(top_k=TOP_K):
+    """Recompute every neighbour list. Returns the number of books indexed."""
+    counts = defaultdict(Counter)
+
+    def flush_reader(books):
+        books = books[-MAX_HISTORY:]
+        for a in books:
+            row = counts[a]
+            for b in books:
+                if a != b:
+                    row[b] += 1
+
+    current_reader, books = None, []
+    for reader_id, book_id in db.session.execute(_history_query().execution_options(yield_per=5000)):
+        if reader_id != current_reader:
+            if books:
+                flush_reader(books)
+            current_reader, books = reader_id, []
+        books.append(book_id)
+    if books:
+        flush_reader(books)
+
+    BookNeighbour.query.delete()
+    rows = []
+    for book_id, row in counts.items():
+        for neighbour_id, score in nlargest(top_k, row.items(), key=lambda item: (item[1], -item[0])):
+            rows.append({'book_id': book_id, 'neighbour_id': neighbour_id, 'score': score})
+        if len(rows) >= 5000:
+            db.session.execute(BookNeighbour.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(BookNeighbour.__table__.insert(), rows)
+    db.session.commit()
+    return len(counts)
+
+
+def _bump(pairs):
+    """Add one to the score of each (book, neighbour) pair, entering the
+    missing ones, in a single statement."""
+    table = BookNeighbour.__table__
+    rows = [{'book_id': book_id, 'neighbour_id': neighbour_id, 'score': 1} for book_id, neighbour_id in pairs]
+    if db.session.get_bind().dialect.name == 'mysql':
+        stmt = mysql.insert(table).values(rows)
+        stmt = stmt.on_duplicate_key_update(score=table.c.score + 1)
+    else:
+        stmt = sqlite.insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(index_elements=['book_id', 'neighbour_id'],
+                                          set_={'score': table.c.score + 1})
+    db.session.execute(stmt)
+
+
+def _trim(book_ids, top_k):
+    """Drop the neighbours ranked past top_k of the given books."""
+    crowded = [book_id for (book_id,) in
+               db.session.query(BookNeighbour.book_id)
+               .filter(BookNeighbour.book_id.in_(book_ids))
+               .group_by(BookNeighbour.book_id)
+               .having(func.count() > top_k)]
+    for book_id in crowded:
+        extra = [n for (n,) in db.session.query(BookNeighbour.neighbour_id)
+                 .filter(BookNeighbour.book_id == book_id)
+                 .order_by(BookNeighbour.score.desc(), BookNeighbour.neighbour_id)
+                 .offset(top_k)]
+        BookNeighbour.query.filter(BookNeighbour.book_id == book_id,
+                                   BookNeighbour.neighbour_id.in_(extra)).delete(synchronize_session=False)
+
+
+def record_loan(loan_id, reader_id, book_id, top_k=TOP_K):
+    """Account for a new loan. Only loans older than it are paired, so
+    replaying queued loans out of order never counts a pair twice. Commits."""
+    earlier = db.session.execute(
+        select(func.count()).select_from(
+            union_all(
+                select(Loan.id).where(Loan.reader_id == reader_id, Loan.book_id == book_id, Loan.id < loan_id),
+                select(LoanArchive.id).where(LoanArchive.reader_id == reader_id, LoanArchive.book_id == book_id,
+                                             LoanArchive.loan_id < loan_id)
+            ).subquery()
+        )
+    ).scalar()
+    # A repeat borrow adds no new co-occurrence
+    if earlier:
+        return 0
+    history = union_all(
+        select(Loan.book_id, Loan.id.label('loan_id'))
+        .where(Loan.reader_id == reader_id, Loan.book_id != book_id, Loan.id < loan_id),
+        select(LoanArchive.book_id, LoanArchive.loan_id)
+        .where(LoanArchive.reader_id == reader_id, LoanArchive.book_id != book_id, LoanArchive.loan_id < loan_id)
+    ).subquery()
+    # The most recent MAX_HISTORY distinct books
+    others = [
+        b for (b,) in db.session.execute(
+            select(history.c.book_id)
+            .group_by(history.c.book_id)
+            .order_by(func.max(history.c.loan_id).desc())
+            .limit(MAX_HISTORY)
+        )
+    ]
+    if not others:
+        return 0
+    _bump([(book_id, other) for other in others] + [(other, book_id) for other in others])
+    _trim([book_id] + others, top_k)
+    db.session.commit()
+    return len(others)
+
+
+def similar_books(book_id, limit=TOP_K):
+    """Neighbours of a book, best first, in one indexed read."""
+    return (
+        db.session.query(Book, Author.full_name, BookNeighbour.score)
+        .join(Book, Book.id == BookNeighbour.neighbour_id)
+        .outerjoin(Author, Author.id == Book.author_id)
+        .filter(BookNeighbour.book_id == book_id)
+        .order_by(BookNeighbour.score.desc(), BookNeighbour.neighbour_id)
+        .limit(limit)
+        .all()
+    )
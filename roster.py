@@ -0,0 +1,235 @@
+"""Bulk reader import and export (CSV, or XLSX when openpyxl is installed).
+
+Imports stream the file row by row: each chunk of CHUNK_SIZE rows is
+validated, its emails are looked up in one query, and existing readers are
+updated while new ones are inserted, in one transaction per chunk. Every row
+gets a line in a result CSV (created / updated / error and why). Exports
+stream readers with yield_per in the same columns, so a file can be exported,
+edited and imported back.
+"""
+import csv
+import io
+import re
+from datetime import date, datetime
+
+from models import db, Reader
+import branches
+import typeahead
+
+try:
+    import openpyxl
+except ImportError:  # CSV only without it
+    openpyxl = None
+
+CHUNK_SIZE = 500
+COLUMNS = ['first_name', 'last_name', 'email', 'phone', 'status', 'registration_date']
+STATUSES = ('Actif', 'Suspendu')
+RESULT_COLUMNS = ['ligne', 'email', 'résultat', 'message']
+
+_EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+def _csv_rows(stream):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    header_line = text.readline()
+    # Excel in a French locale saves with ';'
+    delimiter = ';' if header_line.count(';') > header_line.count(',') else ','
+    header = next(csv.reader([header_line], delimiter=delimiter), [])
+    keys = [h.strip().lower() for h in header]
+    for values in csv.reader(text, delimiter=delimiter):
+        if any(v.strip() for v in values):
+            yield dict(zip(keys, values))
+        else:
+            yield None
+
+
+def _xlsx_rows(stream):
+    if openpyxl is None:
+        raise ValueError("Le format XLSX nécessite openpyxl")
+    workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        keys = [str(h or '').strip().lower() for h in next(rows, [])]
+        for values in rows:
+            if any(v not in (None, '') for v in values):
+                yield dict(zip(keys, values))
+            else:
+                yield None
+    finally:
+        workbook.close()
+
+
+def read_rows(stream, fmt):
+    """Yield one dict per data row (None for blank rows) from a binary stream."""
+    if fmt == 'xlsx':
+        return _xlsx_rows(stream)
+    if fmt == 'csv':
+        return _csv_rows(stream)
+    raise ValueError(f"Format non supporté : {fmt}")
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        # Phone numbers typed into a spreadsheet come back as floats
+        value = int(value)
+    return str(value).strip()
+
+
+def validate(row):
+    """Return (clean values, None) or (None, error message)."""
+    values = {key: _text(row.get(key)) for key in COLUMNS}
+    if not values['first_name'] or not values['last_name']:
+        return None, 'Prénom et nom obligatoires'
+    if len(values['first_name']) > 100 or len(values['last_name']) > 100:
+        return None, 'Nom trop long (100 caractères max)'
+    if not _EMAIL_RE.match(values['email']) or len(values['email']) > 150:
+        return None, 'Email invalide'
+    if len(values['phone']) > 20:
+        return None, 'Téléphone trop long (20 caractères max)'
+    values['status'] = values['status'] or 'Actif'
+    if values['status'] not in STATUSES:
+        return None, f"Statut inconnu : {values['status']}"
+    raw_date = row.get('registration_date')
+    if isinstance(raw_date, datetime):
+        values['registration_date'] = raw_date.date()
+    elif isinstance(raw_date, date):
+        values['registration_date'] = raw_date
+    elif values['registration_date']:
+        try:
+            values['registration_date'] = datetime.strptime(values['registration_date'][:10], '%Y-%m-%d').date()
+        except ValueError:
+            return None, "Date d'inscription invalide (AAAA-MM-JJ)"
+    else:
+        values['registration_date'] = None
+    return values, None
+
+
+def _apply(reader, values):
+    reader.first_name = values['first_name']
+    reader.last_name = values['last_name']
+    reader.name_key, reader.surname_key = typeahead.reader_keys(values['first_name'], values['last_name'])
+    reader.phone = values['phone'] or None
+    reader.status = values['status']
+    if values['registration_date']:
+        reader.registration_date = values['registration_date']
+
+
+def _upsert(batch):
+    """batch: [(line, values)]. Returns [(line, email, result, message)]."""
+    emails = {values['email'] for _, values in batch}
+    # Emails are unique across branches: look in all of them
+    existing = {r.email: r for r in Reader.query.execution_options(all_branches=True, include_deleted=True)
+                .filter(Reader.email.in_(emails)).all()}
+    branch_id = branches.current_id() or branches.MAIN_BRANCH_ID
+    results = []
+    for line, values in batch:
+        reader = existing.get(values['email'])
+        if reader and reader.branch_id not in (None, branch_id):
+            results.append((line, values['email'], 'erreur', 'Email déjà inscrit dans une autre agence'))
+            continue
+        if reader and reader.deleted_at:
+            results.append((line, values['email'], 'erreur', 'Lecteur supprimé, à restaurer'))
+            continue
+        if reader:
+            outcome = 'mis à jour' if reader.id else 'fusionné'
+        else:
+            # Later rows with the same email update this one
+            reader = existing[values['email']] = Reader(email=values['email'])
+            db.session.add(reader)
+            outcome = 'créé'
+        _apply(reader, values)
+        results.append((line, values['email'], outcome, ''))
+    return results
+
+
+def _write_chunk(batch):
+    try:
+        results = _upsert(batch)
+        db.session.commit()
+        return results
+    except Exception:
+        db.session.rollback()
+    # Another writer got in first; redo row by row to pin the failure
+    results = []
+    for line, values in batch:
+        try:
+            results.extend(_upsert([(line, values)]))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            results.append((line, values['email'], 'erreur', str(getattr(e, 'orig', None) or e)))
+    return results
+
+
+def import_rows(rows, result_file, chunk_size=CHUNK_SIZE):
+    """Import parsed rows, writing one result line per row to `result_file`
+    (a text stream). Returns counts per result."""
+    writer = csv.writer(result_file)
+    writer.writerow(RESULT_COLUMNS)
+    counts = {'créé': 0, 'mis à jour': 0, 'fusionné': 0, 'erreur': 0}
+    batch, rejected = [], []
+
+    def flush():
+        results = _write_chunk(batch) if batch else []
+        # Keep the result file in source order
+        for line, email, outcome, message in sorted(results + rejected):
+            counts[outcome] += 1
+            writer.writerow([line, email, outcome, message])
+        batch.clear()
+        rejected.clear()
+
+    # Line 1 is the header
+    for line, row in enumerate(rows, start=2):
+        if row is None:
+            continue
+        values, error = validate(row)
+        if error:
+            rejected.append((line, _text(row.get('email')), 'erreur', error))
+        else:
+            batch.append((line, values))
+        if len(batch) + len(rejected) >= chunk_size:
+            flush()
+    flush()
+    return counts
+
+
+def import_file(path, result_path, fmt=None):
+    fmt = fmt or path.rsplit('.', 1)[-1].lower()
+    with open(path, 'rb') as source, open(result_path, 'w', newline='', encoding='utf-8-sig') as result:
+        return import_rows(read_rows(source, fmt), result)
+
+
+def _export_query():
+    return (db.session.query(*(getattr(Reader, c) for c in COLUMNS))
+            .order_by(Reader.id)
+            .execution_options(yield_per=1000))
+
+
+def iter_csv():
+    """Yield the reader roster as CSV text, a block of rows at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(COLUMNS)
+    for i, row in enumerate(_export_query(), start=1):
+        writer.writerow([v.isoformat() if isinstance(v, date) else (v or '') for v in row])
+        if i % 1000 == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def write_xlsx(path):
+    """Write the roster to an XLSX file with openpyxl's write-only mode,
+    which keeps memory flat whatever the row count."""
+    if openpyxl is None:
+        raise ValueError("Le format XLSX nécessite openpyxl")
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet('Lecteurs')
+    sheet.append(COLUMNS)
+    for row in _export_query():
+        sheet.append(list(row))
+    workbook.save(path)
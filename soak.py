@@ -0,0 +1,364 @@
+"""Soak test of the circulation desk: how many desks can work at once.
+
+Each virtual librarian is a thread replaying the desk workflows through the
+HTTP API: list fetches, lending (some back-dated so they come back late),
+returns, reservations, converting reservations into loans and paying
+penalties. A desk reads the list first and acts on a random row, as the
+pages do, so desks collide on the same loans and titles like real ones.
+
+Desks run in-process through the Flask test client, or against a running
+server (`flask serve`, any number of workers) with a base URL. The run
+works in a new branch seeded with its own books and readers; the command
+must see the same database as the server (BIBLIONEST_DATABASE_URL) since
+seeding and the final invariant checks go through the ORM. Run it on a
+copy of production data, the branch and its rows are left in place.
+"""
+import http.cookiejar
+import json
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date, timedelta
+
+from sqlalchemy import func, case
+from models import db, Admin, Book, Reader, Loan, Penalty, Copy
+import branches
+import copies
+import names
+import typeahead
+
+# Relative weight of each workflow in a desk's mix
+DEFAULT_MIX = {
+    'fetch': 30,
+    'add_loan': 25,
+    'return_loan': 20,
+    'add_reservation': 10,
+    'convert_reservation': 10,
+    'pay_penalty': 5
+}
+LISTS = ['/api/prets', '/api/livres', '/api/reservations', '/api/penalites', '/api/lecteurs']
+# Share of loans entered with a past due date, so their return is late
+LATE_SHARE = 0.3
+LATE_PENALTY_TYPE_ID = 1
+
+
+class LocalDesk:
+    """A desk calling the app in-process, logged in as a Super Admin."""
+
+    def __init__(self, app, admin_id, branch_id):
+        self.client = app.test_client()
+        with self.client.session_transaction() as s:
+            s['user_id'] = admin_id
+            s['user_name'] = 'soak'
+            s['user_role'] = 'Super Admin'
+            s['branch_id'] = branch_id
+
+    def call(self, method, path, json_body=None, form=None):
+        response = self.client.open(path, method=method, json=json_body, data=form)
+        return response.status_code, response.get_data()
+
+
+class HttpDesk:
+    """A desk calling a running server, with its own login session."""
+
+    def __init__(self, base_url, username, password, branch_id, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.call('POST', '/login', form={'username': username, 'password': password})
+        status, body = self.call('POST', '/api/branches/switch', form={'branch_id': branch_id})
+        if status != 200:
+            raise RuntimeError(f"Connexion impossible ({status}) : vérifiez l'utilisateur Super Admin")
+
+    def call(self, method, path, json_body=None, form=None):
+        headers = {}
+        data = None
+        if json_body is not None:
+            data = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif form is not None:
+            data = urllib.parse.urlencode(form).encode()
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+def classify(status, body):
+    """Outcome class of a response: 'ok' or a short error label."""
+    if status == 409:
+        return 'conflit de version'
+    if status >= 400:
+        return f'http {status}'
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        # Redirected to the login page
+        return 'réponse non JSON'
+    if isinstance(payload, dict) and payload.get('success') is False:
+        error = str(payload.get('error') or '')
+        # Database errors come back as "(sqlite3.OperationalError) ..."
+        match = re.match(r'\(([\w.]+)\)', error)
+        if match:
+            return f'erreur base : {match.group(1)}'
+        return f'refus : {error[:60]}'
+    return 'ok'
+
+
+class Recorder:
+    """Latency and outcome of every call, shared by the desks."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.outcomes = {}
+
+    def add(self, label, seconds, outcome):
+        with self.lock:
+            self.latencies.setdefault(label, []).append(seconds)
+            counts = self.outcomes.setdefault(label, {})
+            counts[outcome] = counts.get(outcome, 0) + 1
+
+
+def _percentile(values, p):
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class VirtualLibrarian:
+    def __init__(self, desk, recorder, rng):
+        self.desk = desk
+        self.recorder = recorder
+        self.rng = rng
+
+    def _call(self, label, method, path, json_body=None, form=None):
+        started = time.perf_counter()
+        try:
+            status, body = self.desk.call(method, path, json_body, form)
+            outcome = classify(status, body)
+        except Exception as e:
+            body, outcome = None, f'exception : {type(e).__name__}'
+        self.recorder.add(label, time.perf_counter() - started, outcome)
+        if outcome != 'ok':
+            return None
+        return json.loads(body)
+
+    def _list(self, path):
+        return self._call(f'GET {path}', 'GET', path) or []
+
+    def fetch(self):
+        self._list(self.rng.choice(LISTS))
+
+    def add_loan(self):
+        options = self._call('GET /api/prets?action=fetch_options', 'GET', '/api/prets?action=fetch_options')
+        if not options or not options['books'] or not options['readers']:
+            return
+        payload = {
+            'book_id': self.rng.choice(options['books'])['id'],
+            'reader_id': self.rng.choice(options['readers'])['id']
+        }
+        if self.rng.random() < LATE_SHARE:
+            loan_date = date.today() - timedelta(days=self.rng.randint(20, 40))
+            payload['loan_date'] = loan_date.isoformat()
+            payload['due_date'] = (loan_date + timedelta(days=15)).isoformat()
+        self._call('add_loan', 'POST', '/api/prets/add', json_body=payload)
+
+    def return_loan(self):
+        loans = [l for l in self._list('/api/prets') if l['status'] != 'Terminé']
+        if loans:
+            loan = self.rng.choice(loans)
+            self._call('return_loan', 'POST', '/api/prets/return', form={'id': loan['id'], 'version': loan['version']})
+
+    def add_reservation(self):
+        books = [b for b in self._list('/api/livres') if b['available_copies'] <= 0]
+        readers = self._list('/api/lecteurs')
+        if books and readers:
+            self._call('add_reservation', 'POST', '/api/reservations/add', json_body={
+                'book_id': self.rng.choice(books)['id'],
+                'reader_id': self.rng.choice(readers)['id']
+            })
+
+    def convert_reservation(self):
+        waiting = [r for r in self._list('/api/reservations') if r['status'] in ('En attente', 'Active')]
+        if waiting:
+            self._call('convert_reservation', 'POST', '/api/reservations/convert',
+                       form={'id': self.rng.choice(waiting)['id']})
+
+    def pay_penalty(self):
+        unpaid = [p for p in self._list('/api/penalites') if p['status'] == 'Impayé']
+        if unpaid:
+            self._call('pay_penalty', 'POST', '/api/penalites/pay', form={'id': self.rng.choice(unpaid)['id']})
+
+    def run(self, mix, deadline):
+        names = list(mix)
+        weights = [mix[n] for n in names]
+        while time.monotonic() < deadline:
+            getattr(self, self.rng.choices(names, weights)[0])()
+
+
+def seed(book_count, reader_count, rng):
+    """Create the run's branch with books of 1 to 3 copies (few, so desks
+    compete for them) and active readers. Returns the branch id."""
+    stamp = time.strftime('%Y%m%d%H%M%S')
+    branch = branches.create_branch(f'Soak {stamp}', f'SOAK{stamp}')
+    db.session.flush()
+    author_id = names.get_or_create('author', 'Soak')
+    category_id = names.get_or_create('category', 'Soak')
+    for i in range(book_count):
+        count = rng.randint(1, 3)
+        book = Book(
+            branch_id=branch.id, title=f'Soak {stamp} {i}', title_key=typeahead.book_key(f'Soak {stamp} {i}'),
+            author_id=author_id, category_id=category_id, price=10,
+            total_copies=count, available_copies=count
+        )
+        db.session.add(book)
+        db.session.flush()
+        copies.create(book, count)
+    for i in range(reader_count):
+        name_key, surname_key = typeahead.reader_keys(f'Lecteur{i}', f'Soak{stamp}')
+        db.session.add(Reader(
+            branch_id=branch.id, first_name=f'Lecteur{i}', last_name=f'Soak{stamp}',
+            name_key=name_key, surname_key=surname_key,
+            email=f'soak{stamp}.{i}@example.invalid', status='Actif'
+        ))
+    db.session.commit()
+    return branch.id
+
+
+def check_invariants(branch_id):
+    """Stock and penalty invariants of a branch. Returns a list of
+    violations, empty when everything holds."""
+    violations = []
+    open_loans = dict(db.session.query(Loan.book_id, func.count(Loan.id))
+                      .execution_options(all_branches=True)
+                      .filter(Loan.branch_id == branch_id, Loan.returned_at == None)
+                      .group_by(Loan.book_id).all())
+    shelves = {book_id: (shelf or 0, lent or 0, kept or 0) for book_id, shelf, lent, kept in
+               db.session.query(Copy.book_id,
+                                func.sum(case((Copy.status == 'Disponible', 1), else_=0)),
+                                func.sum(case((Copy.status == 'Prêté', 1), else_=0)),
+                                func.sum(case((Copy.status != 'Retiré', 1), else_=0)))
+               .execution_options(all_branches=True)
+               .filter(Copy.branch_id == branch_id)
+               .group_by(Copy.book_id)}
+    books = Book.query.execution_options(all_branches=True, include_deleted=True) \
+        .filter(Book.branch_id == branch_id).all()
+    for book in books:
+        expected = book.total_copies - open_loans.get(book.id, 0)
+        if book.available_copies < 0:
+            violations.append(f"Livre {book.id} : stock négatif ({book.available_copies})")
+        if book.available_copies != expected:
+            violations.append(f"Livre {book.id} : {book.available_copies} disponible(s), "
+                              f"{expected} attendu(s) ({book.total_copies} - {open_loans.get(book.id, 0)} prêt(s) en cours)")
+        shelf, lent, kept = shelves.get(book.id, (0, 0, 0))
+        if (book.available_copies, book.total_copies) != (shelf, kept):
+            violations.append(f"Livre {book.id} : compteurs {book.available_copies}/{book.total_copies}, "
+                              f"exemplaires {shelf}/{kept}")
+        if lent != open_loans.get(book.id, 0):
+            violations.append(f"Livre {book.id} : {lent} exemplaire(s) prêté(s) pour "
+                              f"{open_loans.get(book.id, 0)} prêt(s) en cours")
+    double_lent = db.session.query(Loan.copy_id).execution_options(all_branches=True) \
+        .filter(Loan.branch_id == branch_id, Loan.returned_at == None, Loan.copy_id != None) \
+        .group_by(Loan.copy_id).having(func.count(Loan.id) > 1).count()
+    if double_lent:
+        violations.append(f"{double_lent} exemplaire(s) prêté(s) à plusieurs lecteurs")
+    late_penalties = dict(db.session.query(Penalty.loan_id, func.count(Penalty.id))
+                          .execution_options(all_branches=True)
+                          .filter(Penalty.branch_id == branch_id, Penalty.penalty_type_id == LATE_PENALTY_TYPE_ID)
+                          .group_by(Penalty.loan_id).all())
+    returned = Loan.query.execution_options(all_branches=True) \
+        .filter(Loan.branch_id == branch_id, Loan.returned_at != None).all()
+    for loan in returned:
+        late = loan.returned_at.date() > loan.due_date
+        count = late_penalties.get(loan.id, 0)
+        if count != (1 if late else 0):
+            violations.append(f"Prêt {loan.id} : {count} pénalité(s) de retard pour un retour "
+                              f"{'en retard' if late else 'à temps'}")
+    return violations
+
+
+def run(app, desks=8, duration=60, base_url=None, username=None, password=None,
+        book_count=40, reader_count=60, mix=None, seed_value=None):
+    """Seed a branch, run the desks for `duration` seconds and check the
+    invariants. Returns the report as a dict."""
+    rng = random.Random(seed_value)
+    mix = mix or DEFAULT_MIX
+    with app.app_context():
+        branch_id = seed(book_count, reader_count, rng)
+        admin = Admin.query.filter_by(role='Super Admin').first()
+        admin_id = admin.id if admin else None
+    if base_url:
+        clients = [HttpDesk(base_url, username, password, branch_id) for _ in range(desks)]
+    else:
+        clients = [LocalDesk(app, admin_id, branch_id) for _ in range(desks)]
+    recorder = Recorder()
+    librarians = [VirtualLibrarian(client, recorder, random.Random(rng.random())) for client in clients]
+    started = time.monotonic()
+    deadline = started + duration
+    threads = [threading.Thread(target=l.run, args=(mix, deadline), name=f'desk-{i}', daemon=True)
+               for i, l in enumerate(librarians)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    with app.app_context():
+        violations = check_invariants(branch_id)
+    return report(recorder, elapsed, desks, branch_id, violations)
+
+
+def report(recorder, elapsed, desks, branch_id, violations):
+    calls = {}
+    errors = {}
+    total = 0
+    for label, values in sorted(recorder.latencies.items()):
+        values = sorted(values)
+        outcomes = recorder.outcomes[label]
+        total += len(values)
+        calls[label] = {
+            'count': len(values),
+            'ok': outcomes.get('ok', 0),
+            'p50_ms': round(_percentile(values, 50) * 1000, 1),
+            'p95_ms': round(_percentile(values, 95) * 1000, 1),
+            'p99_ms': round(_percentile(values, 99) * 1000, 1),
+            'max_ms': round(values[-1] * 1000, 1)
+        }
+        for outcome, count in outcomes.items():
+            if outcome != 'ok':
+                errors[outcome] = errors.get(outcome, 0) + count
+    return {
+        'branch_id': branch_id,
+        'desks': desks,
+        'seconds': round(elapsed, 1),
+        'requests': total,
+        'throughput': round(total / elapsed, 1) if elapsed else 0,
+        'calls': calls,
+        'errors': dict(sorted(errors.items(), key=lambda item: -item[1])),
+        'violations': violations
+    }
+
+
+def format_report(result):
+    """The report as printable lines."""
+    lines = [
+        f"{result['desks']} poste(s), {result['seconds']} s, {result['requests']} requête(s), "
+        f"{result['throughput']} requête(s)/s — agence {result['branch_id']}",
+        f"{'appel':<42} {'nb':>6} {'ok':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}"
+    ]
+    for label, c in result['calls'].items():
+        lines.append(f"{label:<42} {c['count']:>6} {c['ok']:>6} {c['p50_ms']:>8} "
+                     f"{c['p95_ms']:>8} {c['p99_ms']:>8} {c['max_ms']:>8}")
+    lines.append("Erreurs :" if result['errors'] else "Aucune erreur")
+    for outcome, count in result['errors'].items():
+        lines.append(f"  {count:>6}  {outcome}")
+    if result['violations']:
+        lines.append(f"{len(result['violations'])} invariant(s) violé(s) :")
+        lines.extend(f"  {v}" for v in result['violations'])
+    else:
+        lines.append("Invariants respectés : stock cohérent, aucune valeur négative, une pénalité par retour en retard")
+    return lines
@@ -32,3 +32,100 @@ overlay.addEventListener("click", () => {
     sidebar.classList.add("close");
     localStorage.setItem('sidebarStatus', 'close');
 });
+
+// 4. Background Jobs: poll /api/jobs/<id> until the job is finished
+window.waitForJob = function (jobId, interval = 1000) {
+    return new Promise((resolve, reject) => {
+        const poll = () => {
+            fetch(`/api/jobs/${jobId}`)
+                .then(res => res.json())
+                .then(job => {
+                    if (job.status === 'Terminé') resolve(job);
+                    else if (job.status === 'Échec') reject(new Error(job.error || 'Tâche échouée'));
+                    else setTimeout(poll, interval);
+                })
+                .catch(reject);
+        };
+        poll();
+    });
+};
+
+// 5. Typeahead: refill a <select> from /api/typeahead/* as the user types in a search input
+window.attachTypeahead = function (input, select, url, toOption, placeholder) {
+    let timer = null;
+    const load = () => {
+        const sep = url.includes('?') ? '&' : '?';
+        return fetch(`${url}${sep}q=${encodeURIComponent(input.value.trim())}&limit=20`)
+            .then(res => res.json())
+            .then(items => {
+                select.innerHTML = `<option value="">${placeholder}</option>`;
+                items.forEach(item => select.appendChild(toOption(item)));
+                if (input.value.trim() && items.length === 1) {
+                    select.value = items[0].id;
+                    select.dispatchEvent(new Event('change'));
+                }
+            })
+            .catch(err => console.error('Error loading data:', err));
+    };
+    input.addEventListener('input', () => {
+        clearTimeout(timer);
+        timer = setTimeout(load, 200);
+    });
+    return {
+        reset: () => {
+            input.value = '';
+            return load();
+        },
+        // Make sure an already chosen value (edit mode) is present and selected
+        choose: (id, label) => {
+            if (!select.querySelector(`option[value="${id}"]`)) {
+                select.appendChild(toOption({ id: id, title: label, full_name: label }));
+            }
+            select.value = id;
+        }
+    };
+};
+
+// 6. Branch switcher (Super Admin): every page and API call is scoped to the chosen branch
+const branchSelect = document.getElementById('branchSelect');
+if (branchSelect) {
+    branchSelect.addEventListener('change', () => {
+        const formData = new FormData();
+        formData.append('branch_id', branchSelect.value);
+        fetch('/api/branches/switch', { method: 'POST', body: formData })
+            .then(res => res.json())
+            .then(result => {
+                if (result.success) window.location.reload();
+                else alert(result.error);
+            })
+            .catch(err => console.error('Error switching branch:', err));
+    });
+}
+
+// 7. Live updates: /api/events pushes change events ({type, action, data}) made at other desks.
+// handlers maps an event type ('book', 'loan', 'reservation') to a callback.
+window.listenForChanges = function (handlers) {
+    if (!window.EventSource) return;
+    const connect = () => {
+        const source = new EventSource('/api/events');
+        Object.keys(handlers).forEach(type => {
+            source.addEventListener(type, e => handlers[type](JSON.parse(e.data)));
+        });
+        source.onerror = () => {
+            // EventSource reconnects by itself unless the server refused the stream
+            if (source.readyState === EventSource.CLOSED) setTimeout(connect, 30000);
+        };
+    };
+    connect();
+};
+
+// Apply a change event to an array of rows keyed by id; returns the new array
+window.applyChange = function (rows, event) {
+    const others = (rows || []).filter(row => row.id !== event.data.id);
+    if (event.action === 'delete') return others;
+    const index = (rows || []).findIndex(row => row.id === event.data.id);
+    if (index === -1) return [event.data, ...others];
+    const updated = rows.slice();
+    updated[index] = event.data;
+    return updated;
+};
@@ -9,6 +9,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     let isEditMode = false;
     let currentReaderId = null;
+    let currentVersion = null;
 
     // 1. Fetch Readers from Server
     const readersGrid = document.getElementById('readersGrid');
@@ -98,6 +99,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (isEditMode && reader) {
             modalTitle.textContent = "Modifier le Lecteur";
             currentReaderId = reader.id;
+            currentVersion = reader.version;
             document.getElementById('firstName').value = reader.first_name;
             document.getElementById('lastName').value = reader.last_name;
             document.getElementById('email').value = reader.email;
@@ -115,6 +117,29 @@ document.addEventListener('DOMContentLoaded', () => {
         openModal('add');
     });
 
+    // Bulk import: the server processes the file as a job and returns a per-row result file
+    const importFile = document.getElementById('importFile');
+    document.getElementById('importReadersBtn').addEventListener('click', () => importFile.click());
+    importFile.addEventListener('change', () => {
+        if (!importFile.files.length) return;
+        const formData = new FormData();
+        formData.append('file', importFile.files[0]);
+        importFile.value = '';
+        fetch('/api/lecteurs/import', { method: 'POST', body: formData })
+            .then(res => res.json())
+            .then(result => {
+                if (!result.success) throw new Error(result.error);
+                return waitForJob(result.job_id);
+            })
+            .then(job => {
+                const r = job.result;
+                alert(`Import terminé : ${r['créé']} créé(s), ${r['mis à jour'] + r['fusionné']} mis à jour, ${r['erreur']} erreur(s).`);
+                window.location.href = `/api/jobs/${job.id}/download`;
+                fetchReaders();
+            })
+            .catch(err => alert("Erreur: " + err.message));
+    });
+
     closeModal.addEventListener('click', () => {
         modal.style.display = "none";
     });
@@ -141,6 +166,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (isEditMode) {
             url = '/api/lecteurs/edit';
             readerData.id = currentReaderId;
+            readerData.version = currentVersion;
         }
 
         fetch(url, {
@@ -154,6 +180,14 @@ document.addEventListener('DOMContentLoaded', () => {
                     modal.style.display = "none";
                     readerForm.reset();
                     fetchReaders(); // Reload list
+                } else if (result.conflict && result.current) {
+                    // Someone saved first: show their values, a new save overwrites them
+                    alert(result.error);
+                    openModal('edit', result.current);
+                    fetchReaders();
+                } else if (result.deleted_id) {
+                    // The email belongs to a deleted reader: bring it back
+                    if (confirm(`${result.error}\nRestaurer ce lecteur ?`)) restoreDeleted(result.deleted_id);
                 } else {
                     alert("Erreur: " + (result.error || 'Erreur inconnue'));
                 }
@@ -161,6 +195,22 @@ document.addEventListener('DOMContentLoaded', () => {
             .catch(err => console.error(err));
     });
 
+    function restoreDeleted(id) {
+        const formData = new FormData();
+        formData.append('id', id);
+        fetch('/api/lecteurs/restore', { method: 'POST', body: formData })
+            .then(response => response.json())
+            .then(result => {
+                if (result.success) {
+                    modal.style.display = "none";
+                    fetchReaders();
+                } else {
+                    alert("Erreur: " + (result.error || 'Erreur inconnue'));
+                }
+            })
+            .catch(err => console.error(err));
+    }
+
     // 5. Global Actions
     window.deleteReader = function (id) {
         if (confirm('Êtes-vous sûr de vouloir supprimer ce lecteur ?')) {
@@ -9,11 +9,28 @@ document.addEventListener('DOMContentLoaded', () => {
 
     let isEditMode = false;
     let currentBookId = null;
+    let currentVersion = null;
+
+    // 1. Fetch one page of the books under the search and the facets
+    const facetsPanel = document.getElementById('facetsPanel');
+    const pageInfo = document.getElementById('pageInfo');
+    const prevPage = document.getElementById('prevPage');
+    const nextPage = document.getElementById('nextPage');
+    const facetTitles = { category: 'Catégorie', author: 'Auteur', decade: 'Décennie', available: 'Disponibilité' };
+    const perPage = 48;
+    const selected = { category: [], author: [], decade: [], available: [] };
+    let page = 1;
+    let total = 0;
 
-    // 1. Fetch Books from Server
     function fetchBooks() {
-        booksGrid.innerHTML = "<div style='grid-column: 1/-1; text-align:center'>Chargement...</div>";
-        fetch('/api/livres?action=fetch')
+        const params = new URLSearchParams({ page: page, per_page: perPage });
+        const q = searchInput.value.trim();
+        if (q) params.append('q', q);
+        Object.entries(selected).forEach(([facet, values]) => values.forEach(v => params.append(facet, v)));
+        // Both availability values ticked means no filter
+        if (selected.available.length !== 1) params.delete('available');
+
+        fetch(`/api/livres/facettes?${params}`)
             .then(response => {
                 if (!response.ok) {
                     return response.text().then(text => { throw new Error(text || response.statusText) });
@@ -22,8 +39,16 @@ document.addEventListener('DOMContentLoaded', () => {
             })
             .then(data => {
                 if (data.error) throw new Error(data.error);
-                window.allBooks = data; // Store globally for search filtering
-                renderBooks(data);
+                window.allBooks = data.items; // The current page
+                total = data.total;
+                // Filters can shrink the result below the page we are on
+                if (data.items.length === 0 && page > 1) {
+                    page = Math.max(1, Math.ceil(total / perPage));
+                    return fetchBooks();
+                }
+                renderBooks(data.items);
+                renderFacets(data.facets);
+                renderPager();
             })
             .catch(error => {
                 console.error('Error:', error);
@@ -31,6 +56,49 @@ document.addEventListener('DOMContentLoaded', () => {
             });
     }
 
+    function renderFacets(facets) {
+        facetsPanel.innerHTML = '';
+        Object.entries(facetTitles).forEach(([facet, title]) => {
+            const entries = (facets[facet] || []).filter(e => e.value !== null);
+            if (!entries.length) return;
+            const group = document.createElement('div');
+            group.className = 'facet-group';
+            group.innerHTML = `<h4>${title}</h4>`;
+            entries.forEach(entry => {
+                const label = document.createElement('label');
+                label.innerHTML = `
+                    <input type="checkbox" ${selected[facet].includes(entry.value) ? 'checked' : ''}>
+                    <span>${entry.label}</span>
+                    <span class="facet-count">${entry.count}</span>
+                `;
+                label.querySelector('input').addEventListener('change', (e) => {
+                    selected[facet] = e.target.checked
+                        ? [...selected[facet], entry.value]
+                        : selected[facet].filter(v => v !== entry.value);
+                    page = 1;
+                    fetchBooks();
+                });
+                group.appendChild(label);
+            });
+            facetsPanel.appendChild(group);
+        });
+    }
+
+    function renderPager() {
+        const pages = Math.max(1, Math.ceil(total / perPage));
+        pageInfo.textContent = `Page ${page} / ${pages} (${total} livre${total > 1 ? 's' : ''})`;
+        prevPage.disabled = page <= 1;
+        nextPage.disabled = page >= pages;
+    }
+
+    prevPage.addEventListener('click', () => {
+        if (page > 1) { page--; fetchBooks(); }
+    });
+    nextPage.addEventListener('click', () => {
+        page++;
+        fetchBooks();
+    });
+
     function renderBooks(data) {
         booksGrid.innerHTML = "";
         if (data.length === 0) {
@@ -72,6 +140,7 @@ document.addEventListener('DOMContentLoaded', () => {
                         <div class="tooltip-item"><strong>Catégorie:</strong> ${book.category_name || book.category || 'Non classé'}</div>
                         <div class="tooltip-item"><strong>ISBN:</strong> ${book.isbn || '-'}</div>
                         <div class="tooltip-item"><strong>Prix:</strong> ${book.price ? book.price + ' DH' : '-'}</div>
+                        ${book.next_available_date ? `<div class="tooltip-item"><strong>Retour prévu:</strong> ${new Date(book.next_available_date).toLocaleDateString('fr-FR')}</div>` : ''}
                     </div>
                 </div>
                 
@@ -84,6 +153,12 @@ document.addEventListener('DOMContentLoaded', () => {
                     <button class="action-btn-pill btn-delete" onclick="window.deleteBook(${book.id})">
                         <i class='bx bxs-trash'></i> Supprimer
                     </button>
+                    <button class="action-btn-pill btn-edit" onclick="window.showCopies(${book.id})">
+                        <i class='bx bx-barcode'></i> Exemplaires
+                    </button>
+                    ${otherBranches.length && book.available_copies > 0 ? `<button class="action-btn-pill btn-edit" onclick="window.transferBook(${book.id})">
+                        <i class='bx bx-transfer'></i> Transférer
+                    </button>` : ''}
                 </div>
             `;
             booksGrid.appendChild(card);
@@ -93,17 +168,24 @@ document.addEventListener('DOMContentLoaded', () => {
     // Initial Load
     fetchBooks();
 
-    // 2. Search Functionality
-    searchInput.addEventListener('input', (e) => {
-        const term = e.target.value.toLowerCase();
-        if (!window.allBooks) return;
-
-        const filtered = window.allBooks.filter(book =>
-            (book.title && book.title.toLowerCase().includes(term)) ||
-            (book.author_name && book.author_name.toLowerCase().includes(term)) ||
-            (book.isbn && book.isbn.includes(term))
-        );
-        renderBooks(filtered);
+    // 2. Search Functionality: on the server, so it covers every page
+    let searchTimer = null;
+    searchInput.addEventListener('input', () => {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(() => {
+            page = 1;
+            fetchBooks();
+        }, 250);
+    });
+
+    // Live updates from other desks: refresh the page and its counts, once
+    // for a burst of changes
+    let refreshTimer = null;
+    listenForChanges({
+        book: () => {
+            clearTimeout(refreshTimer);
+            refreshTimer = setTimeout(fetchBooks, 500);
+        }
     });
 
     // 3. Modal Logic
@@ -114,6 +196,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (isEditMode && book) {
             modalTitle.textContent = "Modifier le Livre";
             currentBookId = book.id;
+            currentVersion = book.version;
             document.getElementById('title').value = book.title;
             document.getElementById('author').value = book.author_name || ''; // Note: fetches name, ideally ID, but backend handles name lookup
             document.getElementById('category').value = book.category_name || '';
@@ -143,6 +226,33 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    // 3b. Author / Category suggestions from the autocomplete endpoints
+    function attachAutocomplete(inputId, listId, url) {
+        const input = document.getElementById(inputId);
+        const list = document.getElementById(listId);
+        let timer = null;
+        input.addEventListener('input', () => {
+            clearTimeout(timer);
+            const q = input.value.trim();
+            if (!q) return;
+            timer = setTimeout(() => {
+                fetch(`${url}?q=${encodeURIComponent(q)}&limit=10`)
+                    .then(res => res.json())
+                    .then(items => {
+                        list.innerHTML = '';
+                        items.forEach(item => {
+                            const opt = document.createElement('option');
+                            opt.value = item.name;
+                            list.appendChild(opt);
+                        });
+                    })
+                    .catch(err => console.error(err));
+            }, 150);
+        });
+    }
+    attachAutocomplete('author', 'authorSuggestions', '/api/auteurs/autocomplete');
+    attachAutocomplete('category', 'categorySuggestions', '/api/categories/autocomplete');
+
     // 4. Save Book Logic (AJAX) - Handles both Add and Edit
     bookForm.addEventListener('submit', (e) => {
         e.preventDefault();
@@ -165,6 +275,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (isEditMode) {
             url = '/api/livres/edit';
             formData.append('id', currentBookId);
+            formData.append('version', currentVersion);
         }
 
         fetch(url, {
@@ -178,6 +289,14 @@ document.addEventListener('DOMContentLoaded', () => {
                     modal.style.display = "none";
                     bookForm.reset();
                     fetchBooks(); // Reload list
+                } else if (result.conflict && result.current) {
+                    // Someone saved first: show their values, a new save overwrites them
+                    alert(result.error);
+                    openModal('edit', result.current);
+                    fetchBooks();
+                } else if (result.deleted_id) {
+                    // The ISBN belongs to a deleted record: bring it back
+                    if (confirm(`${result.error}\nRestaurer ce livre ?`)) restoreDeleted(result.deleted_id);
                 } else {
                     alert("Erreur: " + (result.error || "Une erreur est survenue."));
                 }
@@ -185,7 +304,157 @@ document.addEventListener('DOMContentLoaded', () => {
             .catch(err => console.error(err));
     });
 
+    function restoreDeleted(id) {
+        const formData = new FormData();
+        formData.append('id', id);
+        fetch('/api/livres/restore', { method: 'POST', body: formData })
+            .then(response => response.json())
+            .then(result => {
+                if (result.success) {
+                    modal.style.display = "none";
+                    fetchBooks();
+                } else {
+                    alert("Erreur: " + (result.error || "Une erreur est survenue."));
+                }
+            })
+            .catch(err => console.error(err));
+    }
+
     // 5. Global Actions
+    // Other branches copies can be transferred to
+    let otherBranches = [];
+    fetch('/api/branches')
+        .then(res => res.json())
+        .then(list => {
+            otherBranches = list.filter(b => !b.current);
+            if (otherBranches.length && window.allBooks) renderBooks(window.allBooks);
+        })
+        .catch(err => console.error(err));
+
+    window.transferBook = function (id) {
+        const book = window.allBooks.find(b => b.id == id);
+        if (!book) return;
+        const choices = otherBranches.map(b => `${b.code} : ${b.name}`).join('\n');
+        const code = prompt(`Agence de destination (code) :\n${choices}`);
+        if (!code) return;
+        const target = otherBranches.find(b => b.code === code.trim().toUpperCase());
+        if (!target) {
+            alert('Agence inconnue');
+            return;
+        }
+        const copies = parseInt(prompt(`Nombre d'exemplaires à transférer (max ${book.available_copies}) :`, '1'), 10);
+        if (!copies) return;
+
+        const formData = new FormData();
+        formData.append('book_id', id);
+        formData.append('branch_id', target.id);
+        formData.append('copies', copies);
+        fetch('/api/livres/transfer', { method: 'POST', body: formData })
+            .then(response => response.json())
+            .then(result => {
+                if (result.success) {
+                    fetchBooks();
+                } else {
+                    alert("Erreur lors du transfert : " + (result.error || "Une erreur inconnue est survenue."));
+                }
+            })
+            .catch(err => console.error(err));
+    }
+
+    // Copies of a title: condition, withdrawal, labels
+    const copiesModal = document.getElementById('copiesModal');
+    const copiesTableBody = document.getElementById('copiesTableBody');
+    const addCopiesForm = document.getElementById('addCopiesForm');
+    const conditions = ['Neuf', 'Bon', 'Usé', 'Abîmé'];
+    let copiesBookId = null;
+
+    function renderCopies(result) {
+        document.getElementById('copiesTitle').innerText =
+            `Exemplaires de « ${result.book.title} » (${result.book.available_copies} / ${result.book.total_copies})`;
+        copiesTableBody.innerHTML = '';
+        result.copies.forEach(copy => {
+            const row = document.createElement('tr');
+            const statusCell = copy.status === 'Prêté' ? copy.status : `
+                <select onchange="window.updateCopy(${copy.id}, 'status', this.value)">
+                    ${['Disponible', 'Retiré'].map(s => `<option ${s === copy.status ? 'selected' : ''}>${s}</option>`).join('')}
+                </select>`;
+            row.innerHTML = `
+                <td><strong>${copy.barcode}</strong></td>
+                <td>
+                    <select onchange="window.updateCopy(${copy.id}, 'condition', this.value)">
+                        ${conditions.map(c => `<option ${c === copy.condition ? 'selected' : ''}>${c}</option>`).join('')}
+                    </select>
+                </td>
+                <td>${statusCell}</td>
+                <td>${copy.loan_id ? `${copy.reader_name || 'N/A'}, retour le ${new Date(copy.due_date).toLocaleDateString('fr-FR')}` : '-'}</td>
+            `;
+            copiesTableBody.appendChild(row);
+        });
+    }
+
+    function loadCopies() {
+        return fetch(`/api/livres/${copiesBookId}/exemplaires`)
+            .then(res => res.json())
+            .then(result => {
+                if (!result.success) {
+                    alert("Erreur: " + (result.error || "Une erreur est survenue."));
+                    return;
+                }
+                renderCopies(result);
+            });
+    }
+
+    window.showCopies = function (id) {
+        copiesBookId = id;
+        addCopiesForm.reset();
+        loadCopies()
+            .then(() => { copiesModal.style.display = 'block'; })
+            .catch(err => console.error(err));
+    }
+
+    window.updateCopy = function (id, field, value) {
+        const formData = new FormData();
+        formData.append('id', id);
+        formData.append(field, value);
+        fetch('/api/exemplaires/edit', { method: 'POST', body: formData })
+            .then(response => response.json())
+            .then(result => {
+                if (!result.success) alert("Erreur: " + (result.error || "Une erreur est survenue."));
+                loadCopies();
+                fetchBooks();
+            })
+            .catch(err => console.error(err));
+    }
+
+    addCopiesForm.addEventListener('submit', (e) => {
+        e.preventDefault();
+        const barcodes = document.getElementById('newBarcodes').value.trim();
+        const formData = new FormData();
+        formData.append('book_id', copiesBookId);
+        formData.append('barcodes', barcodes);
+        if (!barcodes) formData.append('count', document.getElementById('newCopiesCount').value);
+        fetch('/api/exemplaires/add', { method: 'POST', body: formData })
+            .then(response => response.json())
+            .then(result => {
+                if (result.success) {
+                    addCopiesForm.reset();
+                    loadCopies();
+                    fetchBooks();
+                } else {
+                    alert("Erreur: " + (result.error || "Une erreur est survenue."));
+                }
+            })
+            .catch(err => console.error(err));
+    });
+
+    document.getElementById('closeCopiesModal').addEventListener('click', () => {
+        copiesModal.style.display = 'none';
+    });
+
+    window.addEventListener('click', (e) => {
+        if (e.target == copiesModal) copiesModal.style.display = 'none';
+    });
+
     window.deleteBook = function (id) {
         if (confirm('Êtes-vous sûr de vouloir supprimer ce livre ?')) {
             const formData = new FormData();
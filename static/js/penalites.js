@@ -73,24 +73,29 @@ document.addEventListener('DOMContentLoaded', () => {
     // Initial Load
     fetchPenalties();
 
-    // 3. Populate Dropdowns (Types & Readers)
+    // 3. Populate Dropdowns: types are a short list, readers and books are searched as you type
+    const readerPicker = attachTypeahead(
+        document.getElementById('readerSearch'), document.getElementById('readerSelect'), '/api/typeahead/readers',
+        r => new Option(r.full_name, r.id),
+        'Choisir un lecteur'
+    );
+    const bookPicker = attachTypeahead(
+        document.getElementById('bookSearch'), document.getElementById('bookSelect'), '/api/typeahead/books',
+        b => {
+            const opt = new Option(b.title, b.id);
+            opt.dataset.price = b.price || 0;
+            return opt;
+        },
+        'Aucun livre associé'
+    );
+
     function populateSelects() {
         return Promise.all([
-            fetch('/api/penalites?action=fetch_readers').then(res => res.json()),
             fetch('/api/penalites?action=fetch_types').then(res => res.json()),
-            fetch('/api/livres?action=fetch').then(res => res.json())
-        ]).then(([readers, types, books]) => {
-            const readerSelect = document.getElementById('readerSelect');
+            readerPicker.reset(),
+            bookPicker.reset()
+        ]).then(([types]) => {
             const typeSelect = document.getElementById('typeSelect');
-            const bookSelect = document.getElementById('bookSelect');
-
-            readerSelect.innerHTML = '<option value="">Choisir un lecteur</option>';
-            readers.forEach(r => {
-                const opt = document.createElement('option');
-                opt.value = r.id;
-                opt.textContent = r.full_name;
-                readerSelect.appendChild(opt);
-            });
 
             typeSelect.innerHTML = '<option value="">Choisir un type</option>';
             types.forEach(t => {
@@ -102,17 +107,6 @@ document.addEventListener('DOMContentLoaded', () => {
                 opt.dataset.label = t.label; // Store label for logic
                 typeSelect.appendChild(opt);
             });
-
-            if(bookSelect) {
-                bookSelect.innerHTML = '<option value="">Aucun livre associé</option>';
-                books.forEach(b => {
-                    const opt = document.createElement('option');
-                    opt.value = b.id;
-                    opt.textContent = b.title;
-                    opt.dataset.price = b.price;
-                    bookSelect.appendChild(opt);
-                });
-            }
         });
     }
 
@@ -239,7 +233,7 @@ document.addEventListener('DOMContentLoaded', () => {
         document.querySelector('.modal-content h2').innerText = 'Modifier la Pénalité';
 
         populateSelects().then(() => {
-            document.getElementById('readerSelect').value = item.reader_id;
+            readerPicker.choose(item.reader_id, item.reader_name);
             document.getElementById('typeSelect').value = item.penalty_type_id || "";
             document.getElementById('reason').value = item.reason;
             document.getElementById('amount').value = item.amount;
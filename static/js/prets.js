@@ -44,7 +44,7 @@ document.addEventListener('DOMContentLoaded', () => {
             else statusClass = 'badge-success'; // Terminé
 
             row.innerHTML = `
-                <td><strong>${loan.book_title || 'N/A'}</strong></td>
+                <td><strong>${loan.book_title || 'N/A'}</strong>${loan.barcode ? `<br><small>${loan.barcode}</small>` : ''}</td>
                 <td>${loan.reader_name || 'N/A'}</td>
                 <td>${formatDate(loan.loan_date)}</td>
                 <td>${formatDate(loan.due_date)}</td>
@@ -71,27 +71,121 @@ document.addEventListener('DOMContentLoaded', () => {
     // Initial Load
     fetchLoans();
 
-    // 2. Populate Dropdowns
+    // Live updates from other desks; returned loans leave the list
+    listenForChanges({
+        loan: event => {
+            if (event.data.status === 'Terminé') event.action = 'delete';
+            window.allLoans = applyChange(window.allLoans, event);
+            renderTable(window.allLoans);
+        },
+        book: event => {
+            // Loans of a deleted book are deleted with it
+            if (event.action !== 'delete' || !window.allLoans) return;
+            window.allLoans = window.allLoans.filter(l => l.book_id !== event.data.id);
+            renderTable(window.allLoans);
+        }
+    });
+
+    // 2. Dropdowns: search-as-you-type, only available books and active readers
+    const bookPicker = attachTypeahead(
+        document.getElementById('bookSearch'), bookSelect, '/api/typeahead/books?available=1',
+        book => new Option(book.available_copies !== undefined ? `${book.title} (${book.available_copies} dispo)` : book.title, book.id),
+        'Choisir un livre...'
+    );
+    const readerPicker = attachTypeahead(
+        document.getElementById('readerSearch'), readerSelect, '/api/typeahead/readers?status=Actif',
+        reader => new Option(reader.full_name, reader.id),
+        'Choisir un lecteur...'
+    );
+
     function populateSelects() {
-        return fetch('/api/prets?action=fetch_options')
-            .then(res => res.json())
-            .then(data => {
-                const books = data.books;
-                const readers = data.readers;
-                bookSelect.innerHTML = '<option value="">Choisir un livre...</option>';
-                books.forEach(book => {
-                    bookSelect.innerHTML += `<option value="${book.id}">${book.title} (${book.available_copies} dispo)</option>`;
-                });
+        return Promise.all([bookPicker.reset(), readerPicker.reset()]);
+    }
 
-                readerSelect.innerHTML = '<option value="">Choisir un lecteur...</option>';
-                readers.forEach(reader => {
-                    readerSelect.innerHTML += `<option value="${reader.id}">${reader.full_name}</option>`;
-                });
-            }).catch(err => console.error('Error loading data:', err));
+    // 2b. Barcode scan: a copy label lends that very copy, an ISBN any copy
+    // of the matching book
+    const isbnScan = document.getElementById('isbnScan');
+    let scannedCopy = null;
+
+    function selectBook(book) {
+        if (!bookSelect.querySelector(`option[value="${book.id}"]`)) {
+            bookSelect.innerHTML += `<option value="${book.id}">${book.title} (${book.available_copies} dispo)</option>`;
+        }
+        bookSelect.value = book.id;
+        isbnScan.value = '';
+        readerSelect.focus();
     }
 
+    function scanIsbn(code) {
+        return fetch(`/api/livres/isbn/${encodeURIComponent(code)}`)
+            .then(res => res.json())
+            .then(result => {
+                if (!result.success) {
+                    alert("Erreur: " + result.error);
+                    return;
+                }
+                const book = result.book;
+                if (book.available_copies <= 0) {
+                    alert(`« ${book.title} » n'a aucune copie disponible.`);
+                    return;
+                }
+                selectBook(book);
+            });
+    }
+
+    isbnScan.addEventListener('keydown', (e) => {
+        if (e.key !== 'Enter') return;
+        e.preventDefault(); // Scanners send Enter, don't submit the form
+        const code = isbnScan.value.trim();
+        if (!code) return;
+
+        scannedCopy = null;
+        fetch(`/api/exemplaires/${encodeURIComponent(code)}`)
+            .then(res => res.json())
+            .then(result => {
+                if (!result.success) return scanIsbn(code);
+                if (result.copy.status !== 'Disponible') {
+                    alert(`L'exemplaire ${result.copy.barcode} n'est pas en rayon (${result.copy.status}).`);
+                    return;
+                }
+                scannedCopy = result.copy;
+                selectBook(result.book);
+            })
+            .catch(err => console.error(err));
+    });
+
+    // Picking another book by hand drops the scanned copy
+    bookSelect.addEventListener('change', () => { scannedCopy = null; });
+
+    // 2c. Scan-to-return from the list
+    const returnScan = document.getElementById('returnScan');
+    returnScan.addEventListener('keydown', (e) => {
+        if (e.key !== 'Enter') return;
+        e.preventDefault();
+        const code = returnScan.value.trim();
+        if (!code) return;
+
+        const formData = new FormData();
+        formData.append('barcode', code);
+        fetch('/api/prets/return', {
+            method: 'POST',
+            body: formData
+        })
+            .then(response => response.json())
+            .then(result => {
+                returnScan.value = '';
+                if (result.success) {
+                    fetchLoans();
+                } else {
+                    alert("Erreur: " + (result.error || 'Erreur inconnue'));
+                }
+            })
+            .catch(err => console.error(err));
+    });
+
     let isEditing = false;
     let currentId = null;
+    let currentVersion = null;
 
     // Edit Function
     window.editLoan = function (id) {
@@ -100,11 +194,12 @@ document.addEventListener('DOMContentLoaded', () => {
 
         isEditing = true;
         currentId = id;
+        currentVersion = item.version;
         document.querySelector('.modal-content h2').innerText = 'Modifier le Prêt';
 
         populateSelects().then(() => {
-            bookSelect.value = item.book_id;
-            readerSelect.value = item.reader_id;
+            bookPicker.choose(item.book_id, item.book_title);
+            readerPicker.choose(item.reader_id, item.reader_name);
             document.getElementById('loanDate').value = item.loan_date;
             document.getElementById('returnDate').value = item.due_date;
             modal.style.display = "block";
@@ -115,6 +210,7 @@ document.addEventListener('DOMContentLoaded', () => {
     addLoanBtn.addEventListener('click', () => {
         isEditing = false;
         currentId = null;
+        scannedCopy = null;
         addLoanForm.reset();
         document.querySelector('.modal-content h2').innerText = 'Enregistrer un Prêt';
 
@@ -158,11 +254,15 @@ document.addEventListener('DOMContentLoaded', () => {
         const url = isEditing ? '/api/prets/edit' : '/api/prets/add';
         const loanData = {
             id: currentId,
+            version: currentVersion,
             book_id: parseInt(bookSelect.value),
             reader_id: parseInt(readerSelect.value),
             loan_date: document.getElementById('loanDate').value,
             due_date: document.getElementById('returnDate').value
         };
+        if (!isEditing && scannedCopy && scannedCopy.book_id === loanData.book_id) {
+            loanData.barcode = scannedCopy.barcode;
+        }
 
         if (!loanData.book_id || !loanData.reader_id) {
             alert("Veuillez sélectionner un livre et un lecteur.");
@@ -181,6 +281,12 @@ document.addEventListener('DOMContentLoaded', () => {
                     modal.style.display = "none";
                     addLoanForm.reset();
                     fetchLoans(); // Reload list
+                } else if (result.conflict && result.current) {
+                    // Someone saved first: reopen with their values
+                    alert(result.error);
+                    window.allLoans = window.allLoans.map(l => l.id === result.current.id ? result.current : l);
+                    window.editLoan(result.current.id);
+                    fetchLoans();
                 } else {
                     alert("Erreur: " + (result.error || "Erreur inconnue"));
                 }
@@ -193,6 +299,8 @@ document.addEventListener('DOMContentLoaded', () => {
         if (confirm('Confirmer le retour de ce livre ?')) {
             const formData = new FormData();
             formData.append('id', id);
+            const loan = window.allLoans.find(l => l.id == id);
+            if (loan) formData.append('version', loan.version);
 
             fetch('/api/prets/return', {
                 method: 'POST',
@@ -205,6 +313,7 @@ document.addEventListener('DOMContentLoaded', () => {
                         fetchLoans(); // Reload
                     } else {
                         alert("Erreur: " + (result.error || 'Erreur inconnue'));
+                        if (result.conflict) fetchLoans();
                     }
                 })
                 .catch(err => console.error(err));
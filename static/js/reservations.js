@@ -75,7 +75,10 @@ document.addEventListener('DOMContentLoaded', () => {
                 <td>${item.reader_name || 'N/A'}</td>
                 <td>${formatDate(item.reservation_date)}</td>
                 <td>${formatDate(item.expiry_date)}</td>
-                <td><span class="status ${statusClass}">${item.status}</span></td>
+                <td>
+                    <span class="status ${statusClass}">${item.status}</span>
+                    ${item.estimated_available_date ? `<div style="font-size: 0.8rem; color: #666; margin-top: 4px;">Dispo. estimée : ${formatDate(item.estimated_available_date)} (rang ${item.queue_position})</div>` : ''}
+                </td>
                 <td>${actionBtn}</td>
             `;
             tableBody.appendChild(row);
@@ -85,24 +88,55 @@ document.addEventListener('DOMContentLoaded', () => {
     // Initial Load
     fetchReservations();
 
-    // 2. Populate Dropdowns
-    function populateSelects() {
-        return Promise.all([
-            fetch('/api/livres?action=fetch').then(r => r.json()),
-            fetch('/api/lecteurs?action=fetch').then(r => r.json())
-        ]).then(([books, readers]) => {
-            bookSelect.innerHTML = '<option value="">Choisir un livre...</option>';
-            books.forEach(book => {
-                if (book.available_copies === 0) {
-                    bookSelect.innerHTML += `<option value="${book.id}">${book.title}</option>`;
-                }
-            });
+    // Live updates from other desks
+    function renumberQueues(rows) {
+        // Queue rank per book among pending reservations, oldest first
+        const waiting = {};
+        rows.slice().sort((a, b) => a.id - b.id).forEach(r => {
+            if (r.status === 'En attente') {
+                waiting[r.book_id] = (waiting[r.book_id] || 0) + 1;
+                r.queue_position = waiting[r.book_id];
+            } else {
+                r.queue_position = null;
+                r.estimated_available_date = null;
+            }
+        });
+        return rows;
+    }
 
-            readerSelect.innerHTML = '<option value="">Choisir un lecteur...</option>';
-            readers.forEach(reader => {
-                readerSelect.innerHTML += `<option value="${reader.id}">${reader.first_name} ${reader.last_name}</option>`;
-            });
-        }).catch(err => console.error('Error loading data:', err));
+    listenForChanges({
+        reservation: event => {
+            window.allReservations = renumberQueues(applyChange(window.allReservations, event));
+            renderTable(window.allReservations);
+        },
+        book: event => {
+            if (!window.allReservations) return;
+            if (event.action === 'delete') {
+                // Its reservations were deleted with it
+                window.allReservations = window.allReservations.filter(r => r.book_id !== event.data.id);
+            } else {
+                window.allReservations.forEach(r => {
+                    if (r.book_id === event.data.id) r.book_available = event.data.available_copies > 0;
+                });
+            }
+            renderTable(window.allReservations);
+        }
+    });
+
+    // 2. Dropdowns: search-as-you-type, reservations only target books with no free copy
+    const bookPicker = attachTypeahead(
+        document.getElementById('bookSearch'), bookSelect, '/api/typeahead/books?available=0',
+        book => new Option(book.title, book.id),
+        'Choisir un livre...'
+    );
+    const readerPicker = attachTypeahead(
+        document.getElementById('readerSearch'), readerSelect, '/api/typeahead/readers',
+        reader => new Option(reader.full_name, reader.id),
+        'Choisir un lecteur...'
+    );
+
+    function populateSelects() {
+        return Promise.all([bookPicker.reset(), readerPicker.reset()]);
     }
 
     // 3. Modal Logic
@@ -182,37 +216,9 @@ document.addEventListener('DOMContentLoaded', () => {
         currentId = id;
         document.querySelector('.modal-content h2').innerText = 'Modifier la Réservation';
 
-        populateSelects(); // Usually async, but we might have data cached or we just wait. 
-        // Ideally wait for selects to populate then set values. 
-        // For simplicity calling it then setting timeout or just setting values if options exist.
-        // Better approach: populateSelects returns promise.
-
-        // Since populateSelects is async, let's just trigger it and wait a bit or attach logic.
-        // Rewriting populateSelects to return promise would be best but let's just assume data is there if called before or we force it.
-        // Actually populateSelects fetches fresh data every time.
-
-        // Let's modify populateSelects to take a callback? 
-        // Or just rely on the fact that if options are there we set them. 
-
-        // FIX: Let's fetch selects first then set values.
-        Promise.all([
-            fetch('/api/livres?action=fetch').then(r => r.json()),
-            fetch('/api/lecteurs?action=fetch').then(r => r.json())
-        ]).then(([books, readers]) => {
-            bookSelect.innerHTML = '<option value="">Choisir un livre...</option>';
-            books.forEach(b => {
-                if (b.available_copies === 0 || b.id === item.book_id) {
-                    bookSelect.innerHTML += `<option value="${b.id}">${b.title}</option>`;
-                }
-            });
-
-            readerSelect.innerHTML = '<option value="">Choisir un lecteur...</option>';
-            readers.forEach(r => readerSelect.innerHTML += `<option value="${r.id}">${r.first_name} ${r.last_name}</option>`);
-
-            // Set Values
-            bookSelect.value = item.book_id;
-            readerSelect.value = item.reader_id;
-
+        populateSelects().then(() => {
+            bookPicker.choose(item.book_id, item.book_title);
+            readerPicker.choose(item.reader_id, item.reader_name);
             modal.style.display = "block";
         });
     }
@@ -1,21 +1,48 @@
 document.addEventListener('DOMContentLoaded', () => {
     const tableBody = document.getElementById('returnsTableBody');
+    const prevBtn = document.getElementById('prevPage');
+    const nextBtn = document.getElementById('nextPage');
+    const pageInfo = document.getElementById('pageInfo');
+    const perPage = 50;
+    // Cursors of the pages already visited; the last one is the current page
+    const cursors = [''];
+    let nextCursor = null;
 
-    // 1. Fetch Returns History from Server
+    // 1. Fetch one page of Returns History from Server
     function fetchReturns() {
-        tableBody.innerHTML = "<tr><td colspan='4' style='text-align:center'>Chargement...</td></tr>";
-        fetch('/api/retours?action=fetch')
+        const before = cursors[cursors.length - 1];
+        tableBody.innerHTML = "<tr><td colspan='5' style='text-align:center'>Chargement...</td></tr>";
+        fetch(`/api/retours?action=fetch&per_page=${perPage}${before ? `&before=${encodeURIComponent(before)}` : ''}`)
             .then(response => response.json())
             .then(data => {
-                window.allReturns = data;
-                renderTable(data);
+                nextCursor = data.next;
+                window.allReturns = data.items;
+                renderTable(data.items);
+                renderPager();
             })
             .catch(error => {
                 console.error('Error:', error);
-                tableBody.innerHTML = "<tr><td colspan='4' style='text-align:center; color:red'>Erreur de chargement.</td></tr>";
+                tableBody.innerHTML = "<tr><td colspan='5' style='text-align:center; color:red'>Erreur de chargement.</td></tr>";
             });
     }
 
+    function renderPager() {
+        pageInfo.innerText = `Page ${cursors.length}`;
+        prevBtn.disabled = cursors.length <= 1;
+        nextBtn.disabled = !nextCursor;
+    }
+
+    prevBtn.addEventListener('click', () => {
+        if (cursors.length <= 1) return;
+        cursors.pop();
+        fetchReturns();
+    });
+    nextBtn.addEventListener('click', () => {
+        if (!nextCursor) return;
+        cursors.push(nextCursor);
+        fetchReturns();
+    });
+
     function formatDate(dateString) {
         if (!dateString) return 'N/A';
         const date = new Date(dateString);
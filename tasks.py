@@ -0,0 +1,121 @@
+"""Background task handlers run by the job workers (see jobs.py)."""
+import csv
+import os
+from datetime import date
+
+from flask import current_app
+from jobs import task, artifact_dir
+import archive
+import backup
+import branches
+import copies
+import deletion
+import notices
+import recommendations
+import roster
+from models import db, Book, Reader, Loan
+
+
+@task('generate_report')
+def generate_report(payload, job):
+    # The report covers the branch it was requested from
+    with branches.use(payload.get('branch_id')):
+        return _write_report(job)
+
+
+def _write_report(job):
+    filename = f"rapport_biblionest_{date.today().strftime('%Y-%m-%d')}_{job.id}.csv"
+    path = os.path.join(artifact_dir(), filename)
+
+    # utf-8-sig adds the BOM Excel needs
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        cw = csv.writer(f)
+        cw.writerow(['RAPPORT BIBLIONEST - ' + date.today().strftime('%d/%m/%Y')])
+        cw.writerow([])
+
+        total_books = Book.query.count()
+        total_readers = Reader.query.count()
+        active_loans = Loan.query.filter(Loan.returned_at == None).count()
+        overdue = Loan.query.filter(Loan.returned_at == None, Loan.due_date < date.today()).count()
+
+        cw.writerow(['Statistiques Globales'])
+        cw.writerow(['Total Livres', 'Total Lecteurs', 'Prêts Actifs', 'Retards'])
+        cw.writerow([total_books, total_readers, active_loans, overdue])
+        cw.writerow([])
+
+        cw.writerow(['Prêts en retard'])
+        cw.writerow(['Lecteur', 'Livre', 'Date Prêt', 'Échéance', 'Jours de Retard'])
+        overdue_loans = Loan.query.filter(Loan.returned_at == None, Loan.due_date < date.today()) \
+            .options(db.joinedload(Loan.reader), db.joinedload(Loan.book)).yield_per(500)
+        for loan in overdue_loans:
+            cw.writerow([
+                f"{loan.reader.first_name} {loan.reader.last_name}" if loan.reader else 'N/A',
+                loan.book.title if loan.book else 'N/A',
+                loan.loan_date.strftime('%Y-%m-%d'),
+                loan.due_date.strftime('%Y-%m-%d'),
+                (date.today() - loan.due_date).days
+            ])
+        cw.writerow([])
+
+        cw.writerow(['État des Stocks'])
+        cw.writerow(['Titre', 'ISBN', 'Total', 'Disponible', 'Statut'])
+        for b in Book.query.order_by(Book.available_copies.asc()).yield_per(500):
+            cw.writerow([b.title, b.isbn, b.total_copies, b.available_copies, b.status])
+
+    return {'artifact': filename, 'books': total_books, 'overdue': overdue}
+
+
+@task('resync_stocks')
+def resync_stocks(payload, job):
+    # Copies are the truth: statuses from open loans, counters from copies
+    return {'updated': copies.resync()}
+
+
+@task('send_notices', max_attempts=1)
+def send_notices(payload, job):
+    return notices.run()
+
+
+@task('archive_loans')
+def archive_loans(payload, job):
+    moved = archive.archive_finished_loans(
+        payload.get('older_than_days', current_app.config['ARCHIVE_AFTER_DAYS']),
+        current_app.config['ARCHIVE_BATCH_SIZE']
+    )
+    return {'archived': moved}
+
+
+@task('record_loan_cooccurrence')
+def record_loan_cooccurrence(payload, job):
+    pairs = recommendations.record_loan(payload['loan_id'], payload['reader_id'], payload['book_id'])
+    return {'pairs': pairs}
+
+
+@task('rebuild_recommendations', max_attempts=1)
+def rebuild_recommendations(payload, job):
+    return {'books': recommendations.rebuild()}
+
+
+@task('archive_deleted')
+def archive_deleted(payload, job):
+    return {'archived': deletion.archive_deleted(payload['entity'], payload['id'],
+                                                 current_app.config['ARCHIVE_BATCH_SIZE'])}
+
+
+@task('import_readers', max_attempts=1)
+def import_readers(payload, job):
+    filename = f"import_lecteurs_{job.id}_resultat.csv"
+    with branches.use(payload.get('branch_id')):
+        counts = roster.import_file(payload['path'], os.path.join(artifact_dir(), filename), payload.get('format'))
+    os.remove(payload['path'])
+    return dict(counts, artifact=filename)
+
+
+@task('backup', max_attempts=2)
+def run_backup(payload, job):
+    interval = current_app.config['BACKUP_INTERVAL_HOURS']
+    if payload.get('scheduled') and interval:
+        # Queued first, so a failed run does not stop the schedule
+        backup.schedule(int(interval * 3600), running_id=job.id)
+    path = backup.create()
+    return {'path': os.path.basename(path), 'size': os.path.getsize(path)}
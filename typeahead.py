@@ -0,0 +1,63 @@
+"""Prefix search for the book and reader pickers in the modals.
+
+Books and readers carry normalized search keys (see names.normalize) with
+plain indexes, so a prefix match is an index range scan limited to N rows
+instead of a full table download.
+"""
+from sqlalchemy import or_
+from models import db, Book, Reader
+from names import normalize
+
+# Upper bound of the prefix range: the last character of the Basic
+# Multilingual Plane, the highest one a MySQL utf8 (utf8mb3) column accepts
+# as a bound. LIKE 'prefix%' would not use the plain index on SQLite
+_MAX_CHAR = '\uffff'
+
+
+def book_key(title):
+    return normalize(title)[:255]
+
+
+def reader_keys(first_name, last_name):
+    """(first last, last first) keys so either name can be typed first."""
+    return normalize(f"{first_name} {last_name}")[:201], normalize(f"{last_name} {first_name}")[:201]
+
+
+def _prefix(column, key):
+    return (column >= key) & (column < key + _MAX_CHAR)
+
+
+def search_books(q, limit=10, available=None):
+    """available: True = has free copies, False = none free, None = any."""
+    query = Book.query
+    key = normalize(q)
+    if key:
+        query = query.filter(_prefix(Book.title_key, key))
+    if available is True:
+        query = query.filter(Book.available_copies > 0)
+    elif available is False:
+        query = query.filter(Book.available_copies == 0)
+    return query.order_by(Book.title_key).limit(limit).all()
+
+
+def search_readers(q, limit=10, status=None):
+    query = Reader.query
+    key = normalize(q)
+    if key:
+        query = query.filter(or_(
+            _prefix(Reader.name_key, key),
+            _prefix(Reader.surname_key, key),
+            _prefix(Reader.email, key)
+        ))
+    if status:
+        query = query.filter(Reader.status == status)
+    return query.order_by(Reader.surname_key).limit(limit).all()
+
+
+def backfill():
+    """Compute search keys for rows created before they existed."""
+    for book in Book.query.filter(Book.title_key == None).all():
+        book.title_key = book_key(book.title)
+    for reader in Reader.query.filter(Reader.name_key == None).all():
+        reader.name_key, reader.surname_key = reader_keys(reader.first_name, reader.last_name)
+    db.session.commit()
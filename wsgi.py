@@ -0,0 +1,27 @@
+"""WSGI entry point for production servers.
+
+    gunicorn -c gunicorn.conf.py     (Linux/macOS)
+    flask --app app serve            (picks gunicorn or waitress)
+"""
+from app import app
+from models import db
+import availability
+import names
+
+
+def warm_up(app):
+    """Pay the cold-start costs before the first request arrives."""
+    # Compile every Jinja template into the environment cache
+    for name in app.jinja_env.list_templates():
+        if name.endswith('.html'):
+            app.jinja_env.get_template(name)
+    with app.app_context():
+        # Fresh pool connections (never reuse ones inherited across fork)
+        db.engine.dispose(close=False)
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql('SELECT 1')
+        # In-memory autocomplete and availability indexes
+        names.autocomplete('author', 'a')
+        names.autocomplete('category', 'a')
+        availability.rebuild()
+        db.session.remove()